@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    Copyright 2023 Lecture2Go, Dr. Benjamin Milde
+#
+#    Licensed under the Apache License, Version 2.0 (the 'License');
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an 'AS IS' BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Shared audio ingest for all ASR engines: every media file is decoded once to 16 kHz mono 16 bit PCM
+# and stored in an on-disk cache, keyed by the content of the media file. Retries and re-runs of the same media
+# file (e.g. with another engine or other decoding options) don't need to decode the file again.
+# The decoded audio is stored as a plain PCM wav file, so that it can be memory mapped (see load_decoded_audio)
+# and can also be passed directly to Kaldi in a wav.scp file.
+# The cache is limited in size, the least recently used files are removed first.
+
+import os
+import wave
+import shutil
+import struct
+import hashlib
+import tempfile
+
+import ffmpeg
+import numpy as np
+from scipy.io import wavfile
+
+from utils import preprocess_audio
+
+default_cache_dir = 'tmp/audio_cache'
+
+# Default maximum size of the cache, in GB
+default_cache_size = 10.0
+
+decoded_samplerate = 16000
+
+
+# True, if the file is already a 16 kHz mono 16 bit PCM wav file, i.e. it doesn't need to be decoded
+def is_decoded_wav(filename):
+    try:
+        with wave.open(filename, 'rb') as wav_file:
+            return (wav_file.getnchannels() == 1 and wav_file.getsampwidth() == 2
+                    and wav_file.getframerate() == decoded_samplerate and wav_file.getcomptype() == 'NONE')
+    except (wave.Error, EOFError, OSError):
+        return False
+
+
+# Hash of the complete file content, so that the same media file has the same key regardless of its name or path.
+# Reading the file is much faster than decoding it.
+def content_key(filename, block_size=1024*1024):
+    content_hash = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as media_file:
+        for block in iter(lambda: media_file.read(block_size), b''):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+# Removes the least recently used files of the cache, until all files fit into max_size GB.
+# The files in keep are never removed.
+def evict_cache(cache_dir, max_size=default_cache_size, keep=()):
+    keep = {os.path.abspath(filename) for filename in keep}
+    cache_files = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith('.wav'):
+            stat = entry.stat()
+            cache_files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    cache_size = sum(size for _, size, _ in cache_files)
+    for _, size, path in sorted(cache_files):
+        if cache_size <= max_size * 1024**3:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        try:
+            os.remove(path)
+            cache_size -= size
+        except FileNotFoundError:
+            # Already removed by another job
+            cache_size -= size
+
+
+# The filename of the decoded audio of a media file in the cache (which may not exist yet)
+def cache_filename(filename, cache_dir=default_cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, f'{content_key(filename)}.wav')
+
+
+# Returns the filename of the decoded 16 kHz mono PCM wav file of a media file.
+# Media files that are already 16 kHz mono PCM wav files are used directly, without ffmpeg and without the cache.
+# Otherwise the file is decoded with ffmpeg into the cache, unless it is already there.
+# Raises ffmpeg.Error if the file can't be decoded.
+def decoded_audio(filename, cache_dir=default_cache_dir, max_size=default_cache_size, status=None):
+    if is_decoded_wav(filename):
+        if status:
+            status.publish_status('Input file is already 16 kHz mono audio, no need to convert it.')
+        return filename
+
+    cached_filename = cache_filename(filename, cache_dir)
+
+    if os.path.exists(cached_filename):
+        # Mark as recently used
+        os.utime(cached_filename)
+        if status:
+            status.publish_status('Using cached 16 kHz mono audio.')
+        return cached_filename
+
+    # Decode into a temporary file first and rename it, so that other jobs never see a partial file
+    tmp_fd, tmp_filename = tempfile.mkstemp(suffix='.wav.part', dir=cache_dir)
+    os.close(tmp_fd)
+    try:
+        preprocess_audio(filename, tmp_filename)
+        os.replace(tmp_filename, cached_filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+    evict_cache(cache_dir, max_size=max_size, keep=[cached_filename])
+    return cached_filename
+
+
+# Decodes a media file into the cache (see decoded_audio) and links the decoded audio to link_filename, e.g. the
+# wav file of a job. Cached files are hard linked, so that a file that another job evicts from the cache stays
+# readable (its inode is only freed when the job removes its link). If the cache is on another filesystem, the
+# file is copied instead. Media files that are already decoded are not in the cache and are linked symbolically.
+# Raises ffmpeg.Error if the file can't be decoded.
+def link_decoded_audio(filename, link_filename, cache_dir=default_cache_dir, max_size=default_cache_size,
+                       status=None):
+    if os.path.lexists(link_filename):
+        os.remove(link_filename)
+    # Another job may evict the file between decoding and linking it, then it is decoded again
+    for attempt in range(3):
+        decoded_filename = decoded_audio(filename, cache_dir=cache_dir, max_size=max_size, status=status)
+        if decoded_filename == filename:
+            os.symlink(os.path.abspath(decoded_filename), link_filename)
+            return
+        try:
+            os.link(decoded_filename, link_filename)
+            return
+        except FileNotFoundError:
+            continue
+        except OSError:
+            # Different filesystems (EXDEV) or no hard links on the filesystem of the cache
+            try:
+                shutil.copyfile(decoded_filename, link_filename)
+                return
+            except FileNotFoundError:
+                continue
+    raise ffmpeg.Error('ffmpeg', b'', b'The decoded audio was evicted from the cache before it could be used.')
+
+
+# Reads exactly num_bytes from a stream, raises EOFError if the stream ends before
+def read_exactly(stream, num_bytes):
+    data = stream.read(num_bytes)
+    if len(data) != num_bytes:
+        raise EOFError('Unexpected end of the audio stream.')
+    return data
+
+
+# Reads the header of a wav stream (e.g. the stdout of ffmpeg) up to the start of the samples and validates
+# that it is 16 kHz mono 16 bit PCM. The size fields of the header are ignored, since ffmpeg can't fill them in
+# when it writes to a pipe. Returns the samplerate.
+def read_wav_header(stream):
+    riff, _, wave_id = struct.unpack('<4sI4s', read_exactly(stream, 12))
+    if riff != b'RIFF' or wave_id != b'WAVE':
+        raise ValueError('Audio stream is not a wav file.')
+
+    # Skip all chunks until the data chunk, validate the format chunk on the way
+    audio_format = None
+    while True:
+        chunk_id, chunk_size = struct.unpack('<4sI', read_exactly(stream, 8))
+        if chunk_id == b'data':
+            break
+        chunk = read_exactly(stream, chunk_size + chunk_size % 2)
+        if chunk_id == b'fmt ':
+            audio_format = struct.unpack('<HHIIHH', chunk[:16])
+    if audio_format is None:
+        raise ValueError('Audio stream has no format chunk.')
+    format_tag, channels, samplerate, _, _, bits = audio_format
+    # 0xFFFE is WAVE_FORMAT_EXTENSIBLE, ffmpeg uses it for some PCM formats
+    if format_tag not in (1, 0xFFFE) or channels != 1 or samplerate != decoded_samplerate or bits != 16:
+        raise ValueError(f'Audio stream is not 16 kHz mono 16 bit PCM: format {format_tag}, {channels} channels,'
+                         f' {samplerate} Hz, {bits} bits.')
+    return samplerate
+
+
+# Reads a 16 kHz mono 16 bit PCM wav file from a stream (e.g. the stdout of ffmpeg) directly into an int16
+# numpy array, without any intermediate buffers. The format is validated from the wav header in the stream.
+# The array is preallocated with num_samples_hint samples (e.g. from the duration of the media file), only grown
+# (in place) if the stream is longer and shrunk to the samples at the end. Returns the samplerate and the samples.
+def read_wav_stream(stream, num_samples_hint=0, block_size=1024*1024):
+    samplerate = read_wav_header(stream)
+
+    data = np.empty(max(num_samples_hint, block_size // 2), dtype=np.int16)
+    num_bytes = 0
+    while True:
+        if num_bytes == data.nbytes:
+            # The buffer is full: only grow it if the stream doesn't end here (e.g. with an exact hint)
+            next_byte = stream.read(1)
+            if not next_byte:
+                break
+            data.resize(2 * len(data), refcheck=False)
+            data.view(np.uint8)[num_bytes] = next_byte[0]
+            num_bytes += 1
+        # The views have to be released before the array can be resized
+        with memoryview(data) as view, view.cast('B') as byte_view:
+            num_read = stream.readinto(byte_view[num_bytes:num_bytes + min(block_size, data.nbytes - num_bytes)])
+        if not num_read:
+            break
+        num_bytes += num_read
+    # An odd number of bytes can only be a truncated last sample
+    data.resize(num_bytes // 2, refcheck=False)
+    return samplerate, data
+
+
+# Reads the samples of a wav stream after its header (see read_wav_header) and yields them
+# in blocks of block_size bytes as int16 arrays, as soon as they are read.
+def wav_stream_blocks(stream, block_size=1024*1024):
+    remainder = b''
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        block = remainder + block
+        num_bytes = len(block) - len(block) % 2
+        remainder = block[num_bytes:]
+        if num_bytes:
+            yield np.frombuffer(block[:num_bytes], dtype=np.int16)
+
+
+# Starts ffmpeg to decode a media file to a 16 kHz mono 16 bit PCM wav stream on its stdout
+def ffmpeg_wav_process(filename):
+    # Only errors are written to stderr, so that its pipe can't fill up while we read stdout
+    return (
+        ffmpeg
+            .input(filename)
+            .output('pipe:', format='wav', acodec='pcm_s16le', ac=1, ar='16k')
+            .global_args('-nostats', '-loglevel', 'error')
+            .run_async(pipe_stdout=True, pipe_stderr=True)
+    )
+
+
+# Decodes a media file to 16 kHz mono 16 bit PCM in memory. ffmpeg's stdout is streamed directly
+# into a preallocated int16 array, so there is only one copy of the audio in memory.
+# Raises ffmpeg.Error if the file can't be decoded.
+def stream_decoded_audio(filename):
+    try:
+        duration = float(ffmpeg.probe(filename)['format']['duration'])
+    except (ffmpeg.Error, KeyError, ValueError):
+        duration = 0.0
+    # A few seconds more, so that the array doesn't need to be grown if the duration is a bit off
+    num_samples_hint = int((duration + 5.0) * decoded_samplerate)
+
+    process = ffmpeg_wav_process(filename)
+    try:
+        samplerate, data = read_wav_stream(process.stdout, num_samples_hint)
+    except (EOFError, ValueError):
+        data = None
+    stderr = process.stderr.read()
+    if process.wait() != 0 or data is None:
+        raise ffmpeg.Error('ffmpeg', b'', stderr)
+    return samplerate, data
+
+
+# Returns the samplerate and the samples (int16 numpy array) of a media file as 16 kHz mono audio.
+# With a cache_dir, the audio is decoded into the cache (see decoded_audio) and memory mapped from there.
+# Without a cache_dir, the audio is decoded in memory (see stream_decoded_audio), or memory mapped directly
+# if the media file is already a 16 kHz mono PCM wav file.
+def load_audio(filename, cache_dir=default_cache_dir, max_size=default_cache_size, status=None):
+    if cache_dir:
+        return load_decoded_audio(decoded_audio(filename, cache_dir=cache_dir, max_size=max_size, status=status))
+    if is_decoded_wav(filename):
+        return load_decoded_audio(filename)
+    return stream_decoded_audio(filename)
+
+
+# Memory maps a decoded wav file. Returns the samplerate and the samples as an int16 numpy array,
+# no samples are read into memory until they are used.
+def load_decoded_audio(wav_filename):
+    samplerate, data = wavfile.read(wav_filename, mmap=True)
+    if samplerate != decoded_samplerate or data.dtype != np.int16 or data.ndim != 1:
+        raise ValueError(f'{wav_filename} is not a 16 kHz mono 16 bit PCM wav file.')
+    return samplerate, data
@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    Copyright 2023 Lecture2Go, Dr. Benjamin Milde
+#
+#    Licensed under the Apache License, Version 2.0 (the 'License');
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an 'AS IS' BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Reproducible micro-benchmarks for the pure python search stages: the subtitle segmentation (segment_text.py)
+# and the endpointing (simple_endpointing.py). All inputs are synthetic and generated from a fixed seed, so that
+# the JSON results of different commits can be compared directly. The endpointing benchmarks don't need any
+# models, the segmentation uses the parser-free fast scorer unless a spaCy model is given.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from scipy.io import wavfile
+from scipy.ndimage import gaussian_filter1d
+
+import segment_text
+
+# Words per minute of the synthetic transcripts, about the speaking rate of a lecture
+words_per_minute = 150
+
+# Frames per second of the endpointing, one frame is 0.01 seconds
+frames_per_second = 100
+
+synthetic_words = ['der', 'die', 'das', 'und', 'aber', 'weil', 'dass', 'wenn', 'oder', 'also', 'mit', 'von', 'in',
+                   'auf', 'für', 'ein', 'eine', 'nicht', 'wir', 'sie', 'ich', 'man', 'ist', 'sind', 'hat', 'haben',
+                   'wird', 'kann', 'muss', 'heute', 'hier', 'noch', 'schon', 'sehr', 'Vorlesung', 'Beispiel',
+                   'Energie', 'Temperatur', 'Modell', 'Frage', 'Ergebnis', 'Prozent', 'Universität', 'Studium',
+                   'Klima', 'Atmosphäre', 'Strahlung', 'Gesellschaft', 'Krise', 'wichtig', 'natürlich', 'deutlich',
+                   'gemeinsam', 'erklären', 'betrachten', 'diskutieren', 'zeigen', 'messen', 'beschreiben']
+
+
+# Generates cut rewards that look like the output of segment_text.doc_parsetree_scores:
+# short dependency tree paths inside of sentences, a few commas and a sentence end reward
+def synthetic_parsetree_scores(num_tokens, sentence_end_reward_factor=0.9, comma_end_reward_factor=0.5, seed=42):
+    rand = random.Random(seed)
+    doc_parsetree_seqs = []
+    while len(doc_parsetree_seqs) < num_tokens:
+        sent_len = rand.randint(4, 35)
+        parsetree_seq = [rand.randint(1, 6) for _ in range(sent_len - 1)]
+        parsetree_seq.append(sentence_end_reward_factor * sent_len)
+        for i in range(sent_len - 1):
+            if rand.random() < 0.05:
+                parsetree_seq[i] = comma_end_reward_factor * sent_len
+        doc_parsetree_seqs += parsetree_seq
+    return doc_parsetree_seqs[:num_tokens]
+
+
+# Generates a transcript with about words_per_minute words per minute of speech:
+# sentences of 4 to 35 words, with a few commas
+def synthetic_transcript(minutes, seed=42):
+    rand = random.Random(seed)
+    num_words = int(minutes * words_per_minute)
+    sentences = []
+    while num_words > 0:
+        sent_len = min(rand.randint(4, 35), num_words)
+        words = [rand.choice(synthetic_words) for _ in range(sent_len)]
+        for i in range(sent_len - 1):
+            if rand.random() < 0.05:
+                words[i] += ','
+        words[0] = words[0].capitalize()
+        sentences.append(' '.join(words) + '.')
+        num_words -= sent_len
+    return ' '.join(sentences)
+
+
+# Returns for every frame whether it is speech or a pause: speech runs of 2 to 20 seconds,
+# separated by pauses of 0.2 to 3 seconds
+def synthetic_speech_mask(num_frames, seed=42):
+    rand = random.Random(seed)
+    speech_mask = np.zeros(num_frames, dtype=bool)
+    pos = 0
+    while pos < num_frames:
+        speech_len = rand.randint(2 * frames_per_second, 20 * frames_per_second)
+        speech_mask[pos:pos + speech_len] = True
+        pos += speech_len + rand.randint(frames_per_second // 5, 3 * frames_per_second)
+    return speech_mask
+
+
+# Generates the smoothed and negated frame power, like process_wav computes it from the filterbank features,
+# but without any audio: speech frames have a higher power than pauses
+def synthetic_energy(num_frames, seed=42):
+    speech_mask = synthetic_speech_mask(num_frames, seed=seed)
+    rng = np.random.default_rng(seed)
+    fbank_feat_power = np.where(speech_mask, rng.normal(35.0, 3.0, num_frames), rng.normal(12.0, 1.0, num_frames))
+    return gaussian_filter1d(fbank_feat_power, sigma=20) * -1.0
+
+
+# Writes a 16 kHz mono wav file with noise bursts as speech and low noise in the pauses.
+# The audio is generated and written in blocks of one minute, so that long files don't need much memory.
+def write_synthetic_wav(wav_filename, seconds, samplerate=16000, seed=42):
+    samples_per_frame = samplerate // frames_per_second
+    num_frames = int(seconds * frames_per_second)
+    speech_mask = synthetic_speech_mask(num_frames, seed=seed)
+    rng = np.random.default_rng(seed)
+
+    # Write the header with scipy, then append the samples of all blocks and fix the sizes in the header
+    wavfile.write(wav_filename, samplerate, np.zeros(0, dtype=np.int16))
+    block_frames = 60 * frames_per_second
+    with open(wav_filename, 'ab') as wav_file:
+        for block_start in range(0, num_frames, block_frames):
+            block_mask = speech_mask[block_start:block_start + block_frames]
+            amplitude = np.repeat(np.where(block_mask, 3000.0, 30.0), samples_per_frame)
+            samples = rng.normal(0.0, 1.0, len(amplitude)) * amplitude
+            wav_file.write(np.clip(samples, -32768, 32767).astype('<i2').tobytes())
+    data_size = num_frames * samples_per_frame * 2
+    with open(wav_filename, 'r+b') as wav_file:
+        wav_file.seek(4)
+        wav_file.write((36 + data_size).to_bytes(4, 'little'))
+        wav_file.seek(40)
+        wav_file.write(data_size.to_bytes(4, 'little'))
+
+
+# Runs func and returns its result, the runtime in seconds and the peak memory in bytes.
+# The runtime is measured without tracemalloc, since tracing slows down python code considerably.
+# With trace_memory=False, func is only run once and the peak memory is None.
+def measure(func, *args, trace_memory=True, **kwargs):
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    runtime = time.perf_counter() - start_time
+
+    peak_memory = None
+    if trace_memory:
+        tracemalloc.start()
+        func(*args, **kwargs)
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, runtime, peak_memory
+
+
+# Compares the beam search and the dynamic programming search of segment_text on the same cut rewards.
+# Both are scored with segment_text.segmentation_score, the objective of the exact search.
+def benchmark_segmentation_search(doc_parsetree_seqs, beam_size=10, ideal_token_len=10, len_reward_factor=2.3,
+                                  max_lookahead=40, trace_memory=True):
+    results = []
+
+    best, runtime, peak_memory = measure(segment_text.beamsearch_cuts, doc_parsetree_seqs, beam_size=beam_size,
+                                         ideal_token_len=ideal_token_len, len_reward_factor=len_reward_factor,
+                                         max_lookahead=max_lookahead, trace_memory=trace_memory)
+    results.append({'stage': 'search', 'variant': 'beam', 'num_tokens': len(doc_parsetree_seqs),
+                    'beam_size': beam_size, 'max_lookahead': max_lookahead, 'runtime': runtime,
+                    'peak_memory': peak_memory,
+                    'score': segment_text.segmentation_score(doc_parsetree_seqs, best[0], ideal_token_len,
+                                                             len_reward_factor),
+                    'num_segments': len(best[0])})
+
+    best, runtime, peak_memory = measure(segment_text.dp_cuts, doc_parsetree_seqs, ideal_token_len=ideal_token_len,
+                                         len_reward_factor=len_reward_factor, max_lookahead=max_lookahead,
+                                         trace_memory=trace_memory)
+    results.append({'stage': 'search', 'variant': 'dp', 'num_tokens': len(doc_parsetree_seqs), 'beam_size': None,
+                    'max_lookahead': max_lookahead, 'runtime': runtime, 'peak_memory': peak_memory,
+                    'score': segment_text.segmentation_score(doc_parsetree_seqs, best[0], ideal_token_len,
+                                                             len_reward_factor),
+                    'num_segments': len(best[0])})
+
+    return results
+
+
+# Times segment_text.segment_beamsearch (tokenizing/parsing, cut rewards and search) on a transcript
+def benchmark_segment_beamsearch(text, segment_nlp, beam_size=10, max_lookahead=40, search='beam',
+                                 scorer='parser', trace_memory=True):
+    segments, runtime, peak_memory = measure(segment_text.segment_beamsearch, text, segment_nlp,
+                                             beam_size=beam_size, max_lookahead=max_lookahead, search=search,
+                                             scorer=scorer, trace_memory=trace_memory)
+    return {'stage': 'segmentation', 'variant': f'{search}/{scorer}', 'num_tokens': len(text.split()),
+            'beam_size': beam_size, 'max_lookahead': max_lookahead, 'runtime': runtime, 'peak_memory': peak_memory,
+            'score': None, 'num_segments': len(segments)}
+
+
+# Times the endpointing search ('beam' or 'dp') on a smoothed frame power array
+def benchmark_endpointing_search(fbank_feat_power_smoothed, beam_size=10, max_lookahead=100*180, search='beam',
+                                 trace_memory=True):
+    import simple_endpointing
+    if search == 'beam':
+        best, runtime, peak_memory = measure(simple_endpointing.beamsearch_endpoints, fbank_feat_power_smoothed,
+                                             beam_size=beam_size, max_lookahead=max_lookahead,
+                                             trace_memory=trace_memory)
+    else:
+        best, runtime, peak_memory = measure(simple_endpointing.dp_endpoints, fbank_feat_power_smoothed,
+                                             max_lookahead=max_lookahead, trace_memory=trace_memory)
+        beam_size = None
+    return {'stage': 'endpointing', 'variant': search, 'num_frames': len(fbank_feat_power_smoothed),
+            'beam_size': beam_size, 'max_lookahead': max_lookahead, 'runtime': runtime, 'peak_memory': peak_memory,
+            'score': float(best[1]), 'num_segments': len(best[0]) - 1}
+
+
+# Times simple_endpointing.process_wav (feature extraction and search) on a wav file
+def benchmark_process_wav(wav_filename, beam_size=10, max_lookahead=100*180, search='beam', trace_memory=True):
+    import simple_endpointing
+    (_, segments), runtime, peak_memory = measure(simple_endpointing.process_wav, wav_filename, beam_size=beam_size,
+                                                  max_lookahead=max_lookahead, search=search,
+                                                  trace_memory=trace_memory)
+    return {'stage': 'process_wav', 'variant': search, 'beam_size': beam_size if search == 'beam' else None,
+            'max_lookahead': max_lookahead, 'runtime': runtime, 'peak_memory': peak_memory, 'score': None,
+            'num_segments': len(segments)}
+
+
+# Times the streaming ingest (streaming_ingest.py: online endpointing in a separate process, one wav file per segment)
+# on a wav file: the time until the first segment is ready for the decoder and until the last one is.
+# The ingest runs in its own process, so its memory is not measured.
+def benchmark_streaming_ingest(wav_filename, tmp_dir, max_lookahead=100*180, search='dp'):
+    import streaming_ingest
+    start_time = time.perf_counter()
+    first_segment_time = None
+    num_segments = 0
+    ingest = streaming_ingest.start_ingest(wav_filename, os.path.join(tmp_dir, 'segment'), search=search,
+                                           max_lookahead=max_lookahead)
+    for _, _, segment_filename in streaming_ingest.ingested_segments(*ingest):
+        if first_segment_time is None:
+            first_segment_time = time.perf_counter() - start_time
+        num_segments += 1
+        os.remove(segment_filename)
+    runtime = time.perf_counter() - start_time
+    return {'stage': 'streaming', 'variant': search, 'beam_size': None, 'max_lookahead': max_lookahead,
+            'runtime': runtime, 'first_segment_time': first_segment_time, 'peak_memory': None, 'score': None,
+            'num_segments': num_segments}
+
+
+# Compares the in-process Kaldi feature pipeline with the Kaldi command line tools (extract-segments,
+# compute-mfcc-feats and ivector-extract-online2) on the segments of a wav file. Needs PyKaldi, the Kaldi tools and
+# the model of config_file. Reports the runtime of both and the largest difference of the features and i-vectors
+# (both are only equal up to the dither, if the mfcc config of the model uses dithering).
+def benchmark_kaldi_features(config_file, wav_filename, models_dir='models/'):
+    import yaml
+    import simple_endpointing
+    import kaldi_decoder
+
+    with open(config_file, 'r') as stream:
+        decoder_yaml_opts = yaml.safe_load(stream)['decoder']
+    feat_info = kaldi_decoder.feature_pipeline_info(decoder_yaml_opts, models_dir)
+
+    # The same files as in kaldi_decoder.kaldi_asr, the segments are named after the wav file in tmp/
+    name = f'benchmark_{os.getpid()}'
+    tmp_wav_filename = f'tmp/{name}.wav'
+    scp_filename = f'tmp/{name}.scp'
+    spk2utt_filename = f'tmp/{name}_spk2utt'
+    os.makedirs('tmp', exist_ok=True)
+    os.symlink(os.path.abspath(wav_filename), tmp_wav_filename)
+    try:
+        segments_filename, segments_timing = simple_endpointing.process_wav(tmp_wav_filename, search='dp')
+        with open(scp_filename, 'w') as wavscp, open(spk2utt_filename, 'w') as spk2utt:
+            wavscp.write(f'{name} {tmp_wav_filename}\n')
+            for i in range(len(segments_timing)):
+                spk2utt.write(f'{name} {name}_{i:04}\n')
+
+        results = []
+        all_features = {}
+        for variant in ['rspec', 'inprocess']:
+            start_time = time.perf_counter()
+            if variant == 'rspec':
+                segment_features = kaldi_decoder.rspec_segment_features(decoder_yaml_opts, models_dir, scp_filename,
+                                                                        spk2utt_filename, segments_filename)
+            else:
+                segment_samples = kaldi_decoder.wav_segment_samples(tmp_wav_filename, segments_timing)
+                segment_features = kaldi_decoder.inprocess_segment_features(feat_info, segment_samples)
+            all_features[variant] = [(feats.numpy().copy(), ivectors.numpy().copy())
+                                     for feats, ivectors in segment_features]
+            runtime = time.perf_counter() - start_time
+            results.append({'stage': 'kaldi_features', 'variant': variant, 'beam_size': None,
+                            'max_lookahead': 100*180, 'runtime': runtime, 'peak_memory': None, 'score': None,
+                            'num_segments': len(all_features[variant])})
+
+        max_feature_diff, max_ivector_diff = 0.0, 0.0
+        for (feats, ivectors), (feats_inprocess, ivectors_inprocess) in zip(all_features['rspec'],
+                                                                              all_features['inprocess']):
+            num_frames = min(len(feats), len(feats_inprocess))
+            max_feature_diff = max(max_feature_diff,
+                                   float(np.abs(feats[:num_frames] - feats_inprocess[:num_frames]).max()))
+            num_ivectors = min(len(ivectors), len(ivectors_inprocess))
+            max_ivector_diff = max(max_ivector_diff, float(np.abs(ivectors[:num_ivectors]
+                                                                  - ivectors_inprocess[:num_ivectors]).max()))
+        for result in results:
+            result.update(max_feature_diff=max_feature_diff, max_ivector_diff=max_ivector_diff)
+        return results
+    finally:
+        for filename in [tmp_wav_filename, scp_filename, spk2utt_filename, f'tmp/{name}_segments']:
+            if os.path.lexists(filename):
+                os.remove(filename)
+
+
+# Loads the recognizer of a yaml config (in a fresh process, see benchmark_kaldi_models) and puts the startup time,
+# the memory usage and whether the graph is memory mapped on result_queue
+def load_kaldi_recognizer(config_file, models_dir, result_queue):
+    import yaml
+    import kaldi_decoder
+    import prepared_models
+
+    start_time = time.perf_counter()
+    with open(config_file, 'r') as stream:
+        decoder_yaml_opts = yaml.safe_load(stream)['decoder']
+    fr, graph_mapped = kaldi_decoder.recognizer(decoder_yaml_opts, models_dir)
+    runtime = time.perf_counter() - start_time
+    resident, shared = prepared_models.memory_usage()
+    result_queue.put((runtime, resident, shared, graph_mapped))
+
+
+# Compares the startup time and the memory usage (RSS and the shared part of it) of loading the unprepared
+# and the prepared model of config_file (see prepared_models.py), if it is prepared. Every variant is loaded
+# by num_jobs concurrent processes, like concurrent subtitle2go jobs on one host.
+def benchmark_kaldi_models(config_file, models_dir='models/', num_jobs=2):
+    import multiprocessing
+    import prepared_models
+
+    config_files = {'unprepared': config_file}
+    if os.path.exists(prepared_models.prepared_config_filename(config_file)):
+        config_files['prepared'] = prepared_models.prepared_config_filename(config_file)
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for variant, variant_config_file in config_files.items():
+        result_queue = context.Queue()
+        processes = [context.Process(target=load_kaldi_recognizer,
+                                     args=(variant_config_file, models_dir, result_queue)) for _ in range(num_jobs)]
+        for process in processes:
+            process.start()
+        job_results = [result_queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+        results.append({'stage': 'kaldi_models', 'variant': variant, 'beam_size': None, 'max_lookahead': None,
+                        'runtime': max(runtime for runtime, _, _, _ in job_results), 'peak_memory': None,
+                        'score': None, 'num_jobs': num_jobs,
+                        'rss_mb': max(resident or 0.0 for _, resident, _, _ in job_results),
+                        'shared_mb': min(shared or 0.0 for _, _, shared, _ in job_results),
+                        'graph_mapped': all(graph_mapped for _, _, _, graph_mapped in job_results)})
+    return results
+
+
+# Compares load and parse time of the full spaCy pipeline and the parser-only pipeline used for the segmentation
+def benchmark_spacy_pipelines(model_name, text):
+    import spacy
+    results = []
+    for pipeline, exclude in [('full', []), ('parser-only', segment_text.spacy_excluded_pipes)]:
+        start_time = time.perf_counter()
+        nlp = spacy.load(model_name, exclude=exclude)
+        load_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        doc = nlp(text)
+        parse_time = time.perf_counter() - start_time
+
+        results.append({'pipeline': pipeline, 'pipes': nlp.pipe_names, 'load_time': load_time,
+                        'parse_time': parse_time, 'num_tokens': len(doc)})
+    return results
+
+
+# Information about the environment, so that results of different commits and machines can be told apart
+def benchmark_metadata(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'args': vars(args)}
+
+
+def print_spacy_results(results):
+    for result in results:
+        print(f'{result["pipeline"]:>12}: load {result["load_time"]:.2f}s, parse {result["parse_time"]:.2f}s'
+              f' ({result["num_tokens"]} tokens, {result["num_tokens"] / result["parse_time"]:.0f} tokens/s),'
+              f' pipes: {", ".join(result["pipes"])}')
+
+
+def print_results(results):
+    print(f'{"stage":>12} {"variant":>14} {"minutes":>8} {"beam":>6} {"lookahead":>9} {"runtime (s)":>12}'
+          f' {"first seg (s)":>14} {"peak mem (MB)":>14} {"score":>12} {"segments":>9}')
+    for result in results:
+        peak_memory = '-' if result['peak_memory'] is None else f'{result["peak_memory"] / 1e6:.2f}'
+        score = '-' if result['score'] is None else f'{result["score"]:.1f}'
+        first_segment_time = ('-' if result.get('first_segment_time') is None
+                              else f'{result["first_segment_time"]:.4f}')
+        print(f'{result["stage"]:>12} {result["variant"]:>14} {str(result.get("minutes", "-")):>8}'
+              f' {str(result["beam_size"]):>6} {result["max_lookahead"]:>9} {result["runtime"]:>12.4f}'
+              f' {first_segment_time:>14} {peak_memory:>14} {score:>12} {result["num_segments"]:>9}')
+
+
+def int_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+def float_list(value):
+    return [float(x) for x in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the subtitle segmentation and the endpointing'
+                                                 ' on synthetic transcripts and audio.')
+
+    parser.add_argument('-m', '--minutes', help='Lengths of the synthetic transcripts and audio in minutes'
+                                                ' (comma separated).', type=float_list, default='1,10,60')
+    parser.add_argument('--stages', help='Benchmark stages to run (comma separated): search, segmentation,'
+                                         ' endpointing, process_wav and streaming.',
+                        type=str, default='search,segmentation,endpointing,process_wav,streaming')
+    parser.add_argument('--beam-sizes', help='Beam sizes of the segmentation and endpointing search'
+                                             ' (comma separated).', type=int_list, default='5,10')
+    parser.add_argument('--segment-lookaheads', help='Maximum segment lengths of the segmentation in tokens'
+                                                     ' (comma separated).', type=int_list, default='20,40')
+    parser.add_argument('--endpoint-lookaheads', help='Maximum segment lengths of the endpointing in frames of'
+                                                      ' 0.01 seconds (comma separated).',
+                        type=int_list, default='6000,18000')
+    parser.add_argument('--max-wav-minutes', help='process_wav and streaming are only benchmarked on synthetic wav'
+                                                  ' files up to this length, since the wav files are large (about'
+                                                  ' 115 MB per hour).',
+                        type=float, default=10)
+    parser.add_argument('--segment-search', help='The segmentation search of the segmentation stage.',
+                        default='beam', choices=['beam', 'dp'])
+    parser.add_argument('--spacy-model', help='spaCy model for the segmentation stage and --text-file.'
+                                              ' Without a model, the parser-free fast scorer is used.',
+                        type=str, default=None)
+    parser.add_argument('--text-file', help='Also compare the spaCy pipelines and the segmentation searches'
+                                            ' on the text of this file (needs --spacy-model).',
+                        type=str, default=None)
+    parser.add_argument('--kaldi-model-yaml', help='Also compare the in-process Kaldi feature pipeline with the'
+                                                   ' Kaldi command line tools and the startup time and memory of'
+                                                   ' the unprepared and prepared model, with the model of this yaml'
+                                                   ' config (needs PyKaldi and Kaldi).',
+                        type=str, default=None)
+    parser.add_argument('--wav-file', help='16 kHz mono wav file for --kaldi-model-yaml, by default a synthetic'
+                                           ' wav file of the largest --minutes (up to --max-wav-minutes) is used.',
+                        type=str, default=None)
+    parser.add_argument('--seed', help='Seed of the synthetic inputs.', type=int, default=42)
+    parser.add_argument('--no-memory', help='Do not measure peak memory (every benchmark only runs once).',
+                        action='store_true', default=False)
+    parser.add_argument('-o', '--output', help='Write the results as JSON to this file.', type=str, default=None)
+
+    args = parser.parse_args()
+    if args.text_file and not args.spacy_model:
+        parser.error('--text-file needs --spacy-model')
+    stages = args.stages.split(',')
+    trace_memory = not args.no_memory
+
+    all_results = []
+
+    if args.text_file:
+        with open(args.text_file, 'r') as text_file:
+            text = text_file.read()
+        print_spacy_results(benchmark_spacy_pipelines(args.spacy_model, text))
+        doc = segment_text.load_spacy_model(args.spacy_model)(text)
+        for max_lookahead in args.segment_lookaheads:
+            for result in benchmark_segmentation_search(segment_text.doc_parsetree_scores(doc),
+                                                        beam_size=max(args.beam_sizes),
+                                                        max_lookahead=max_lookahead, trace_memory=trace_memory):
+                all_results.append(dict(result, minutes=None, input=args.text_file))
+
+    if 'segmentation' in stages:
+        scorer = 'parser' if args.spacy_model else 'fast'
+        segment_nlp = segment_text.load_spacy_model(args.spacy_model or 'de', scorer=scorer)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for minutes in args.minutes:
+            if 'search' in stages:
+                doc_parsetree_seqs = synthetic_parsetree_scores(int(minutes * words_per_minute), seed=args.seed)
+                for beam_size in args.beam_sizes:
+                    for max_lookahead in args.segment_lookaheads:
+                        for result in benchmark_segmentation_search(doc_parsetree_seqs, beam_size=beam_size,
+                                                                    max_lookahead=max_lookahead,
+                                                                    trace_memory=trace_memory):
+                            # The dp search does not depend on the beam size, only run it once
+                            if result['variant'] == 'dp' and beam_size != args.beam_sizes[0]:
+                                continue
+                            all_results.append(dict(result, minutes=minutes))
+
+            if 'segmentation' in stages:
+                text = synthetic_transcript(minutes, seed=args.seed)
+                for beam_size in args.beam_sizes:
+                    for max_lookahead in args.segment_lookaheads:
+                        result = benchmark_segment_beamsearch(text, segment_nlp, beam_size=beam_size,
+                                                              max_lookahead=max_lookahead,
+                                                              search=args.segment_search, scorer=scorer,
+                                                              trace_memory=trace_memory)
+                        all_results.append(dict(result, minutes=minutes))
+
+            if 'endpointing' in stages:
+                fbank_feat_power_smoothed = synthetic_energy(int(minutes * 60 * frames_per_second), seed=args.seed)
+                for max_lookahead in args.endpoint_lookaheads:
+                    for beam_size in args.beam_sizes:
+                        result = benchmark_endpointing_search(fbank_feat_power_smoothed, beam_size=beam_size,
+                                                              max_lookahead=max_lookahead,
+                                                              trace_memory=trace_memory)
+                        all_results.append(dict(result, minutes=minutes))
+                    result = benchmark_endpointing_search(fbank_feat_power_smoothed, max_lookahead=max_lookahead,
+                                                          search='dp', trace_memory=trace_memory)
+                    all_results.append(dict(result, minutes=minutes))
+
+            wav_filename = os.path.join(tmp_dir, 'synthetic.wav')
+            if ('process_wav' in stages or 'streaming' in stages) and minutes <= args.max_wav_minutes:
+                write_synthetic_wav(wav_filename, minutes * 60, seed=args.seed)
+
+            if 'process_wav' in stages and minutes <= args.max_wav_minutes:
+                for max_lookahead in args.endpoint_lookaheads:
+                    for beam_size in args.beam_sizes:
+                        result = benchmark_process_wav(wav_filename, beam_size=beam_size,
+                                                       max_lookahead=max_lookahead, trace_memory=trace_memory)
+                        all_results.append(dict(result, minutes=minutes))
+                    result = benchmark_process_wav(wav_filename, max_lookahead=max_lookahead, search='dp',
+                                                   trace_memory=trace_memory)
+                    all_results.append(dict(result, minutes=minutes))
+
+            if 'streaming' in stages and minutes <= args.max_wav_minutes:
+                for max_lookahead in args.endpoint_lookaheads:
+                    result = benchmark_streaming_ingest(wav_filename, tmp_dir, max_lookahead=max_lookahead)
+                    all_results.append(dict(result, minutes=minutes))
+
+        if args.kaldi_model_yaml:
+            wav_filename = args.wav_file
+            if wav_filename is None:
+                wav_filename = os.path.join(tmp_dir, 'synthetic.wav')
+                minutes = max([minutes for minutes in args.minutes if minutes <= args.max_wav_minutes],
+                              default=args.max_wav_minutes)
+                write_synthetic_wav(wav_filename, minutes * 60, seed=args.seed)
+            else:
+                minutes = None
+            for result in benchmark_kaldi_features(args.kaldi_model_yaml, wav_filename):
+                print(f'kaldi_features {result["variant"]}: {result["runtime"]:.2f}s,'
+                      f' max feature difference {result["max_feature_diff"]:.4f},'
+                      f' max i-vector difference {result["max_ivector_diff"]:.4f}')
+                all_results.append(dict(result, minutes=minutes, input=args.wav_file))
+            for result in benchmark_kaldi_models(args.kaldi_model_yaml):
+                print(f'kaldi_models {result["variant"]}: startup {result["runtime"]:.2f}s,'
+                      f' RSS {result["rss_mb"]:.0f} MB ({result["shared_mb"]:.0f} MB shared),'
+                      f' graph memory mapped: {result["graph_mapped"]} ({result["num_jobs"]} concurrent jobs)')
+                all_results.append(dict(result, minutes=None, input=args.kaldi_model_yaml))
+
+    print_results(all_results)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'metadata': benchmark_metadata(args), 'results': all_results}, output_file, indent=2)
+        print('Wrote results to', args.output)
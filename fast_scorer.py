@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    Copyright 2023 Lecture2Go, Dr. Benjamin Milde
+#
+#    Licensed under the Apache License, Version 2.0 (the 'License');
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an 'AS IS' BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# A lightweight boundary scorer for the segmentation, that doesn't need a dependency parser.
+# It only uses punctuation, sentence ends (from spaCy's rule based sentencizer) and a small token model:
+# a list of words that usually start a new clause (good to cut before them) and a list of words
+# that are usually followed by the rest of their phrase (bad to cut after them).
+
+# Reward for a cut between two words, if none of the rules below apply.
+# This is about the average shortest path length between two adjacent words in the dependency tree.
+default_cut_reward = 2.0
+
+# Reward for a cut before a word that usually starts a new clause
+cut_before_reward = 4.0
+
+# Reward for a cut after a word that is usually followed by the rest of its phrase
+no_cut_after_reward = 0.0
+
+# Punctuation within a sentence, that gets the comma reward
+comma_punctuation = {',', ';', ':'}
+
+cut_before_words = {
+    'de': {'und', 'oder', 'aber', 'sondern', 'denn', 'dass', 'weil', 'wenn', 'als', 'ob', 'obwohl', 'damit',
+           'während', 'nachdem', 'bevor', 'sodass', 'wobei', 'welche', 'welcher', 'welches', 'also', 'dann',
+           'deshalb', 'trotzdem', 'jedoch'},
+    'en': {'and', 'or', 'but', 'because', 'that', 'which', 'who', 'whom', 'whose', 'when', 'while', 'if',
+           'although', 'though', 'since', 'so', 'then', 'where', 'whether', 'unless', 'until', 'however'},
+}
+
+no_cut_after_words = {
+    'de': {'der', 'die', 'das', 'den', 'dem', 'des', 'ein', 'eine', 'einen', 'einem', 'einer', 'eines', 'in', 'im',
+           'an', 'am', 'auf', 'aus', 'bei', 'beim', 'mit', 'nach', 'von', 'vom', 'zu', 'zum', 'zur', 'für', 'über',
+           'unter', 'vor', 'durch', 'gegen', 'ohne', 'um', 'mein', 'dein', 'sein', 'ihr', 'unser', 'euer', 'kein',
+           'sehr', 'nicht'},
+    'en': {'the', 'a', 'an', 'of', 'to', 'in', 'on', 'at', 'by', 'for', 'with', 'from', 'about', 'into', 'over',
+           'under', 'my', 'your', 'his', 'her', 'its', 'our', 'their', 'this', 'these', 'those', 'very', 'not'},
+}
+
+
+# Computes the reward for a cut after every token in the doc, like segment_text.doc_parsetree_scores.
+# The doc only needs sentence boundaries (e.g. from the sentencizer), no parser or tagger.
+def fast_boundary_scores(doc, sentence_end_reward_factor=0.9, comma_end_reward_factor=0.5, debug_print=False):
+    cut_before = cut_before_words.get(doc.lang_, set())
+    no_cut_after = no_cut_after_words.get(doc.lang_, set())
+
+    doc_boundary_seqs = []
+    for sent in doc.sents:
+        row_size = len(sent)
+        boundary_seq = []
+        for i, token in enumerate(sent):
+            if i == row_size - 1:
+                # This is the score/reward for sentence end, we make it depended on the sentence length
+                boundary_seq.append(sentence_end_reward_factor * row_size)
+            elif token.text in comma_punctuation:
+                boundary_seq.append(comma_end_reward_factor * row_size)
+            elif token.lower_ in no_cut_after:
+                boundary_seq.append(no_cut_after_reward)
+            elif sent[i + 1].lower_ in cut_before:
+                boundary_seq.append(cut_before_reward)
+            else:
+                boundary_seq.append(default_cut_reward)
+
+        if debug_print:
+            print('next word reward function:', list(zip([token for token in sent], boundary_seq)))
+        doc_boundary_seqs += boundary_seq
+
+    return doc_boundary_seqs
@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    Copyright 2023 Lecture2Go, Dr. Benjamin Milde
+#
+#    Licensed under the Apache License, Version 2.0 (the 'License');
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an 'AS IS' BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Forced alignment of an existing transcript (e.g. a script or a corrected transcript) with the acoustic model of a
+# Kaldi yaml config. Instead of searching the full HCLG graph, every segment of the endpointing (process_wav) is
+# decoded with a small graph that only contains a window of the transcript: the words that are expected in the
+# segment (from the speaking rate), in order. The graph is compiled per segment from the lexicon (L_disambig.fst),
+# the tree and the transition model, like in compile-train-graphs-fsts. The graph may start a few words into
+# the window (words that the previous segment missed) and may end after any word, so the segment only takes the
+# words that it contains and the next segment continues after them.
+# The result is the same vtt datastructure (word, begin (frames), duration (frames)) as kaldi_decoder.kaldi_asr,
+# with the words of the transcript as they are written (with punctuation and casing).
+# kaldi_realign uses the same alignment for subtitles that were corrected by an editor: the edited cues are diffed
+# against the word timings of the timings sidecar and only the audio around the edits is aligned again.
+
+import os
+import re
+import time
+import difflib
+
+import yaml
+
+from kaldi.asr import NnetLatticeFasterRecognizer
+from kaldi.decoder import LatticeFasterDecoder, LatticeFasterDecoderOptions, TrainingGraphCompiler, \
+    TrainingGraphCompilerOptions
+from kaldi.fstext import SymbolTable, StdVectorFst, StdArc, TropicalWeight, read_fst_kaldi
+from kaldi.nnet3 import NnetSimpleComputationOptions
+from kaldi.tree import ContextDependency
+from kaldi.util.io import xopen
+from kaldi.transform import cmvn
+
+from kaldi_decoder import extract_audio, segment_audio, feature_pipeline_info, inprocess_segment_features, \
+    wav_segment_samples, best_path_result
+from prepared_models import read_acoustic_model
+from audio_cache import default_cache_dir, default_cache_size, load_decoded_audio
+
+from utils import *
+
+# Beams of the alignment, wider than for decoding, since the graphs are tiny
+align_beam = 20.0
+align_max_active = 10000
+align_lattice_beam = 4.0
+
+# Words of the transcript that a segment may skip at its start, and the cost of every skipped word
+max_start_skip = 5
+skip_penalty = 5.0
+
+# The window of a segment: twice the expected number of words, plus this many words
+window_slack = 20
+
+# Symbols of unknown words in the common Kaldi lexicons
+unknown_word_symbols = ['<UNK>', '<unk>', '<SPOKEN_NOISE>']
+
+# Unchanged words before and after an edit that are aligned again with the edit, they anchor it in the audio
+realign_context_words = 1
+
+# Audio around a realigned range of words, in frames of 10 ms, so that its first and last word are not cut off
+realign_margin = 25
+
+
+# The word of a token of a transcript or subtitle for the lexicon, without the punctuation around it
+def lexicon_word(token):
+    return re.sub(r'^\W+|\W+$', '', token)
+
+
+# Splits a transcript into the words of the subtitles (as they are written) and the words of the lexicon
+# (without punctuation). Closing punctuation without a word (e.g. ' .') is attached to the word before it,
+# other tokens without a word (e.g. dashes) are kept as words of their own, with an empty lexicon word.
+def transcript_words(text):
+    words, lexicon_words = [], []
+    for token in text.split():
+        token_lexicon_word = lexicon_word(token)
+        if not token_lexicon_word and words and re.fullmatch(r'[.,;:!?…)\]»“”"\']+', token):
+            words[-1] += token
+            continue
+        words.append(token)
+        lexicon_words.append(token_lexicon_word)
+    return words, lexicon_words
+
+
+# The word id of every word of the transcript (as written, lowercase, or the unknown word symbol).
+# Words that are not in the word symbols and can't be mapped to an unknown word symbol (and empty words) are None.
+def transcript_word_ids(lexicon_words, symbols):
+    unknown_id = None
+    for unknown_symbol in unknown_word_symbols:
+        if symbols.find_index(unknown_symbol) != -1:
+            unknown_id = symbols.find_index(unknown_symbol)
+            break
+
+    word_ids = []
+    for word in lexicon_words:
+        if not word:
+            word_ids.append(None)
+            continue
+        word_id = symbols.find_index(word)
+        if word_id == -1:
+            word_id = symbols.find_index(word.lower())
+        if word_id == -1:
+            word_id = unknown_id
+        word_ids.append(word_id)
+    return word_ids
+
+
+# The word graph of a window of the transcript: an acceptor of the word ids in order. It has to be an acceptor
+# (and not output e.g. the positions in the window), since the graph compiler determinizes it, which fails for
+# graphs that map the same words to different outputs (repeated words with skipped start words).
+# The graph can skip up to start_skip words at its start (skip_penalty per word). With free_end, it can end
+# after any word, otherwise only after the last word.
+def transcript_fst(word_ids, start_skip=0, free_end=False):
+    fst = StdVectorFst()
+    start = fst.add_state()
+    fst.set_start(start)
+    # Every word has a state before and a state after it, so that a path always contains at least one word
+    before = [fst.add_state() for _ in word_ids]
+    after = [fst.add_state() for _ in word_ids]
+    for skip in range(min(start_skip, len(word_ids) - 1) + 1):
+        fst.add_arc(start, StdArc(0, 0, TropicalWeight(skip * skip_penalty), before[skip]))
+    for i, word_id in enumerate(word_ids):
+        fst.add_arc(before[i], StdArc(word_id, word_id, TropicalWeight.one(), after[i]))
+        if i + 1 < len(word_ids):
+            fst.add_arc(after[i], StdArc(0, 0, TropicalWeight.one(), before[i + 1]))
+        if free_end or i + 1 == len(word_ids):
+            fst.set_final(after[i], TropicalWeight.one())
+    return fst
+
+
+# Reads the integer list of a Kaldi .int file (e.g. phones/disambig.int)
+def read_int_list(filename):
+    with open(filename, 'r') as int_file:
+        return [int(line.split()[0]) for line in int_file if line.strip()]
+
+
+# Loads everything the alignment needs from a Kaldi yaml config: the acoustic model, the graph compiler (the tree,
+# the lexicon with disambiguation symbols and the transition model), the word symbols, the global cmvn (if set)
+# and the feature pipeline. The tree, the lexicon and the disambiguation symbols are the 'tree', 'lexicon-fst'
+# and 'disambig-symbols' options of the yaml config, by default tree, L_disambig.fst and phones/disambig.int
+# next to the model.
+def load_aligner(config_file, status=None, models_dir='models/'):
+    with open(config_file, 'r') as stream:
+        decoder_yaml_opts = yaml.safe_load(stream)['decoder']
+    model_dir = os.path.dirname(decoder_yaml_opts['model'])
+    tree_filename = models_dir + decoder_yaml_opts.get('tree', os.path.join(model_dir, 'tree'))
+    lexicon_filename = models_dir + decoder_yaml_opts.get('lexicon-fst', os.path.join(model_dir, 'L_disambig.fst'))
+    disambig_filename = models_dir + decoder_yaml_opts.get('disambig-symbols',
+                                                           os.path.join(model_dir, 'phones/disambig.int'))
+    for filename in [tree_filename, lexicon_filename, disambig_filename]:
+        if not os.path.exists(filename):
+            raise FileNotFoundError(f'The forced alignment needs {filename}, set "tree", "lexicon-fst" and'
+                                    f' "disambig-symbols" in the decoder options of {config_file}.')
+
+    if status:
+        status.publish_status('Loading the acoustic model and the lexicon for the alignment.')
+
+    transition_model, acoustic_model = read_acoustic_model(models_dir + decoder_yaml_opts['model'])
+    with xopen(tree_filename) as tree_file:
+        tree = ContextDependency()
+        tree.read(tree_file.stream(), tree_file.binary)
+
+    # Chain models are aligned without transition and self-loop scales, like in align_lats.sh of the chain recipes
+    compiler_opts = TrainingGraphCompilerOptions()
+    compiler_opts.transition_scale = 1.0
+    compiler_opts.self_loop_scale = 1.0
+    compiler = TrainingGraphCompiler(transition_model, tree, read_fst_kaldi(lexicon_filename),
+                                     read_int_list(disambig_filename), compiler_opts)
+
+    decoder_opts = LatticeFasterDecoderOptions()
+    decoder_opts.beam = align_beam
+    decoder_opts.max_active = align_max_active
+    decoder_opts.lattice_beam = align_lattice_beam
+
+    decodable_opts = NnetSimpleComputationOptions()
+    decodable_opts.acoustic_scale = decoder_yaml_opts['acoustic-scale']
+    decodable_opts.frame_subsampling_factor = 3
+    decodable_opts.frames_per_chunk = 150
+
+    cmvn_transformer = None
+    if decoder_yaml_opts.get('global-cmvn-stats'):
+        cmvn_transformer = cmvn.Cmvn(40)
+        cmvn_transformer.read_stats(f'{models_dir}{decoder_yaml_opts["global-cmvn-stats"]}')
+
+    return {'transition_model': transition_model, 'acoustic_model': acoustic_model, 'tree': tree,
+            'compiler': compiler, 'decoder_opts': decoder_opts, 'decodable_opts': decodable_opts,
+            'symbols': SymbolTable.read_text(models_dir + decoder_yaml_opts['word-syms']),
+            'cmvn': cmvn_transformer, 'feat_info': feature_pipeline_info(decoder_yaml_opts, models_dir),
+            'recognizer': None}
+
+
+# The positions in word_ids of the aligned words of a window graph (see transcript_fst): the aligned words are
+# the words of the window in order, after at most start_skip skipped words. The fewest skipped words win, like in
+# the graph (skip_penalty). Returns None if the aligned words are not a path of the graph.
+def window_positions(word_ids, aligned_ids, start_skip=0):
+    for skip in range(min(start_skip, len(word_ids) - 1) + 1):
+        if word_ids[skip:skip + len(aligned_ids)] == aligned_ids:
+            return list(range(skip, skip + len(aligned_ids)))
+    return None
+
+
+# Aligns the words of word_ids to the features and i-vectors of one segment, with the graph of transcript_fst.
+# Returns the positions in word_ids (from 0) and the start frames and durations of the aligned words,
+# or None if the words can't be aligned to the segment.
+def align_segment(aligner, feats, ivectors, word_ids, start_skip=0, free_end=False):
+    if aligner['cmvn']:
+        aligner['cmvn'].apply(feats)
+    try:
+        graph = aligner['compiler'].compile_graph(transcript_fst(word_ids, start_skip=start_skip,
+                                                                 free_end=free_end))
+        decoder = LatticeFasterDecoder(graph, aligner['decoder_opts'])
+        # One recognizer for all segments, only its decoder (with the graph of the segment) is replaced, so that
+        # the compiled nnet computations are reused
+        if aligner['recognizer'] is None:
+            aligner['recognizer'] = NnetLatticeFasterRecognizer(aligner['transition_model'],
+                                                                aligner['acoustic_model'], decoder,
+                                                                decodable_opts=aligner['decodable_opts'])
+        else:
+            aligner['recognizer'].decoder = decoder
+        aligner['graph'] = graph
+
+        out = aligner['recognizer'].decode((feats, ivectors))
+        _, (labels, starts, durations) = best_path_result(aligner, out['lattice'])
+    except RuntimeError:
+        return None
+    # Silence has no word in the word alignment
+    aligned = [(label, start, duration) for label, start, duration in zip(labels, starts, durations) if label != 0]
+    if not aligned:
+        return None
+    aligned_ids, starts, durations = [list(values) for values in zip(*aligned)]
+    positions = window_positions(word_ids, aligned_ids, start_skip=start_skip)
+    if positions is None:
+        return None
+    return positions, starts, durations
+
+
+# Gives the words of the transcript that are not aligned (unknown words, or words that no segment took) the time
+# between the aligned words around them, evenly divided. word_timings: (start, duration) or None for every word.
+def interpolate_timings(word_timings, end_frame):
+    timings = list(word_timings)
+    i = 0
+    while i < len(timings):
+        if timings[i] is not None:
+            i += 1
+            continue
+        j = i
+        while j < len(timings) and timings[j] is None:
+            j += 1
+        gap_start = timings[i - 1][0] + timings[i - 1][1] if i > 0 else 0.0
+        gap_end = timings[j][0] if j < len(timings) else max(end_frame, gap_start)
+        step = max(gap_end - gap_start, 0.0) / (j - i)
+        for k in range(i, j):
+            timings[k] = (gap_start + (k - i) * step, step)
+        i = j
+    return timings
+
+
+# Aligns the words of a transcript to the segments (start, end in frames) and their features, segment by segment.
+# Returns the (start, duration) of every word in Kaldi frames (see kaldi_feature_factor) and the number of words
+# that could not be aligned (their timings are interpolated).
+def align_transcript(aligner, word_ids, segment_features, segments_timing, status=None):
+    # Only words in the lexicon are aligned, positions are indices into word_ids
+    alignable = [i for i, word_id in enumerate(word_ids) if word_id is not None]
+    speech_seconds = sum(end - start for start, end in segments_timing) / 100.
+    words_per_second = len(alignable) / max(speech_seconds, 0.01)
+
+    word_timings = [None] * len(word_ids)
+    position = 0
+    for segment_idx, ((feats, ivectors), (start, end)) in enumerate(zip(segment_features, segments_timing)):
+        if position >= len(alignable):
+            break
+        expected_words = (end - start) / 100. * words_per_second
+        window = alignable[position:position + int(2 * expected_words) + window_slack]
+        result = align_segment(aligner, feats, ivectors, [word_ids[i] for i in window],
+                               start_skip=max_start_skip, free_end=True)
+        if result is not None:
+            positions, starts, durations = result
+            for window_position, word_start, duration in zip(positions, starts, durations):
+                word_timings[window[window_position]] = (word_start + start / kaldi_feature_factor, duration)
+            position += max(positions) + 1
+        if status:
+            status.publish_status(f'Alignment progress: {100. * (segment_idx + 1) / len(segments_timing):.2f}%,'
+                                  f' {position} of {len(alignable)} words aligned.')
+
+    num_unaligned = sum(timing is None for timing in word_timings)
+    end_frame = segments_timing[-1][1] / kaldi_feature_factor if segments_timing else 0.0
+    return interpolate_timings(word_timings, end_frame), num_unaligned
+
+
+# Forced alignment job: extracts and segments the audio of the media file like kaldi_decoder.kaldi_asr, and aligns
+# the text of transcript_filename to it. Returns the vtt datastructure (word, begin (frames), duration (frames))
+# and the words of the transcript.
+def kaldi_align(filenameS_hash, filename, transcript_filename,
+                config_file='models/kaldi_tuda_de_nnet3_chain2_de_900k.yaml', status=None, endpoint_search='beam',
+                audio_cache_dir=default_cache_dir, audio_cache_size=default_cache_size):
+    start_time = time.time()
+    wav_filename = f'tmp/{filenameS_hash}.wav'
+    segments_filename = f'tmp/{filenameS_hash}_segments'
+
+    with open(transcript_filename, 'r') as transcript_file:
+        words, lexicon_words = transcript_words(transcript_file.read())
+
+    extract_audio(filename, wav_filename, audio_cache_dir=audio_cache_dir, audio_cache_size=audio_cache_size,
+                  status=status)
+    segments_timing = segment_audio(wav_filename, endpoint_search=endpoint_search, status=status)
+
+    aligner = load_aligner(config_file, status=status)
+    word_ids = transcript_word_ids(lexicon_words, aligner['symbols'])
+
+    if status:
+        status.publish_status('Start alignment.')
+    segment_features = inprocess_segment_features(aligner['feat_info'],
+                                                  wav_segment_samples(wav_filename, segments_timing))
+    word_timings, num_unaligned = align_transcript(aligner, word_ids, segment_features, segments_timing,
+                                                   status=status)
+    vtt = [[word, word_start, duration] for word, (word_start, duration) in zip(words, word_timings)]
+
+    for tmp_filename in [wav_filename, segments_filename]:
+        if os.path.lexists(tmp_filename):
+            os.remove(tmp_filename)
+
+    if status:
+        status.publish_status(f'Alignment finished after {time.time() - start_time:.1f} seconds,'
+                              f' {len(words) - num_unaligned} of {len(words)} words aligned'
+                              f' ({num_unaligned} interpolated).')
+    return vtt, words
+
+
+# Diffs the words of the edited cues (see utils.read_subtitle) against the words of a vtt datastructure, e.g. of
+# the timings sidecar. Words that are unchanged up to punctuation and casing keep their timings, with their edited
+# spelling. Returns the words of the cues, their lexicon words, their timings ((start, duration) in Kaldi frames,
+# None for new words), the cue of every word and the ranges (start, end) of the words that have to be aligned
+# again: every edit with realign_context_words unchanged words around it, overlapping ranges are merged.
+def diff_edited_words(vtt, cues):
+    words, lexicon_words, word_cues = [], [], []
+    for cue_idx, (text, _, _) in enumerate(cues):
+        cue_words, cue_lexicon_words = transcript_words(text)
+        words += cue_words
+        lexicon_words += cue_lexicon_words
+        word_cues += [cue_idx] * len(cue_words)
+
+    old_words = [element for element in vtt if element[0]]
+    old_keys = [lexicon_word(element[0]).lower() for element in old_words]
+    new_keys = [word.lower() for word in lexicon_words]
+
+    timings = [None] * len(words)
+    word_ranges = []
+    matcher = difflib.SequenceMatcher(None, old_keys, new_keys, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            for i, j in zip(range(i1, i2), range(j1, j2)):
+                timings[j] = (old_words[i][1], old_words[i][2])
+            continue
+        start, end = max(j1 - realign_context_words, 0), min(j2 + realign_context_words, len(words))
+        if start >= end:
+            continue
+        if word_ranges and start <= word_ranges[-1][1]:
+            word_ranges[-1] = (word_ranges[-1][0], max(end, word_ranges[-1][1]))
+        else:
+            word_ranges.append((start, end))
+    return words, lexicon_words, timings, word_cues, word_ranges
+
+
+# The audio region (start, end in frames of 10 ms) of a range of words: from the start of the last timed word at or
+# before the range start to the end of the first timed word at or after the range end (the start or the end of
+# the audio if there is none), with realign_margin around it
+def realign_region(timings, start, end, num_frames):
+    region_start, region_end = 0, num_frames
+    before = [timing for timing in timings[:start + 1] if timing is not None]
+    if before:
+        region_start = max(int(before[-1][0] * kaldi_feature_factor) - realign_margin, 0)
+    after = [timing for timing in timings[end - 1:] if timing is not None]
+    if after:
+        region_end = min(int((after[0][0] + after[0][1]) * kaldi_feature_factor) + realign_margin + 1, num_frames)
+    return region_start, max(region_end, region_start + 1)
+
+
+# Aligns the word ranges of diff_edited_words again, every range to its own audio region with all of its words
+# (no skipped words, no free end). Words that can't be aligned get interpolated timings.
+# Returns the timings of all words and the number of realigned words.
+def realign_word_ranges(aligner, wav_filename, word_ids, timings, word_ranges, status=None):
+    samplerate, data = load_decoded_audio(wav_filename)
+    num_frames = len(data) // (samplerate // 100)
+    del data
+
+    timings = list(timings)
+    regions = [realign_region(timings, start, end, num_frames) for start, end in word_ranges]
+    segment_features = inprocess_segment_features(aligner['feat_info'], wav_segment_samples(wav_filename, regions))
+
+    num_realigned = 0
+    for (start, end), (region_start, _), (feats, ivectors) in zip(word_ranges, regions, segment_features):
+        alignable = [i for i in range(start, end) if word_ids[i] is not None]
+        result = None
+        if alignable:
+            result = align_segment(aligner, feats, ivectors, [word_ids[i] for i in alignable])
+        if result is None:
+            # The unchanged words keep their timings, the new words are interpolated
+            continue
+        for i in range(start, end):
+            timings[i] = None
+        for position, word_start, duration in zip(*result):
+            timings[alignable[position]] = (word_start + region_start / kaldi_feature_factor, duration)
+            num_realigned += 1
+
+    if status:
+        status.publish_status(f'Realigned {num_realigned} words in {len(word_ranges)} regions.')
+    return interpolate_timings(timings, num_frames / kaldi_feature_factor), num_realigned
+
+
+# Realignment job for a subtitle that was corrected by an editor: diffs the cues of subtitle_filename against the
+# vtt datastructure of the timings sidecar and aligns only the audio around the edited words again (see
+# diff_edited_words), with the acoustic model of the Kaldi yaml config. The cues keep their text as edited, the
+# cues with realigned words get the times of their words, all other cues keep their times as they are.
+# Returns the new vtt datastructure and the cues as sequences (text, start, end) in seconds, with subtitle_offset.
+def kaldi_realign(filenameS_hash, filename, vtt, subtitle_filename,
+                  config_file='models/kaldi_tuda_de_nnet3_chain2_de_900k.yaml', status=None, subtitle_offset=0.0,
+                  audio_cache_dir=default_cache_dir, audio_cache_size=default_cache_size):
+    start_time = time.time()
+    wav_filename = f'tmp/{filenameS_hash}.wav'
+
+    cues = read_subtitle(subtitle_filename)
+    words, lexicon_words, timings, word_cues, word_ranges = diff_edited_words(vtt, cues)
+    if status:
+        status.publish_status(f'{len(word_ranges)} edited regions in {len(cues)} cues.')
+
+    if word_ranges:
+        extract_audio(filename, wav_filename, audio_cache_dir=audio_cache_dir, audio_cache_size=audio_cache_size,
+                      status=status)
+        aligner = load_aligner(config_file, status=status)
+        word_ids = transcript_word_ids(lexicon_words, aligner['symbols'])
+        timings, _ = realign_word_ranges(aligner, wav_filename, word_ids, timings, word_ranges, status=status)
+        if os.path.lexists(wav_filename):
+            os.remove(wav_filename)
+
+    changed_cues = {word_cues[i] for start, end in word_ranges for i in range(start, end)}
+    cue_words = [[] for _ in cues]
+    for i, cue_idx in enumerate(word_cues):
+        cue_words[cue_idx].append(i)
+
+    sequences = []
+    for cue_idx, (text, cue_start, cue_end) in enumerate(cues):
+        if not cue_words[cue_idx]:
+            continue
+        if cue_idx in changed_cues:
+            first, last = timings[cue_words[cue_idx][0]], timings[cue_words[cue_idx][-1]]
+            cue_start = first[0] * kaldi_feature_factor / 100. + subtitle_offset
+            cue_end = (last[0] + last[1]) * kaldi_feature_factor / 100. + subtitle_offset
+        sequences.append([text, cue_start, cue_end])
+
+    if status:
+        status.publish_status(f'Realignment finished after {time.time() - start_time:.1f} seconds,'
+                              f' {len(changed_cues)} of {len(cues)} cues retimed.')
+    return [[word, word_start, duration] for word, (word_start, duration) in zip(words, timings)], sequences
@@ -17,29 +17,49 @@
 #    limitations under the License.
 
 import sys
+import time
 import yaml
+import tempfile
 import traceback
-
+import collections
+import multiprocessing
+import numpy as np
+from scipy.io import wavfile
 
 
 # Load Kaldi
-from kaldi.asr import NnetLatticeFasterRecognizer, LatticeRnnlmPrunedRescorer
+from kaldi.asr import NnetLatticeFasterRecognizer, MappedLatticeFasterRecognizer, LatticeRnnlmPrunedRescorer
 from kaldi.rnnlm import RnnlmComputeStateComputationOptions
 from kaldi.decoder import LatticeFasterDecoderOptions
 from kaldi.lat.functions import ComposeLatticePrunedOptions
-from kaldi.fstext import SymbolTable, shortestpath, indices_to_symbols
+from kaldi.fstext import SymbolTable, CompactLatticeVectorFst, shortestpath, indices_to_symbols
 from kaldi.fstext.utils import get_linear_symbol_sequence
 from kaldi.nnet3 import NnetSimpleComputationOptions
+try:
+    from kaldi.nnet3 import NnetBatchComputerOptions, NnetBatchInference
+except ImportError:
+    # Older PyKaldi builds don't wrap nnet-batch-compute.h, batched decoding is not available then
+    NnetBatchComputerOptions = None
+    NnetBatchInference = None
 from kaldi.util.table import SequentialMatrixReader
+from kaldi.online2 import OnlineNnetFeaturePipelineConfig, OnlineNnetFeaturePipelineInfo, \
+    OnlineNnetFeaturePipeline, OnlineIvectorExtractorAdaptationState
+from kaldi.matrix import Matrix, Vector
 from kaldi.lat import functions
 from kaldi.transform import cmvn
 
 #from subtitle2go import status, kaldi_time_to_seconds, debug_word_timing, preprocess_audio, send_error, args
 from simple_endpointing import process_wav
+from audio_cache import link_decoded_audio, load_decoded_audio, default_cache_dir, default_cache_size
+from silence_trimming import silence_trimming, write_trimmed_wav, map_times, default_threshold_db
+from streaming_ingest import start_ingest, ingested_segments
+from prepared_models import prepared_config_filename, prepared_recognizer, memory_usage
 
 from utils import *
 
 
+# Loads the recognizer of a yaml config, from the prepared model files if the config is prepared
+# (see prepared_models.py). Returns the recognizer and True if the graph is memory mapped.
 def recognizer(decoder_yaml_opts, models_dir):
     decoder_opts = LatticeFasterDecoderOptions()
     decoder_opts.beam = decoder_yaml_opts['beam']
@@ -50,19 +70,41 @@ def recognizer(decoder_yaml_opts, models_dir):
     decodable_opts.acoustic_scale = decoder_yaml_opts['acoustic-scale']
     decodable_opts.frame_subsampling_factor = 3 # decoder_yaml_opts['frame-subsampling-factor'] # 3
     decodable_opts.frames_per_chunk = 150
+
+    if decoder_yaml_opts.get('prepared'):
+        return prepared_recognizer(decoder_yaml_opts, models_dir, decoder_opts, decodable_opts)
+
     fr = NnetLatticeFasterRecognizer.from_files(
         models_dir + decoder_yaml_opts['model'],
         models_dir + decoder_yaml_opts['fst'],
         models_dir + decoder_yaml_opts['word-syms'],
         decoder_opts=decoder_opts, decodable_opts=decodable_opts)
 
-    return fr
-
-# This method contains all Kaldi related calls and methods
-def Kaldi(config_file, scp_filename, spk2utt_filename, segments_filename, do_rnn_rescore,
-          segments_timing, lm_scale, acoustic_scale, status, debug_word_timing=False):
-
-    models_dir = 'models/'
+    return fr, False
+
+# The recognizer of batched decoding: it searches the lattice of precomputed log-likelihoods (see
+# batch_segment_loglikes) and shares the transition model and the HCLG graph of fr, so nothing is loaded twice.
+# The log-likelihoods are not scaled, the recognizer applies the acoustic scale like the decodable of fr.
+def batch_recognizer(decoder_yaml_opts, fr, batch_size):
+    batch_opts = NnetBatchComputerOptions()
+    batch_opts.acoustic_scale = 1.0
+    batch_opts.frame_subsampling_factor = 3
+    batch_opts.frames_per_chunk = 150
+    batch_opts.minibatch_size = batch_size
+    mapped_fr = MappedLatticeFasterRecognizer(fr.transition_model, fr.decoder, fr.symbols,
+                                              acoustic_scale=decoder_yaml_opts['acoustic-scale'])
+    return mapped_fr, batch_opts
+
+# Loads the recognizer, the symbol table, the global cmvn (if set) and the RNNLM rescorer (if enabled).
+# With batch_size > 0, also the recognizer of batched decoding (see batch_recognizer). Only segments with a lattice
+# depth of at least rescore_min_depth are rescored (see first_pass_result).
+# The prepared model of config_file is used instead, if there is one (see prepared_models.py).
+def load_models(config_file, do_rnn_rescore, lm_scale, acoustic_scale, status, models_dir='models/',
+                batch_size=0, rescore_min_depth=0.0):
+    start_time = time.time()
+
+    if os.path.exists(prepared_config_filename(config_file)):
+        config_file = prepared_config_filename(config_file)
 
     # Read yaml File
     with open(config_file, 'r') as stream:
@@ -70,7 +112,7 @@ def Kaldi(config_file, scp_filename, spk2utt_filename, segments_filename, do_rnn
     decoder_yaml_opts = model_yaml['decoder']
 
     # Construct recognizer
-    fr = recognizer(decoder_yaml_opts, models_dir)
+    fr, graph_mapped = recognizer(decoder_yaml_opts, models_dir)
 
     # Check if cmvn is set
     cmvn_transformer = None
@@ -78,20 +120,8 @@ def Kaldi(config_file, scp_filename, spk2utt_filename, segments_filename, do_rnn
         cmvn_transformer = cmvn.Cmvn(40)
         cmvn_transformer.read_stats(f'{models_dir}{decoder_yaml_opts["global-cmvn-stats"]}')
 
-    # Construct symbol table
-    symbols = SymbolTable.read_text(models_dir + decoder_yaml_opts['word-syms'])
-
-    # Define feature pipelines as Kaldi rspecifiers
-    feats_rspec = (f'ark:extract-segments scp,p:{scp_filename} {segments_filename} '
-                   f'ark:- | compute-mfcc-feats --config={models_dir}{decoder_yaml_opts["mfcc-config"]} ark:- ark:- |')
-
-    ivectors_rspec = (
-            (f'ark:extract-segments scp,p:{scp_filename} {segments_filename} '
-             f'ark:- | compute-mfcc-feats --config={models_dir}{decoder_yaml_opts["mfcc-config"]} '
-             f'ark:- ark:- | '
-             f'ivector-extract-online2 --config={models_dir}{decoder_yaml_opts["ivector-extraction-config"]} '
-             f'ark:{spk2utt_filename} ark:- ark:- |'))
-
+    # The symbol table of the recognizer, the words are only read once
+    symbols = fr.symbols
 
     rnn_rescore_available = 'rnnlm' in decoder_yaml_opts
 
@@ -100,6 +130,7 @@ def Kaldi(config_file, scp_filename, spk2utt_filename, segments_filename, do_rnn
             status.publish_status("Warning, disabling RNNLM rescoring since 'rnnlm'"
                               " is not in the decoder options of the .yaml config.")
 
+    rescorer = None
     if do_rnn_rescore and rnn_rescore_available:
         status.publish_status('Loading language model rescorer.')
         rnn_lm_folder = models_dir + decoder_yaml_opts['rnnlm']
@@ -123,34 +154,348 @@ def Kaldi(config_file, scp_filename, spk2utt_filename, segments_filename, do_rnn
             f'{rnn_lm_folder}/final.raw', lm_scale=lm_scale, acoustic_scale=acoustic_scale, max_ngram_order=4,
             use_const_arpa=True, opts=rnnlm_opts, compose_opts=compose_opts)
 
-    did_decode = False
-    decoding_results = []
+    mapped_fr, batch_opts = None, None
+    if batch_size > 0:
+        if NnetBatchInference is None:
+            if status:
+                status.publish_status('Warning, disabling batched decoding since this PyKaldi build'
+                                      ' has no NnetBatchInference.')
+        else:
+            mapped_fr, batch_opts = batch_recognizer(decoder_yaml_opts, fr, batch_size)
+
+    model_format = 'prepared' if decoder_yaml_opts.get('prepared') else 'unprepared'
+    if graph_mapped:
+        model_format += ', graph memory mapped'
+    message = f'Loaded Kaldi models ({model_format}) in {time.time() - start_time:.1f} seconds'
+    resident, shared = memory_usage()
+    if resident is not None:
+        message += f', RSS {resident:.0f} MB ({shared:.0f} MB shared)'
+    print(message)
+    if status:
+        status.publish_status(message + '.')
+
+    return {'decoder_opts': decoder_yaml_opts, 'models_dir': models_dir, 'recognizer': fr, 'symbols': symbols,
+            'cmvn': cmvn_transformer, 'rescorer': rescorer,
+            'feat_info': feature_pipeline_info(decoder_yaml_opts, models_dir),
+            'batch_recognizer': mapped_fr, 'batch_opts': batch_opts, 'rescore_min_depth': rescore_min_depth}
+
+# The word ids and the word alignment (word ids, start frames, durations) of the best path of a lattice
+def best_path_result(models, lat):
+    best_path = functions.compact_lattice_shortest_path(lat)
+    words, _, _ = get_linear_symbol_sequence(shortestpath(best_path))
+    timing = functions.compact_lattice_to_word_alignment(best_path)
+    return words, timing
+
+# The result of the first pass of one segment: ('best_path', (words, timing)) if there is no RNNLM rescoring or
+# the lattice is confident, otherwise ('rescore', lattice filename) for the rescoring workers (see rescored_results).
+# The confidence is the lattice depth (the average number of lattice arcs that cover a frame, as in lattice-depth):
+# lattices with a depth below rescore_min_depth have (almost) no competing hypotheses, which rescoring could prefer.
+def first_pass_result(models, lat):
+    if not models['rescorer']:
+        return 'best_path', best_path_result(models, lat)
+    depth, _ = functions.compact_lattice_depth(lat)
+    if depth < models['rescore_min_depth']:
+        return 'best_path', best_path_result(models, lat)
+    tmp_fd, lattice_filename = tempfile.mkstemp(suffix='.lat', dir='tmp')
+    os.close(tmp_fd)
+    lat.write(lattice_filename)
+    return 'rescore', lattice_filename
+
+# Sets the beam, max-active and lattice beam of a decoder, for the next segment it decodes
+def set_decoder_beams(decoder, beams):
+    decoder_opts = LatticeFasterDecoderOptions()
+    decoder_opts.beam, decoder_opts.max_active, decoder_opts.lattice_beam = beams
+    decoder.set_options(decoder_opts)
+
+# Decodes the features and i-vectors of one segment. Returns the first pass result (see first_pass_result).
+# beams: (beam, max-active, lattice beam) for this segment, the beams of the yaml config if None.
+def decode_segment(models, feats, ivectors, beams=None):
+    if models['cmvn']:
+        models['cmvn'].apply(feats)
+    if beams:
+        set_decoder_beams(models['recognizer'].decoder, beams)
+    out = models['recognizer'].decode((feats, ivectors))
+    return first_pass_result(models, out['lattice'])
+
+# Searches the lattice of one segment from its precomputed acoustic log-likelihoods (batched decoding).
+# Returns the same as decode_segment.
+def search_segment(models, loglikes, beams=None):
+    if beams:
+        set_decoder_beams(models['batch_recognizer'].decoder, beams)
+    out = models['batch_recognizer'].decode(loglikes)
+    return first_pass_result(models, out['lattice'])
+
+# Computes the acoustic log-likelihoods of the segments with Kaldi's NnetBatchInference (as in
+# nnet3-compute-batch): the segments are split into chunks of frames_per_chunk frames, and the chunks of several
+# segments are computed together in minibatches of batch_size chunks, so that the nnet3 computation runs on
+# larger matrices. The segments are handed over as soon as their features are ready, the nnet runs in a
+# background thread of Kaldi. Yields the log-likelihoods of every segment in segment order.
+def batch_segment_loglikes(models, segment_features):
+    acoustic_model = models['recognizer'].acoustic_model
+    inference = NnetBatchInference(models['batch_opts'], acoustic_model.get_nnet(), acoustic_model.priors())
+    ivector_period = models['feat_info'].ivector_extractor_info.ivector_period
+
+    for idx, (feats, ivectors) in enumerate(segment_features):
+        if models['cmvn']:
+            models['cmvn'].apply(feats)
+        inference.accept_input(f'{idx:04}', feats, None, ivectors, ivector_period)
+        # Segments whose computation is already finished
+        while True:
+            ready, _, loglikes = inference.get_output()
+            if not ready:
+                break
+            yield loglikes
+
+    # Blocks until the remaining segments are computed
+    inference.finished()
+    while True:
+        ready, _, loglikes = inference.get_output()
+        if not ready:
+            break
+        yield loglikes
+
+# The models of the decoding workers, set before the workers are forked (see decode_segments)
+worker_models = None
+
+# Decodes one segment in a worker process, the inputs (features and i-vectors, or log-likelihoods)
+# are numpy arrays. Returns the first pass result and the decoding time of the segment.
+def decode_segment_worker(task):
+    start_time = time.time()
+    decode_function, inputs, beams = task
+    result = decode_function(worker_models, *[Matrix(matrix) for matrix in inputs], beams=beams)
+    return result, time.time() - start_time
+
+# Rescores the lattice of one segment with the RNNLM in a rescoring worker process.
+# Returns the word ids and the word alignment of the best path and the rescoring time.
+def rescore_segment_worker(lattice_filename):
+    start_time = time.time()
+    lat = CompactLatticeVectorFst.read(lattice_filename)
+    os.remove(lattice_filename)
+    result = best_path_result(worker_models, worker_models['rescorer'].rescore(lat))
+    return result, time.time() - start_time
+
+# Yields the results of the first pass in segment order, the uncertain segments (see first_pass_result)
+# are rescored by a separate pool of rescore_procs worker processes. The rescoring overlaps with the first pass of
+# the next segments, the results of confident segments are passed on as soon as all segments before them are done.
+# The number of rescored and skipped segments and the rescoring time are counted in rescore_stats.
+def rescored_results(models, first_pass_results, rescore_procs=1, rescore_stats=None):
+    global worker_models
+
+    if rescore_stats is None:
+        rescore_stats = {}
+    rescore_stats.update(rescored=0, skipped=0, rescore_time=0.0)
+
+    if not models['rescorer']:
+        for _, result in first_pass_results:
+            yield result
+        return
+
+    worker_models = models
+    context = multiprocessing.get_context('fork')
+    with context.Pool(max(rescore_procs, 1)) as pool:
+        # The first pass results and the pending rescorings, in segment order
+        pending = collections.deque()
+
+        def pending_result(block):
+            kind, result = pending[0]
+            if kind == 'best_path':
+                rescore_stats['skipped'] += 1
+                return result
+            if not block and not result.ready():
+                return None
+            result, rescore_time = result.get()
+            rescore_stats['rescored'] += 1
+            rescore_stats['rescore_time'] += rescore_time
+            return result
+
+        for kind, result in first_pass_results:
+            if kind == 'rescore':
+                result = pool.apply_async(rescore_segment_worker, (result,))
+            pending.append((kind, result))
+            while pending:
+                result = pending_result(block=False)
+                if result is None:
+                    break
+                pending.popleft()
+                yield result
+
+        while pending:
+            result = pending_result(block=True)
+            pending.popleft()
+            yield result
+
+# Publishes how many segments were rescored with the RNNLM and the rescoring time that the skipped segments saved
+# (estimated from the average rescoring time of a segment)
+def publish_rescore_stats(rescore_stats, status):
+    rescored, skipped = rescore_stats['rescored'], rescore_stats['skipped']
+    if rescored + skipped == 0:
+        return
+    saved_time = skipped * rescore_stats['rescore_time'] / max(rescored, 1)
+    message = (f'RNNLM rescoring: rescored {rescored} of {rescored + skipped} segments'
+               f' in {rescore_stats["rescore_time"]:.1f} seconds, skipped {skipped} confident segments'
+               f' (saved about {saved_time:.1f} seconds).')
+    print(message)
+    if status:
+        status.publish_status(message)
+
+# Runs the first pass of the segments of segment_features and yields the results (see first_pass_result) in
+# segment order. With num_procs > 1, the segments are decoded by a pool of worker processes that are forked after
+# the models are loaded, so they share the recognizer, the HCLG graph and the symbol tables (copy-on-write) instead
+# of loading them again. The features are still computed here in segment order (the i-vector adaptation carries over from segment
+# to segment), so the output is exactly the same as with one process.
+# With batched decoding (see load_models), the acoustic model is computed here for several segments together
+# (see batch_segment_loglikes), and only the lattice search runs per segment (in the workers with num_procs > 1).
+# With a beam_controller (see adaptive_beam), every segment is decoded with the beams of the controller, and the
+# controller gets the first pass time of every segment (including its features, but not the rescoring). With
+# num_procs > 1, only num_procs + 1 segments are decoded at a time then, so that the beams of a segment are chosen
+# with the times of all segments before it, except the ones that are still being decoded.
+def first_pass_results(models, segment_features, num_procs=1, beam_controller=None):
+    global worker_models
+
+    if models.get('batch_recognizer'):
+        segment_inputs = ((loglikes,) for loglikes in batch_segment_loglikes(models, segment_features))
+        decode_function = search_segment
+        # The log-likelihoods are subsampled (frame_subsampling_factor)
+        frames_per_row = kaldi_feature_factor
+    else:
+        segment_inputs = segment_features
+        decode_function = decode_segment
+        frames_per_row = 1
+
+    # The seconds of audio of a segment, from the rows of its features (or log-likelihoods), 100 frames per second
+    def segment_seconds(inputs):
+        return inputs[0].num_rows * frames_per_row / 100.
+
+    def segment_beams():
+        return beam_controller.next_beams() if beam_controller else None
+
+    if num_procs <= 1:
+        input_start = time.time()
+        for inputs in segment_inputs:
+            result = decode_function(models, *inputs, beams=segment_beams())
+            if beam_controller:
+                beam_controller.segment_decoded(segment_seconds(inputs), time.time() - input_start)
+            yield result
+            input_start = time.time()
+        return
+
+    worker_models = models
+    context = multiprocessing.get_context('fork')
+    with context.Pool(num_procs) as pool:
+        if not beam_controller:
+            for result, _ in pool.imap(decode_segment_worker,
+                                       ((decode_function, [matrix.numpy().copy() for matrix in inputs], None)
+                                        for inputs in segment_inputs)):
+                yield result
+            return
+
+        # (seconds, feature time, decoding) of the segments that are decoded, in segment order
+        pending = collections.deque()
+
+        def pending_result():
+            seconds, feature_time, async_result = pending.popleft()
+            result, decode_time = async_result.get()
+            # The workers decode in parallel, so a segment takes only a part of their time
+            beam_controller.segment_decoded(seconds, feature_time + decode_time / num_procs)
+            return result
+
+        input_start = time.time()
+        for inputs in segment_inputs:
+            feature_time = time.time() - input_start
+            task = (decode_function, [matrix.numpy().copy() for matrix in inputs], segment_beams())
+            pending.append((segment_seconds(inputs), feature_time,
+                            pool.apply_async(decode_segment_worker, (task,))))
+            while len(pending) > num_procs or (pending and pending[0][2].ready()):
+                yield pending_result()
+            input_start = time.time()
+
+        while pending:
+            yield pending_result()
+
+# Decodes the segments of segment_features and yields the word ids and word alignments in segment order:
+# the first pass (see first_pass_results) and the RNNLM rescoring of the uncertain segments (see rescored_results)
+def decode_segments(models, segment_features, num_procs=1, rescore_procs=1, rescore_stats=None,
+                    beam_controller=None):
+    yield from rescored_results(models, first_pass_results(models, segment_features, num_procs=num_procs,
+                                                           beam_controller=beam_controller),
+                                rescore_procs=rescore_procs, rescore_stats=rescore_stats)
+
+# Deadline-aware adaptive beam: chooses the beam and max-active of every segment, so that the decoding stays
+# within a real-time factor budget (rtf: seconds of decoding per second of audio) and/or a wall-clock deadline
+# (seconds after start_time, the start of the job). After every decoded segment, the measured time of the segment
+# is compared with the time per second of audio that is left for the rest of the audio: the beams are tightened
+# when the decoding falls behind and widened (up to max_scale times the beams of the yaml config) when it is ahead.
+# Without total_seconds (streaming ingest), the rest of the audio is unknown and only the rtf budget is used.
+class adaptive_beam():
+    def __init__(self, decoder_yaml_opts, rtf=0.0, deadline=0.0, total_seconds=None, start_time=None,
+                 min_scale=0.4, max_scale=1.5, max_step=1.25):
+        self.base_beams = (decoder_yaml_opts['beam'], decoder_yaml_opts['max-active'],
+                           decoder_yaml_opts['lattice-beam'])
+        self.rtf = rtf
+        self.deadline = deadline if total_seconds else 0.0
+        self.total_seconds = total_seconds
+        self.start_time = time.time() if start_time is None else start_time
+        self.min_scale, self.max_scale, self.max_step = min_scale, max_scale, max_step
+        self.scale = 1.0
+        self.done_seconds = 0.0
+        # (beam, max-active, lattice beam) of every segment and the measured (seconds, decoding time) of every segment
+        self.segment_beams = []
+        self.segment_times = []
+
+    # The beams of the next segment
+    def next_beams(self):
+        beam, max_active, lattice_beam = self.base_beams
+        beams = (beam * self.scale, max(int(max_active * self.scale), 200),
+                 min(lattice_beam, beam * self.scale))
+        self.segment_beams.append(beams)
+        return beams
+
+    # The decoding time per second of audio that is left for the next segment of next_seconds
+    def required_rtf(self, next_seconds):
+        elapsed = time.time() - self.start_time
+        required = []
+        if self.total_seconds:
+            remaining = max(self.total_seconds - self.done_seconds, next_seconds, 0.01)
+            if self.rtf > 0:
+                required.append((self.rtf * self.total_seconds - elapsed) / remaining)
+            if self.deadline > 0:
+                required.append((self.deadline - elapsed) / remaining)
+        elif self.rtf > 0:
+            required.append((self.rtf * (self.done_seconds + next_seconds) - elapsed) / max(next_seconds, 0.01))
+        return min(required) if required else None
+
+    # Adapts the beams after a segment of seconds is decoded in decode_time seconds (its first pass)
+    def segment_decoded(self, seconds, decode_time):
+        self.done_seconds += seconds
+        self.segment_times.append((seconds, decode_time))
+
+        # The next segment is assumed to be as long as this one
+        required = self.required_rtf(seconds)
+        if required is None:
+            return
+        measured = decode_time / max(seconds, 0.01)
+        if required <= 0:
+            step = 1. / self.max_step
+        else:
+            step = min(max((required / max(measured, 1e-6)) ** 0.5, 1. / self.max_step), self.max_step)
+        self.scale = min(max(self.scale * step, self.min_scale), self.max_scale)
+
+    # Prints the effective beams of every segment and publishes the summary
+    def report(self, status=None):
+        for i, (beams, (seconds, decode_time)) in enumerate(zip(self.segment_beams, self.segment_times)):
+            print(f'Segment {i:04}: beam {beams[0]:.2f}, max-active {beams[1]}, lattice beam {beams[2]:.2f},'
+                  f' {seconds:.1f} seconds of audio decoded in {decode_time:.1f} seconds')
+        elapsed = time.time() - self.start_time
+        message = (f'Adaptive beam: {self.done_seconds:.1f} seconds of audio after {elapsed:.1f} seconds'
+                   f' (RTF {elapsed / max(self.done_seconds, 0.01):.2f}), effective beam per segment: '
+                   + ', '.join(f'{beams[0]:.1f}' for beams in self.segment_beams[:len(self.segment_times)]))
+        print(message)
+        if status:
+            status.publish_status(message)
 
-    segmentcounter = 1
-    with SequentialMatrixReader(feats_rspec) as f, \
-            SequentialMatrixReader(ivectors_rspec) as i:
-            for (fkey, feats), (ikey, ivectors) in zip(f, i):
-                # Calculate progress percentage
-                progress_percentage = (segmentcounter / len(segments_timing)) * 100
-                progress_message = f'Decoding progress: {progress_percentage:.2f}%'
-                status.publish_status(progress_message)
-
-                if cmvn_transformer:
-                    cmvn_transformer.apply(feats)
-                did_decode = True
-                assert (fkey == ikey)
-                out = fr.decode((feats, ivectors))
-                if do_rnn_rescore:
-                    lat = rescorer.rescore(out['lattice'])
-                else:
-                    lat = out['lattice']
-                best_path = functions.compact_lattice_shortest_path(lat)
-                words, _, _ = get_linear_symbol_sequence(shortestpath(best_path))
-                timing = functions.compact_lattice_to_word_alignment(best_path)
-                decoding_results.append((words, timing))
-                segmentcounter+=1
-
-    # Concatenating the results of the segments and adding an offset to the segments
+# Concatenates the results of the segments and adds the start of every segment to its word timings.
+# Returns the vtt datastructure (Word, begin(Frames), end(Frames)) and the words.
+def concatenate_results(decoding_results, segments_timing, symbols, debug_word_timing=False):
     words = []
     timing = [[],[],[]]
     for result in decoding_results:
@@ -161,8 +506,6 @@ def Kaldi(config_file, scp_filename, spk2utt_filename, segments_filename, do_rnn
             timing[0].extend(result[1][0])
             # start = map(lambda x: int(x + (offset[0] / kaldi_feature_factor)), result[1][1])
             start = [x + (offset[0] / kaldi_feature_factor) for x in result[1][1]]
-            format_timestamp_str(offset[0] / kaldi_feature_factor, seperator=".")
-            format_timestamp_str(start[0], seperator=".")
 
             timing[1].extend(start)
             timing[2].extend(result[1][2])
@@ -180,28 +523,242 @@ def Kaldi(config_file, scp_filename, spk2utt_filename, segments_filename, do_rnn
     if debug_word_timing:
         with open('debug_output.txt', 'w') as f:
             for element in vtt:
-                f.write(f'{element[1]} {format_timestamp_str(element[1], ".")}'
-                        f' {format_timestamp_str(element[1] + element[2], ".")} {element[2]} {element[0]}\n')
+                f.write(f'{element[1]} {format_timestamp_str(element[1], 0.0, ".")}'
+                        f' {format_timestamp_str(element[1] + element[2], 0.0, ".")} {element[2]} {element[0]}\n')
+
+    return vtt, words
+
+# The in-process feature pipeline of the model: MFCCs (mfcc-config) and online i-vectors
+# (ivector-extraction-config), the same options as compute-mfcc-feats and ivector-extract-online2
+def feature_pipeline_info(decoder_yaml_opts, models_dir):
+    feat_opts = OnlineNnetFeaturePipelineConfig()
+    feat_opts.feature_type = 'mfcc'
+    feat_opts.mfcc_config = models_dir + decoder_yaml_opts['mfcc-config']
+    feat_opts.ivector_extraction_config = models_dir + decoder_yaml_opts['ivector-extraction-config']
+    return OnlineNnetFeaturePipelineInfo.from_config(feat_opts)
+
+# Computes the features and i-vectors of every segment in-process. segment_samples are the (samples, samplerate)
+# of the segments. The MFCCs are computed once per segment and are the input of both the nnet and the online
+# i-vector extractor. The i-vector adaptation state carries over from segment to segment, like in
+# ivector-extract-online2 for all utterances of one speaker. Yields the features and the i-vectors of every segment.
+def inprocess_segment_features(feat_info, segment_samples):
+    ivector_period = feat_info.ivector_extractor_info.ivector_period
+    adaptation_state = OnlineIvectorExtractorAdaptationState.from_info(feat_info.ivector_extractor_info)
+    for samples, samplerate in segment_samples:
+        feat_pipeline = OnlineNnetFeaturePipeline(feat_info)
+        feat_pipeline.set_adaptation_state(adaptation_state)
+        feat_pipeline.accept_waveform(samplerate, Vector(np.asarray(samples, dtype=np.float32)))
+        feat_pipeline.input_finished()
+
+        input_feature = feat_pipeline.input_feature()
+        num_frames = input_feature.num_frames_ready()
+        feats = Matrix(num_frames, input_feature.dim())
+        input_feature.get_frames(list(range(num_frames)), feats)
+
+        # One i-vector every ivector_period frames, as in ivector-extract-online2
+        ivector_feature = feat_pipeline.ivector_feature()
+        ivectors = Matrix((num_frames + ivector_period - 1) // ivector_period, ivector_feature.dim())
+        for i in range(ivectors.num_rows):
+            ivector_feature.get_frame(i * ivector_period, ivectors[i])
+
+        feat_pipeline.get_adaptation_state(adaptation_state)
+        yield feats, ivectors
+
+# Computes the features and i-vectors of every segment with the Kaldi command line tools (extract-segments,
+# compute-mfcc-feats and ivector-extract-online2), this was used before the in-process feature pipeline.
+# Yields the features and the i-vectors of every segment.
+def rspec_segment_features(decoder_yaml_opts, models_dir, scp_filename, spk2utt_filename, segments_filename):
+    # Define feature pipelines as Kaldi rspecifiers
+    feats_rspec = (f'ark:extract-segments scp,p:{scp_filename} {segments_filename} '
+                   f'ark:- | compute-mfcc-feats --config={models_dir}{decoder_yaml_opts["mfcc-config"]} ark:- ark:- |')
+
+    ivectors_rspec = (
+            (f'ark:extract-segments scp,p:{scp_filename} {segments_filename} '
+             f'ark:- | compute-mfcc-feats --config={models_dir}{decoder_yaml_opts["mfcc-config"]} '
+             f'ark:- ark:- | '
+             f'ivector-extract-online2 --config={models_dir}{decoder_yaml_opts["ivector-extraction-config"]} '
+             f'ark:{spk2utt_filename} ark:- ark:- |'))
+
+    with SequentialMatrixReader(feats_rspec) as f, \
+            SequentialMatrixReader(ivectors_rspec) as i:
+            for (fkey, feats), (ikey, ivectors) in zip(f, i):
+                assert (fkey == ikey)
+                yield feats, ivectors
+
+# The samples of the segments (in frames) of a wav file, the wav file is memory mapped
+def wav_segment_samples(wav_filename, segments_timing):
+    samplerate, data = load_decoded_audio(wav_filename)
+    frame_step = samplerate // 100
+    for start, end in segments_timing:
+        yield data[start * frame_step:end * frame_step], samplerate
+
+# This method contains all Kaldi related calls and methods.
+# features: 'inprocess' for the in-process feature pipeline or 'rspec' for the Kaldi command line tools.
+# rtf_budget, deadline: decode with the adaptive beam (see adaptive_beam) within this budget, if set.
+def Kaldi(config_file, scp_filename, spk2utt_filename, segments_filename, do_rnn_rescore,
+          segments_timing, lm_scale, acoustic_scale, status, debug_word_timing=False, wav_filename=None,
+          features='inprocess', num_procs=1, batch_size=0, rescore_min_depth=0.0, rescore_procs=1,
+          rtf_budget=0.0, deadline=0.0, start_time=None):
+
+    models = load_models(config_file, do_rnn_rescore, lm_scale, acoustic_scale, status, batch_size=batch_size,
+                         rescore_min_depth=rescore_min_depth)
+
+    if features == 'inprocess':
+        segment_features = inprocess_segment_features(models['feat_info'],
+                                                      wav_segment_samples(wav_filename, segments_timing))
+    elif features == 'rspec':
+        segment_features = rspec_segment_features(models['decoder_opts'], models['models_dir'], scp_filename,
+                                                  spk2utt_filename, segments_filename)
+    else:
+        raise ValueError(f'Unknown feature pipeline: {features}')
+
+    did_decode = False
+    decoding_results = []
+
+    if num_procs > 1:
+        status.publish_status(f'Decoding with {num_procs} processes.')
+
+    beam_controller = None
+    if rtf_budget > 0 or deadline > 0:
+        beam_controller = adaptive_beam(models['decoder_opts'], rtf=rtf_budget, deadline=deadline,
+                                        total_seconds=sum(end - start for start, end in segments_timing) / 100.,
+                                        start_time=start_time)
+
+    segmentcounter = 1
+    rescore_stats = {}
+    for result in decode_segments(models, segment_features, num_procs=num_procs, rescore_procs=rescore_procs,
+                                  rescore_stats=rescore_stats, beam_controller=beam_controller):
+        # Calculate progress percentage
+        progress_percentage = (segmentcounter / len(segments_timing)) * 100
+        progress_message = f'Decoding progress: {progress_percentage:.2f}%'
+        status.publish_status(progress_message)
+
+        did_decode = True
+        decoding_results.append(result)
+        segmentcounter+=1
+
+    publish_rescore_stats(rescore_stats, status)
+    if beam_controller:
+        beam_controller.report(status)
+
+    vtt, words = concatenate_results(decoding_results, segments_timing, models['symbols'],
+                                     debug_word_timing=debug_word_timing)
 
     return vtt, did_decode, words
 
-# This is the asr function that converts the videofile, split the video into segments and decodes
-def kaldi_asr(filenameS_hash, filename, asr_beamsize=13, asr_max_active=8000, acoustic_scale=1.0, lm_scale=0.5,
-              do_rnn_rescore=False, config_file='models/kaldi_tuda_de_nnet3_chain2_de_722k.yaml', status=None):
+# The samples of the segments of the streaming ingest, every segment wav file is removed after it is read.
+# The (start, end) of every segment is appended to segments_timing.
+def ingested_segment_samples(segments, segments_timing, status=None, start_time=None):
+    for segment_idx, segment, segment_filename in segments:
+        samplerate, samples = wavfile.read(segment_filename)
+        os.remove(segment_filename)
+        segments_timing.append(segment)
+        if segment_idx == 0 and status and start_time is not None:
+            status.publish_status(f'First segment endpointed after {time.time() - start_time:.1f} seconds.')
+        yield samples, samplerate
+
+# Decodes the segments of the streaming ingest (see streaming_ingest.py) as soon as they are endpointed,
+# with the in-process feature pipeline. The length of the audio is not known in advance, so the adaptive beam
+# only uses rtf_budget.
+def Kaldi_stream(config_file, segments, do_rnn_rescore, lm_scale, acoustic_scale, status, start_time=None,
+                 debug_word_timing=False, num_procs=1, batch_size=0, rescore_min_depth=0.0, rescore_procs=1,
+                 rtf_budget=0.0):
+
+    models = load_models(config_file, do_rnn_rescore, lm_scale, acoustic_scale, status, batch_size=batch_size,
+                         rescore_min_depth=rescore_min_depth)
+
+    if start_time is None:
+        start_time = time.time()
 
-    print(f"{filenameS_hash=}")
+    did_decode = False
+    decoding_results = []
+    segments_timing = []
+    segment_samples = ingested_segment_samples(segments, segments_timing, status=status, start_time=start_time)
+    segment_features = inprocess_segment_features(models['feat_info'], segment_samples)
 
-    scp_filename = f'tmp/{filenameS_hash}.scp'
-    segments_filename = f'tmp/{filenameS_hash}_segments'
-    wav_filename = f'tmp/{filenameS_hash}.wav'
-    spk2utt_filename = f'tmp/{filenameS_hash}_spk2utt'
+    beam_controller = None
+    if rtf_budget > 0:
+        beam_controller = adaptive_beam(models['decoder_opts'], rtf=rtf_budget, start_time=start_time)
+
+    rescore_stats = {}
+    for result in decode_segments(models, segment_features, num_procs=num_procs, rescore_procs=rescore_procs,
+                                  rescore_stats=rescore_stats, beam_controller=beam_controller):
+        decoding_results.append(result)
+        did_decode = True
+
+        if len(decoding_results) == 1:
+            status.publish_status(f'First segment decoded after {time.time() - start_time:.1f} seconds.')
+        status.publish_status(f'Decoded segment {len(decoding_results)},'
+                              f' {segments_timing[-1][1] / 100.:.1f} seconds of audio.')
+
+    publish_rescore_stats(rescore_stats, status)
+    if beam_controller:
+        beam_controller.report(status)
+
+    vtt, words = concatenate_results(decoding_results, segments_timing, models['symbols'],
+                                     debug_word_timing=debug_word_timing)
+
+    return vtt, did_decode, words
+
+# Streaming version of kaldi_asr: the audio extraction and the endpointing run in a separate process
+# (see streaming_ingest.py), the models are loaded and the segments are decoded while the media file is decoded.
+def kaldi_stream_asr(filenameS_hash, filename, lm_scale=0.5, do_rnn_rescore=False, acoustic_scale=1.0,
+                     config_file='models/kaldi_tuda_de_nnet3_chain2_de_722k.yaml', status=None,
+                     endpoint_search='beam', audio_cache_dir=default_cache_dir, audio_cache_size=default_cache_size,
+                     num_procs=1, batch_size=0, rescore_min_depth=0.0, rescore_procs=1, rtf_budget=0.0,
+                     start_time=None):
+    if start_time is None:
+        start_time = time.time()
+
+    if status:
+        status.publish_status('Extract and segment audio (streaming).')
+
+    ingest = start_ingest(filename, f'tmp/{filenameS_hash}', cache_dir=audio_cache_dir, cache_size=audio_cache_size,
+                          search=endpoint_search, status=status)
+    try:
+        vtt, did_decode, words = Kaldi_stream(config_file, ingested_segments(*ingest), do_rnn_rescore, lm_scale,
+                                              acoustic_scale, status, start_time=start_time, num_procs=num_procs,
+                                              batch_size=batch_size, rescore_min_depth=rescore_min_depth,
+                                              rescore_procs=rescore_procs, rtf_budget=rtf_budget)
+    except ffmpeg.Error as e:
+        traceback.print_exc()
+        if status:
+            status.publish_status('Audio extraction failed.')
+            status.publish_status(f'Error message is: {e.stderr}')
+            status.send_error()
+        print(f'Audio extraction failed: {e.stderr}')
+        sys.exit(-1)
+
+    if did_decode:
+        if status:
+            status.publish_status(f'ASR finished after {time.time() - start_time:.1f} seconds.')
+    else:
+        if status:
+            status.publish_status('ASR error.')
+            status.send_error()
+        print('ASR error.')
+        sys.exit(-1)
 
-    # Audio extraction
+    if status:
+        status.publish_status('VTT finished.')
+
+    return vtt, words
+
+# Extracts the 16 kHz mono audio of a media file to the wav file of the job (a hard link to the audio cache, or a
+# copy if the cache is disabled). Exits the job if the audio can't be extracted.
+def extract_audio(filename, wav_filename, audio_cache_dir=default_cache_dir, audio_cache_size=default_cache_size,
+                  status=None):
     if status:
         status.publish_status('Extract audio.')
 
     try:
-        preprocess_audio(filename, wav_filename)
+        if audio_cache_dir:
+            # The endpointing names the segments after the wav file, so the job links the decoded audio
+            # to its own name. The link is a hard link, so other jobs can't evict the audio while the job reads it.
+            link_decoded_audio(filename, wav_filename, cache_dir=audio_cache_dir, max_size=audio_cache_size,
+                               status=status)
+        else:
+            preprocess_audio(filename, wav_filename)
     except ffmpeg.Error as e:
         traceback.print_exc()
         if status:
@@ -213,21 +770,69 @@ def kaldi_asr(filenameS_hash, filename, asr_beamsize=13, asr_max_active=8000, ac
 
     if status:
         status.publish_status('Audio extracted.')
-        status.publish_status('Audio segmentation.')
 
-    # Segmentation
+# Cuts the audio of the wav file of the job into segments (see simple_endpointing.process_wav).
+# Returns the (start, end) of every segment in frames. Exits the job if the segmentation fails.
+def segment_audio(wav_filename, endpoint_search='beam', status=None):
+    if status:
+        status.publish_status('Audio segmentation.')
 
     try:
-        segments_filenames, segments_timing = process_wav(wav_filename)
+        _, segments_timing = process_wav(wav_filename, search=endpoint_search)
     except Exception as e:
         traceback.print_exc()
         if status:
             status.publish_status('Audio segmentation failed.')
             status.publish_status(f'Error message is: {e}')
             status.send_error()
-        print(f'Audio segmentation failed. {e.stderr}')
+        print(f'Audio segmentation failed. {e}')
         sys.exit(-1)
 
+    return segments_timing
+
+# This is the asr function that converts the videofile, split the video into segments and decodes
+def kaldi_asr(filenameS_hash, filename, asr_beamsize=13, asr_max_active=8000, acoustic_scale=1.0, lm_scale=0.5,
+              do_rnn_rescore=False, config_file='models/kaldi_tuda_de_nnet3_chain2_de_722k.yaml', status=None,
+              endpoint_search='beam', audio_cache_dir=default_cache_dir, audio_cache_size=default_cache_size,
+              trim_silence=0.0, trim_silence_threshold=default_threshold_db, streaming_ingest=False,
+              kaldi_features='inprocess', num_procs=1, batch_size=0, rescore_min_depth=0.0, rescore_procs=1,
+              rtf_budget=0.0, deadline=0.0):
+    start_time = time.time()
+
+    print(f"{filenameS_hash=}")
+
+    if streaming_ingest:
+        if trim_silence > 0 and status:
+            status.publish_status('Warning, silence trimming is not available with the streaming ingest.')
+        if deadline > 0 and status:
+            status.publish_status('Warning, the decoding deadline is not available with the streaming ingest,'
+                                  ' only the real-time factor budget.')
+        return kaldi_stream_asr(filenameS_hash, filename, lm_scale=lm_scale, do_rnn_rescore=do_rnn_rescore,
+                                acoustic_scale=acoustic_scale, config_file=config_file, status=status,
+                                endpoint_search=endpoint_search, audio_cache_dir=audio_cache_dir,
+                                audio_cache_size=audio_cache_size, num_procs=num_procs,
+                                batch_size=batch_size, rescore_min_depth=rescore_min_depth,
+                                rescore_procs=rescore_procs, rtf_budget=rtf_budget, start_time=start_time)
+
+    scp_filename = f'tmp/{filenameS_hash}.scp'
+    segments_filename = f'tmp/{filenameS_hash}_segments'
+    wav_filename = f'tmp/{filenameS_hash}.wav'
+    spk2utt_filename = f'tmp/{filenameS_hash}_spk2utt'
+
+    extract_audio(filename, wav_filename, audio_cache_dir=audio_cache_dir, audio_cache_size=audio_cache_size,
+                  status=status)
+
+    # Silence trimming, the wav file (or the link to the cache) of the job is replaced by the trimmed audio
+    time_offsets = None
+    if trim_silence > 0:
+        samplerate, data = load_decoded_audio(wav_filename)
+        speech_ranges, time_offsets = silence_trimming(data, samplerate, min_silence=trim_silence,
+                                                       threshold_db=trim_silence_threshold, status=status)
+        write_trimmed_wav(wav_filename, data, samplerate, speech_ranges)
+        del data
+
+    segments_timing = segment_audio(wav_filename, endpoint_search=endpoint_search, status=status)
+
     # Write scp and spk2utt file
     with open(scp_filename, 'w') as wavscp, open(spk2utt_filename, 'w') as spk2utt:
         # segmentFilename = wav_filename.rpartition('.')[0]
@@ -241,7 +846,19 @@ def kaldi_asr(filenameS_hash, filename, asr_beamsize=13, asr_max_active=8000, ac
     if status:
         status.publish_status('Start ASR.')
     vtt, did_decode, words = Kaldi(config_file, scp_filename, spk2utt_filename, segments_filename,
-                                   do_rnn_rescore, segments_timing, lm_scale, acoustic_scale, status)
+                                   do_rnn_rescore, segments_timing, lm_scale, acoustic_scale, status,
+                                   wav_filename=wav_filename, features=kaldi_features, num_procs=num_procs,
+                                   batch_size=batch_size, rescore_min_depth=rescore_min_depth,
+                                   rescore_procs=rescore_procs, rtf_budget=rtf_budget, deadline=deadline,
+                                   start_time=start_time)
+
+    # Map the word timings (in frames) of the trimmed audio back to the time of the media file
+    if time_offsets:
+        frames_per_second = 100. / kaldi_feature_factor
+        starts = map_times([element[1] / frames_per_second for element in vtt], time_offsets)
+        ends = map_times([(element[1] + element[2]) / frames_per_second for element in vtt], time_offsets)
+        vtt = [[element[0], start * frames_per_second, (end - start) * frames_per_second]
+               for element, start, end in zip(vtt, starts, ends)]
 
     # communicate back job status
     if did_decode:
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    Copyright 2023 Lecture2Go, Dr. Benjamin Milde
+#
+#    Licensed under the Apache License, Version 2.0 (the 'License');
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an 'AS IS' BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Prepared Kaldi models: a one-time conversion of the model files of a Kaldi yaml config into a format that
+# is fast to load and can be shared by all concurrent subtitle2go jobs of a host:
+#  - the HCLG graph as aligned const FST (fstconvert --fst_type=const --fst_align), which OpenFST memory maps
+#    read-only, so all jobs share one copy of the graph in the page cache instead of a private copy each,
+#  - the acoustic model in binary format, prepared for test (nnet3-am-copy --prepare-for-test),
+#  - the word symbol table in the binary OpenFST format.
+# The prepared model is described by its own yaml config (models/<name>.prepared.yaml), which kaldi_decoder uses
+# automatically if it exists. Prepare a model with:
+#   python prepared_models.py models/kaldi_tuda_de_nnet3_chain2_de_900k.yaml
+
+import os
+import argparse
+import subprocess
+
+import yaml
+
+from kaldi.asr import NnetLatticeFasterRecognizer
+from kaldi.decoder import LatticeFasterDecoder
+from kaldi.fstext import SymbolTable, StdConstFst
+from kaldi.hmm import TransitionModel
+from kaldi.nnet3 import AmNnetSimple, set_batchnorm_test_mode, set_dropout_test_mode, collapse_model, \
+    CollapseModelConfig
+from kaldi.util.io import xopen
+
+
+# The yaml config of the prepared model of a yaml config
+def prepared_config_filename(config_file):
+    return config_file.rpartition('.')[0] + '.prepared.yaml'
+
+
+# Converts the model files of config_file into the prepared format and writes the prepared yaml config.
+# Needs the Kaldi and OpenFST command line tools in the PATH (see path.sh).
+def prepare_models(config_file, models_dir='models/'):
+    with open(config_file, 'r') as stream:
+        model_yaml = yaml.safe_load(stream)
+    decoder_yaml_opts = model_yaml['decoder']
+
+    fst = decoder_yaml_opts['fst'].rpartition('.')[0] + '.const.fst'
+    model = decoder_yaml_opts['model'].rpartition('.')[0] + '.prepared.mdl'
+    word_syms = decoder_yaml_opts['word-syms'].rpartition('.')[0] + '.syms'
+
+    print(f'Converting {decoder_yaml_opts["fst"]} to {fst}')
+    subprocess.run(['fstconvert', '--fst_type=const', '--fst_align=true', models_dir + decoder_yaml_opts['fst'],
+                    models_dir + fst], check=True)
+    print(f'Converting {decoder_yaml_opts["model"]} to {model}')
+    subprocess.run(['nnet3-am-copy', '--binary=true', '--prepare-for-test=true',
+                    models_dir + decoder_yaml_opts['model'], models_dir + model], check=True)
+    print(f'Converting {decoder_yaml_opts["word-syms"]} to {word_syms}')
+    SymbolTable.read_text(models_dir + decoder_yaml_opts['word-syms']).write(models_dir + word_syms)
+
+    decoder_yaml_opts.update({'fst': fst, 'model': model, 'word-syms-binary': word_syms, 'prepared': True})
+    prepared_config_file = prepared_config_filename(config_file)
+    with open(prepared_config_file, 'w') as stream:
+        yaml.safe_dump(model_yaml, stream, default_flow_style=False, allow_unicode=True)
+    print(f'Wrote {prepared_config_file}')
+    return prepared_config_file
+
+
+# Reads a const FST memory mapped (read-only), so that all processes that read the same file share its pages.
+# OpenFST only maps aligned const FSTs (see prepare_models), and older PyKaldi builds don't wrap the read options
+# of OpenFST. In both cases the FST is read into memory instead, in one block.
+# Returns the FST and True if it is memory mapped.
+def read_mapped_fst(filename):
+    try:
+        from kaldi.fstext import FstHeader, FstReadOptions
+        from kaldi.base.io import ifstream
+
+        stream = ifstream.from_file(filename)
+        header = FstHeader()
+        if header.read(stream, filename):
+            read_opts = FstReadOptions(filename, header)
+            read_opts.mode = FstReadOptions.FileReadMode.MAP
+            fst = StdConstFst.read_from_stream(stream, read_opts)
+            if fst is not None:
+                return fst, True
+    except (ImportError, AttributeError, TypeError):
+        pass
+    return StdConstFst.read(filename), False
+
+
+# Reads the transition model and the acoustic model of a Kaldi nnet3 model file and prepares it for test
+def read_acoustic_model(model_filename):
+    with xopen(model_filename) as model_file:
+        transition_model = TransitionModel()
+        transition_model.read(model_file.stream(), model_file.binary)
+        acoustic_model = AmNnetSimple()
+        acoustic_model.read(model_file.stream(), model_file.binary)
+    # No-ops for a model that is prepared for test, but cheap
+    set_batchnorm_test_mode(True, acoustic_model.get_nnet())
+    set_dropout_test_mode(True, acoustic_model.get_nnet())
+    collapse_model(CollapseModelConfig(), acoustic_model.get_nnet())
+    return transition_model, acoustic_model
+
+
+# Loads the recognizer of a prepared model, the words are read once from the binary symbol table.
+# Returns the recognizer and True if the graph is memory mapped.
+def prepared_recognizer(decoder_yaml_opts, models_dir, decoder_opts, decodable_opts):
+    transition_model, acoustic_model = read_acoustic_model(models_dir + decoder_yaml_opts['model'])
+    graph, mapped = read_mapped_fst(models_dir + decoder_yaml_opts['fst'])
+    symbols = SymbolTable.read(models_dir + decoder_yaml_opts['word-syms-binary'])
+    decoder = LatticeFasterDecoder(graph, decoder_opts)
+    fr = NnetLatticeFasterRecognizer(transition_model, acoustic_model, decoder, symbols,
+                                     decodable_opts=decodable_opts)
+    # The decoder only references the graph, it has to stay alive as long as the recognizer
+    fr.graph = graph
+    return fr, mapped
+
+
+# Resident memory of this process and the part of it that is shared with other processes (e.g. the pages of
+# a memory mapped graph), in MB. None on systems without /proc.
+def memory_usage():
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            _, resident, shared = [int(value) for value in statm.read().split()[:3]]
+    except (OSError, ValueError):
+        return None, None
+    page_size = os.sysconf('SC_PAGE_SIZE') / 1024**2
+    return resident * page_size, shared * page_size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts the models of Kaldi yaml configs into the prepared,'
+                                                 ' memory mappable format.')
+    parser.add_argument('configs', help='Kaldi yaml configs, e.g. models/kaldi_tuda_de_nnet3_chain2_de_900k.yaml',
+                        nargs='+')
+    parser.add_argument('--models-dir', help='The directory of the model files.', default='models/')
+    args = parser.parse_args()
+
+    for config_file in args.configs:
+        prepare_models(config_file, models_dir=args.models_dir)
@@ -1,27 +1,120 @@
 # Interpunctuation
+# The text is punctuated in overlapping windows of a fixed number of words, which are predicted in padded batches.
+# Every word gets the label of the window in which it has the most context on both sides, so the merged labels
+# in the overlap regions don't depend on the batch size or the number of threads.
+import time
+
 from rpunct import RestorePuncts
 
-# Adds interpunctuation to the Kaldi output
-def interpunctuation(vtt, words, filenameS_hash, model_punctuation, uppercase, status):
+# Words per window, every window has to fit into the max_seq_length of the model (512 subword tokens)
+window_words = 250
+
+# Words that overlapping windows share
+overlap_words = 30
+
+# Windows per batch of the model
+default_batch_size = 8
+
+# Label of words that are not punctuated (no punctuation, no uppercase)
+no_punct_label = 'OO'
+
+# Process-wide cache of loaded punctuation models
+punctuation_models = {}
+
+
+# Loads an rpunct punctuation model, every model is only loaded once per process
+def load_punctuation_model(model_punctuation):
+    if model_punctuation not in punctuation_models:
+        start_time = time.time()
+        punctuation_models[model_punctuation] = RestorePuncts(model=model_punctuation)
+        print(f'Loaded punctuation model {model_punctuation} in {time.time() - start_time:.1f} seconds.')
+    return punctuation_models[model_punctuation]
+
+
+# The windows (start, end) of num_words words, window_words long with overlap_words words overlap
+def punctuation_windows(num_words, window_words=window_words, overlap_words=overlap_words):
+    step = max(window_words - overlap_words, 1)
+    windows = []
+    start = 0
+    while True:
+        end = min(start + window_words, num_words)
+        windows.append((start, end))
+        if end >= num_words:
+            return windows
+        start += step
+
+
+# The context of every word of a window: the distance to the nearer window edge, edges at the start or the end
+# of the text don't count, since a word there doesn't have more context in any other window
+def window_context(start, end, num_words):
+    left = [i - start if start > 0 else num_words for i in range(start, end)]
+    right = [end - 1 - i if end < num_words else num_words for i in range(start, end)]
+    return [min(l, r) for l, r in zip(left, right)]
+
+
+# Predicts the punctuation label (e.g. ',O' or '.U', see rpunct) of every word. The windows are predicted
+# batch_size windows at a time, so the memory of the model doesn't grow with the length of the text.
+# In the overlap regions, the label of the window with the most context wins, the earlier window on ties.
+def predict_punctuation_labels(rpunct, words, batch_size=default_batch_size, window_words=window_words,
+                               overlap_words=overlap_words):
+    windows = punctuation_windows(len(words), window_words=window_words, overlap_words=overlap_words)
+    rpunct.model.args.eval_batch_size = batch_size
+
+    labels = [no_punct_label] * len(words)
+    best_context = [-1] * len(words)
+    for batch_start in range(0, len(windows), batch_size):
+        batch = windows[batch_start:batch_start + batch_size]
+        predictions, _ = rpunct.model.predict([' '.join(words[start:end]) for start, end in batch])
+        for (start, end), prediction in zip(batch, predictions):
+            # Words that are truncated by the model keep the label of the other window (or no punctuation)
+            window_labels = [list(word_label.values())[0] for word_label in prediction]
+            for i, label, context in zip(range(start, end), window_labels, window_context(start, end, len(words))):
+                if context > best_context[i]:
+                    labels[i], best_context[i] = label, context
+    return labels
+
+
+# Applies a punctuation label to a word, like rpunct.punctuate_texts
+def punctuate_word(word, label):
+    if label[-1] == 'U':
+        word = word.capitalize()
+    if label[0] != 'O':
+        word += label[0]
+    return word
+
+
+# Adds interpunctuation to the Kaldi output.
+# num_threads: torch threads of the model (0 keeps the default of torch), batch_size: windows per batch.
+def interpunctuation(vtt, words, filenameS_hash, model_punctuation, uppercase, status, num_threads=0,
+                     batch_size=default_batch_size):
 
     status.publish_status('Starting interpunctuation.')
+    start_time = time.time()
+
+    if num_threads > 0:
+        import torch
+        torch.set_num_threads(num_threads)
 
     # BERT
-    text = str(' '.join(words))
-    if uppercase:
-        text = text.lower()
-    rpunct = RestorePuncts(model=model_punctuation)
+    rpunct = load_punctuation_model(model_punctuation)
+
+    # Words without text (if any) are not passed to the model, so that the words of the windows stay aligned
+    # to the words of the model (it splits its input on spaces)
+    text_positions = [i for i, word in enumerate(words) if word.strip()]
+    text_words = [words[i].lower() if uppercase else words[i] for i in text_positions]
+    labels = predict_punctuation_labels(rpunct, text_words, batch_size=batch_size) if text_words else []
 
-    punct = rpunct.punctuate(text)
-    punct = punct.replace('.', '. ').replace(',', ', ').replace('!', '! ').replace('?', '? ')
-    punct = punct.replace('  ', ' ')
-    punct_list = punct.split(' ')
+    punct_list = list(words)
+    for i, word, label in zip(text_positions, text_words, labels):
+        punct_list[i] = punctuate_word(word, label)
+    # Like rpunct, the text always ends with a period
+    if text_positions and punct_list[text_positions[-1]][-1].isalnum():
+        punct_list[text_positions[-1]] += '.'
 
-    # punct_list = file_punct.read().split(' ')
     vtt_punc = []
     for a, b in zip(punct_list, vtt):  # Replaces the adapted words with the (capitalization, period, comma) with the new ones
         vtt_punc.append([a, b[1], b[2]])
 
-    status.publish_status('Adding interpunctuation finished.')
+    status.publish_status(f'Adding interpunctuation finished after {time.time() - start_time:.1f} seconds.')
 
-    return vtt_punc
\ No newline at end of file
+    return vtt_punc
@@ -15,46 +15,103 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import os
 import spacy
 import math
+import time
+import bisect
+import traceback
+import multiprocessing
+import numpy as np
+
+from spacy.attrs import HEAD
+from spacy.tokens import Doc
+
+from fast_scorer import fast_boundary_scores
 
 test = '''Seit der Industriellen Revolution verstärkt der Mensch den natürlichen Treibhauseffekt durch den Ausstoß von Treibhausgasen, wie messtechnisch belegt werden konnte. Seit 1990 ist der Strahlungsantrieb das heißt die Erwärmungswirkung auf das Klima durch langlebige Treibhausgase um 43 Prozent gestiegen. In der Klimatologie ist es heute Konsens, dass die gestiegene Konzentration der vom Menschen in die Erdatmosphäre freigesetzten Treibhausgase mit hoher Wahrscheinlichkeit die wichtigste Ursache der globalen Erwärmung ist, da ohne sie die gemessenen Temperaturen nicht zu erklären sind. Treibhausgase lassen die von der Sonne kommende kurzwellige Strahlung weitgehend ungehindert auf die Erde durch, absorbieren aber einen Großteil der von der Erde ausgestrahlten Infrarotstrahlung. Dadurch erwärmen sie sich und emittieren selbst Strahlung im langwelligen Bereich (vgl. Kirchhoffsches Strahlungsgesetz). Der in Richtung der Erdoberfläche gerichtete Strahlungsanteil wird als atmosphärische Gegenstrahlung bezeichnet. Im isotropen Fall wird die absorbierte Energie je zur Hälfte in Richtung Erde und Weltall abgestrahlt. Hierdurch erwärmt sich die Erdoberfläche stärker, als wenn allein die kurzwellige Strahlung der Sonne sie erwärmen würde. Das IPCC schätzt den Grad des wissenschaftlichen Verständnisses über die Wirkung von Treibhausgasen als hoch ein. Das Treibhausgas Wasserdampf trägt mit 36 bis 66 Prozent, Kohlenstoffdioxid mit 9 bis 26 Prozent und Methan mit 4 bis 9 Prozent zum natürlichen Treibhauseffekt bei. Die große Bandbreite erklärt sich folgendermaßen: Einerseits gibt es sowohl örtlich wie auch zeitlich große Schwankungen in der Konzentration dieser Gase. Zum anderen überlappen sich deren Absorptionsspektren. Beispiel: Strahlung, die von Wasserdampf bereits absorbiert wurde, kann von CO2 nicht mehr absorbiert werden. Das bedeutet, dass in einer Umgebung wie eisbedeckte Flächen oder Trockenwüste, in der Wasserdampf nur wenig zum Treibhauseffekt beiträgt, die übrigen Treibhausgase mehr zum Gesamttreibhauseffekt beitragen als in den feuchten Tropen. Da die genannten Treibhausgase natürliche Bestandteile der Atmosphäre sind, wird die von ihnen verursachte Temperaturerhöhung als natürlicher Treibhauseffekt bezeichnet. Der natürliche Treibhauseffekt führt dazu, dass die Durchschnittstemperatur der Erde bei etwa plus 14 Grad Celius liegt. Ohne den natürlichen Treibhauseffekt läge sie bei etwa minus 18 Grad Celius. Hierbei handelt es sich um rechnerisch bestimmte Werte. In der Literatur können diese Werte gegebenenfalls leicht abweichen, je nach Rechenansatz und der zu Grunde gelegten Annahmen, zum Beispiel dem Reflexionsverhalten der Erde. Diese Werte dienen als Nachweis, dass es einen natürlichen Treibhauseffekt gibt, da ohne ihn die Temperatur entsprechend deutlich geringer sein müsste und sich die höhere Temperatur mit dem Treibhauseffekt erklären lässt. Abweichungen von wenigen Grad Celsius spielen bei diesem Nachweis zunächst keine wesentliche Rolle.'''
 
 test = '''In Husum Zeiten muss man ja immer pünktlich sein, was sonst akademischen werden. Nicht so richtig eher. Der Fall war das fing Fangnetz aber schon mal an. Ich freue mich sehr, dass wir so früh morgens am jetzt hier zusammenkommen. Einmal eben auf dem Campus von Melle Park. Und einmal in der Summe Welt. Also auf dem Server der Unität Hamburg-Mitte, das Jahr stattfinden Herzlich. Willkommen zu dieser Veranstaltung mit dem Titel Schulden Phobie und Lohnverzicht, wie man die Corona Krise zur Katastrophe macht. Mit er Professor Doktor Heiner Flassbeck er diese Veranstaltung findet, starb waren. Die meisten Menschen wissen, dass heute mal kurz er im Rahmen des ersten Semesters des Fachbereich Sozialökonomie. Das hat mal begonnen. Diese Idee eigentlich mit dem GzwanzigGipfel. Als hier in Steindorf entfernen, Messehallen sich die großen Welt Köpfe. Getroffen, haben wir gesagt da Moment mal, da haben wir noch einiges mehr mitzureden als Universität. Wollen uns mal diese Semester mit diesen Fragen auseinandersetzen und wollen ja, dass es im schüttel mich vor allem darauf ankommen könnte, Pons runter zu reißen. Oder für Lehrende. Dass man vor allem der pro Tag machen muss oder so. Sondern dass man sich mit den gesellschaftlich relevanten Fragen im im Studium beschäftigt. Dass es nicht so trocken schwimmen ist, sondern auch etwas für drittes relevantes gemeinsam machte, hatten dann auch schon zehn Semester zu Austritten aus Solidarität, Einzug, Gesundheitspflege und Kinderarbeit. Und haben jetzt eben uns in diesem mal überlegt, dass wir die gesellschaftliche Polarisierung sozialökonomische betrachten wollen. Also politisch, ökonomisch, kulturell, sozial, ökonomisch eben. Und haben uns dann aus aktuellem Anlass gesagt, dass man das auch in Zeiten von Corona eben zuspitzen muss, dass das jetzt sehr ansteht. Das Hochschulen sich da einmischen auch gegen diese ganze Erzählung, von dass eine Naturkatastrophe, was er die Hamburgische Bürgerschaft, die Masche beschlossen hat, um dann die Schuldenbremse Ausnahmeregelung anwenden zu können, um deutlich zu machen, dass das eine Gesellschaft Krise erheben is, wo wir eben auch dann handlungsfähig sind und uns das Jahr zu beschäftigen haben. Online Vorlesungen gemacht. Und sind jetzt eben diese Aktionswoche mittlerweile im finalen Tag am Freitag angekommen. Nachdem wir schon Hm, rechtswissenschaftliche, Medien, Soziologische, antirassistische sozialstaatliche, unser weite Diskussionen geführt haben, dann genau Sind wir jetzt eben er dabei und freuen uns sehr, dass wir das am ökonomisch diskutieren kann. Heterodoxe Ökonomie diskutieren können. Hm Genau mit eben Heiner Flassbeck, der beim Professor A an der ihm einen huschen Wirtschaftspolitik heutigen Fachbereich Sozialökonomie Immunität Hamburg is. Denn er war früher Stadtsekretär Bundesministerium. Der Finanzen sozusagen, hat dann langfristig rechtzeitig den Absprung gemacht, vor die neoliberale Phase dann eingeläutet is also sozusagen. Die Geschichte hat ihn daraufhin Fall recht gegeben. Was den offenen Krise und so alles folgte. Er war dann im Anschluss Chefökonom. Ähm, der UNO Organisationen für Welthandel und Entwicklungen unkt hat beim Hohen. Genau ist er seit zwei Tausend. Neunzehn Herausgeber er unter anderem dem fielen der Tätigkeiten, der Online-Zeitschrift makroskopisch Hm Genau Und. Ja, Mach schon länger im Lehrveranstaltungen. Vor allem in Master. Komische soziologische Studien. Aber Wirtschaftsgesellschaft ich auch ein bisschen Werbung machen will an dieser Stelle. Die Bewerbungsfrist läuft gerade. Also traut euch Ärmel. Genau. Und insofern freue ich mich jetzt, dass wir diese diese Diskussion Schuldenfalle Lohnverzicht, wie man die Corona Krise zu Katastrophe macht. Und vielleicht Alternativ oder so. Dann noch Gemeinde des gesunden. Ja auch normal. Dann besprechen wir das. Sind sie gemeinsam angehen kann ich wird jetzt auch gleich meine Klappe halten. Nur kurzer Hinweis auf Organisatorisches. Wenn ihr dann gleich nach dem Vortrag etwas sagen Wolfs in der Sagenwelt, dann wär 's cool, wenn ihr ein Ausrufezeichen in den Depots sind an sich, dass hier vor Ort und würdigsten sanken, die Rednerliste einsortieren. Und ich guck mich einfach hier bis in um auf informeller Park. Wer sich hier meldet. Und genau wurde das dann eben gemeinsam ein redete.'''
 
-# find parent in spacy dependency graph
-def find_node(common_parent, search_node):
-    path_len = 0
-    while search_node != common_parent:
-        path_len += 1
-        search_node = search_node.head
-    return path_len
+# Pipeline components that are not needed for the segmentation. We only use the sentence boundaries and
+# the dependency heads, which are both predicted by the parser (and its tok2vec layer).
+spacy_excluded_pipes = ['tagger', 'morphologizer', 'attribute_ruler', 'lemmatizer', 'ner', 'entity_ruler',
+                        'entity_linker', 'senter', 'textcat', 'textcat_multilabel', 'trainable_lemmatizer']
 
-# Segments the given text
+# Process-wide cache of loaded spaCy models
+spacy_models = {}
 
-# Options:
-# beam_size: what beam size to use for the segmentation search
-# ideal_token_len: the ideal length of tokens per segment
-# len_reward_factor: how important it is to be close to ideal_token_len,
-#                    higher factor = splits are closer to ideal_token_len
-# sentence_end_reward_factor: the weight of the sentence end score in the search.
-#                             Higher values make it more likely to always split at sentence end.
-# comma_end_reward_factor: the weight of the comma end score in the search.
-#                             Higher values make it more likely to always split at sentence end.
-# max_lookahead: maximum lookahead for the beam search, this is also the maximum length of one segment
-# debug_print: print additional debug info
+# Loads a parser-only spaCy pipeline for the segmentation, every model is only loaded once per process.
+# With the 'fast' scorer, no trained model is loaded at all: we only need spaCy's tokenizer for the language
+# of the model (e.g. 'de' for de_core_news_lg) and the rule based sentencizer.
+def load_spacy_model(model_name, scorer='parser'):
+    if (model_name, scorer) not in spacy_models:
+        start_time = time.time()
+        if scorer == 'fast':
+            nlp = spacy.blank(os.path.basename(os.path.normpath(model_name)).split('_')[0])
+            nlp.add_pipe('sentencizer')
+        else:
+            nlp = spacy.load(model_name, exclude=spacy_excluded_pipes)
+        spacy_models[(model_name, scorer)] = nlp
+        print(f'Loaded spaCy model {model_name} for the {scorer} scorer with pipes {nlp.pipe_names}'
+              f' in {time.time() - start_time:.2f} seconds.')
+    return spacy_models[(model_name, scorer)]
 
-def segment_beamsearch(text, model_spacy, beam_size=10, ideal_token_len=10, len_reward_factor=2.3,
-                   sentence_end_reward_factor=0.9, comma_end_reward_factor=0.5, max_lookahead=40, debug_print=False):
+# Computes the length of the shortest path in the dependency tree between all adjacent words of a sentence.
+# heads contains the index of the head of every word (relative to the sentence start), the root points to itself.
+# The path length is depth[i] + depth[i+1] - 2*depth[lca[i,i+1]], where lca is the lowest common ancestor.
+# Instead of computing the full lowest common ancestry matrix, we compute the depth of every word and the
+# 2^k-th ancestors with pointer jumping once, and then only the lowest common ancestors of adjacent words
+# (the superdiagonal of the LCA matrix) with binary lifting. Everything is vectorized over the sentence.
+def adjacent_path_lengths(heads):
+    heads = np.asarray(heads, dtype=np.int64)
+    sent_len = len(heads)
+    if sent_len < 2:
+        return np.zeros(0, dtype=np.int64)
+    positions = np.arange(sent_len)
 
-    # if model_spacy is just the model name, then load the model
-    # otherwise assume model_spacy is preloaded outside of this function
-    if type(model_spacy) is str:
-        segment_nlp = spacy.load(model_spacy)
-    else:
-        segment_nlp = model_spacy
-    doc = segment_nlp(text)
-    doc_parsetree_seqs = []    
+    # heads outside of the sentence should not happen, but if they do, the word is treated as a root
+    heads = np.where((heads < 0) | (heads >= sent_len), positions, heads)
+
+    # Pointer jumping: after step k, ancestors[k] is the 2^k-th ancestor of every word (or the root)
+    # and depth is the distance to the root after the last step
+    depth = (heads != positions).astype(np.int64)
+    ancestors = [heads]
+    for _ in range(sent_len.bit_length()):
+        depth = depth + depth[ancestors[-1]]
+        ancestors.append(ancestors[-1][ancestors[-1]])
+
+    # Binary lifting for all pairs of adjacent words (u, v) at once, first lift the deeper word
+    # to the depth of the other one, then lift both as long as their ancestors differ
+    left, right = positions[:-1], positions[1:]
+    swap = depth[left] < depth[right]
+    u = np.where(swap, right, left)
+    v = np.where(swap, left, right)
+    depth_diff = depth[u] - depth[v]
+    for k, ancestor in enumerate(ancestors):
+        u = np.where((depth_diff >> k) & 1 == 1, ancestor[u], u)
+    for ancestor in reversed(ancestors):
+        differs = ancestor[u] != ancestor[v]
+        u = np.where(differs, ancestor[u], u)
+        v = np.where(differs, ancestor[v], v)
+    lca = np.where(u == v, u, heads[u])
+
+    path_lens = depth[left] + depth[right] - 2 * depth[lca]
+
+    # Words in different trees (again, should not happen) are treated as if connected through a virtual root
+    disconnected = (u != v) & (heads[u] != heads[v])
+    path_lens[disconnected] = depth[left][disconnected] + depth[right][disconnected] + 2
+
+    return path_lens
+
+# Computes the reward for a cut after every token in the doc.
+# Longer shortest paths in the dependency tree between two adjacent words = better point to split.
+# Sentence ends and commas get a reward that is dependent on the sentence length.
+def doc_parsetree_scores(doc, sentence_end_reward_factor=0.9, comma_end_reward_factor=0.5, debug_print=False):
+    doc_parsetree_seqs = []
+
+    # Heads of all tokens in the doc, HEAD is stored relative to the token position
+    doc_heads = np.arange(len(doc), dtype=np.int64) + doc.to_array(HEAD).astype(np.int64)
 
     # Iterate over all sentences in the text
     for sent in doc.sents:
@@ -62,24 +119,11 @@ def segment_beamsearch(text, model_spacy, beam_size=10, ideal_token_len=10, len_
             print( [sent.start, sent.end] )
         span = doc[sent.start: sent.end]
 
-        # This generates the lowest common ancestry matrix for the dependency tree of the current sentence
-        lca = span.get_lca_matrix()
+        row_size = len(span)
 
-        row_size = len(lca[0])
-        parsetree_seq = []
+        # For all words, we use the shortest path in the dependency tree between adjacent words
+        parsetree_seq = adjacent_path_lengths(doc_heads[sent.start:sent.end] - sent.start).tolist()
 
-        for i in range(row_size-1):
-            # For all words, we use the lowest common ancestry (LCA) matrix
-            # to determine the shortest path between all adjacent words
-            # with LCA we just need to lookup the path to the common ancestor for the word i and i+1
-            common_parent = lca[i][i+1]
-            cur_node = span[i]
-            path_len = find_node(span[common_parent], cur_node)
-
-            cur_node = span[i+1]
-            path_len += find_node(span[common_parent], cur_node)
-    
-            parsetree_seq.append(path_len)
         # This is the score/reward for sentence end, we make it depended on the sentence length
         parsetree_seq.append(sentence_end_reward_factor * row_size)
 
@@ -98,21 +142,44 @@ def segment_beamsearch(text, model_spacy, beam_size=10, ideal_token_len=10, len_
     if debug_print:
         print(doc_parsetree_seqs)
 
-    num_doc_tokens = len(doc_parsetree_seqs)
-    assert(num_doc_tokens == len(doc))
+    return doc_parsetree_seqs
 
+# Boundary scorers compute the reward for a cut after every token of a doc:
+# 'parser' uses the shortest paths in the dependency tree and needs a parser model,
+# 'fast' only uses punctuation, sentence ends and word lists (see fast_scorer.py).
+boundary_scorers = {'parser': doc_parsetree_scores, 'fast': fast_boundary_scores}
 
-    # Beam search for a solution until there is no improvement
-    # This is classical beam search, for all candidates on the beam we expand
-    # and calculate the score for splitting at any position between +1 and
-    # we use the scores from doc_parsetree_seqs, longer shortest path = better point to split.
-    # So bigger number = better.
-    # Additionally we compute the difference to the ideal sequence length (in words currently) and add this to the score:
-    # (ideal length - |(ideal length - length)|)
+# Computes the cut rewards with the selected scorer. If pauses are given (the pause after every token in seconds,
+# e.g. from the word timings of the ASR), pause_reward_factor * pause is added to the reward of every cut.
+# Pauses longer than max_pause seconds are not rewarded any further.
+def boundary_scores(doc, scorer='parser', sentence_end_reward_factor=0.9, comma_end_reward_factor=0.5, pauses=None,
+                    pause_reward_factor=0.0, max_pause=2.0, debug_print=False):
+    if scorer not in boundary_scorers:
+        raise ValueError(f'Unknown boundary scorer: {scorer}')
+    doc_parsetree_seqs = boundary_scorers[scorer](doc, sentence_end_reward_factor=sentence_end_reward_factor,
+                                                  comma_end_reward_factor=comma_end_reward_factor,
+                                                  debug_print=debug_print)
+    if pauses is not None and pause_reward_factor:
+        doc_parsetree_seqs = [score + pause_reward_factor * min(pause, max_pause)
+                              for score, pause in zip(doc_parsetree_seqs, pauses)]
+    return doc_parsetree_seqs
 
-    # sequences are of this shape; first list keeps track of the split positions, seconds lists contains the spans
+# Beam search for a solution until there is no improvement
+# This is classical beam search, for all candidates on the beam we expand
+# and calculate the score for splitting at any position between +1 and max_lookahead.
+# We use the scores from doc_parsetree_seqs, longer shortest path = better point to split.
+# So bigger number = better.
+# Additionally we compute the difference to the ideal sequence length (in words currently) and add this to the score:
+# (ideal length - |(ideal length - length)|)
+#
+# Returns the cut positions (end of every segment) and the score of the best path.
+def beamsearch_cuts(doc_parsetree_seqs, beam_size=10, ideal_token_len=10, len_reward_factor=2.3, max_lookahead=40,
+                    debug_print=False):
+    num_doc_tokens = len(doc_parsetree_seqs)
+
+    # sequences are of this shape; first list keeps track of the split positions
     # the float value is the combined score for the complete path
-    sequences = [[list(), list(), 0.0]]
+    sequences = [[list(), 0.0]]
 
     cont_search = True
     while cont_search:
@@ -120,15 +187,15 @@ def segment_beamsearch(text, model_spacy, beam_size=10, ideal_token_len=10, len_
         cont_search = False
         # Expand each current candidate
         for i in range(len(sequences)):
-            seq_pos, spans, current_score = sequences[i]
+            seq_pos, current_score = sequences[i]
             last_cut = (seq_pos[-1] if (len(seq_pos) > 0) else 0)
-            score_at_k = sequences[-1][2]
+            score_at_k = sequences[-1][1]
             # search over all tokens, 1 to max_lookahead
             for j in range(1, min(max_lookahead, num_doc_tokens - last_cut -1)):
                 len_reward = len_reward_factor * (ideal_token_len - math.fabs(ideal_token_len - float(j)))
                 
                 new_score = current_score + len_reward + doc_parsetree_seqs[last_cut + j]
-                candidate = [seq_pos + [last_cut + j +1], spans + [doc[last_cut:last_cut + j +1]], new_score]
+                candidate = [seq_pos + [last_cut + j +1], new_score]
                 all_candidates.append(candidate)
 
                 # only continue the search, of atleast one of the candidates was better than the current score at k
@@ -136,24 +203,362 @@ def segment_beamsearch(text, model_spacy, beam_size=10, ideal_token_len=10, len_
                     cont_search = True
 
         # order all candidates by score
-        ordered = sorted(all_candidates, key=lambda tup:tup[2], reverse=True)
+        ordered = sorted(all_candidates, key=lambda tup:tup[1], reverse=True)
         # select k best
         sequences = ordered[:beam_size]
 
     if debug_print:
         for sequence in sequences:
-            print(sequence[2])
-  
-    best = sequences[0]
+            print(sequence[1])
+
+    return sequences[0]
+
+# Exact search (Viterbi / dynamic programming) for the best segmentation of the complete text.
+# Summing up the raw beam search rewards over a complete path would favour lots of tiny segments,
+# since every cut adds a positive reward. The beam search only avoids this because it stops early.
+# For the exact search we therefore subtract the maximal length reward from every cut, so that the
+# length reward becomes a penalty for the difference to the ideal length (see segmentation_score).
+# The score is a sum of independent per cut rewards, so the best path that ends with a cut at position c
+# only depends on the best path ending at c - length. best_score[c] is the best score of all paths
+# with a last cut at c and back_pointer[c] is the previous cut. This needs O(tokens * max_lookahead)
+# time and O(tokens) memory and never copies partial paths.
+#
+# Unlike the beam search, the last segment always ends with the last token of the text.
+# Returns the cut positions (end of every segment) and the score of the best path.
+def dp_cuts(doc_parsetree_seqs, ideal_token_len=10, len_reward_factor=2.3, max_lookahead=40):
+    num_doc_tokens = len(doc_parsetree_seqs)
+
+    # len_rewards[length] is the (negative) reward for a segment with length tokens
+    len_rewards = [segment_len_reward(length, ideal_token_len, len_reward_factor)
+                   for length in range(max_lookahead + 1)]
+
+    best_score = [0.0] + [-math.inf] * num_doc_tokens
+    back_pointer = [0] * (num_doc_tokens + 1)
+
+    for cut in range(1, num_doc_tokens + 1):
+        cut_score = -math.inf
+        cut_back_pointer = 0
+        for length in range(1, min(max_lookahead, cut) + 1):
+            score = best_score[cut - length] + len_rewards[length]
+            if score > cut_score:
+                cut_score = score
+                cut_back_pointer = cut - length
+        best_score[cut] = cut_score + doc_parsetree_seqs[cut - 1]
+        back_pointer[cut] = cut_back_pointer
+
+    # Follow the back pointers from the end of the text
+    seq_pos = []
+    cut = num_doc_tokens
+    while cut > 0:
+        seq_pos.append(cut)
+        cut = back_pointer[cut]
+    seq_pos.reverse()
+
+    return [seq_pos, best_score[num_doc_tokens]]
+
+# Length reward of the exact search for a segment with length tokens:
+# the beam search length reward minus its maximum (len_reward_factor * ideal_token_len)
+def segment_len_reward(length, ideal_token_len=10, len_reward_factor=2.3):
+    return -len_reward_factor * math.fabs(ideal_token_len - float(length - 1))
+
+# Score of a complete segmentation, as optimized by dp_cuts. If the cuts do not reach the end of the text,
+# the remaining tokens are scored as one last segment. Can be used to compare cuts of different searches.
+def segmentation_score(doc_parsetree_seqs, seq_pos, ideal_token_len=10, len_reward_factor=2.3):
+    num_doc_tokens = len(doc_parsetree_seqs)
+    if num_doc_tokens == 0:
+        return 0.0
+    if len(seq_pos) == 0 or seq_pos[-1] != num_doc_tokens:
+        seq_pos = seq_pos + [num_doc_tokens]
+
+    score = 0.0
+    last_cut = 0
+    for cut in seq_pos:
+        score += segment_len_reward(cut - last_cut, ideal_token_len, len_reward_factor) + doc_parsetree_seqs[cut - 1]
+        last_cut = cut
+    return score
+
+# Segments the given text
+
+# Options:
+# beam_size: what beam size to use for the segmentation search
+# ideal_token_len: the ideal length of tokens per segment
+# len_reward_factor: how important it is to be close to ideal_token_len,
+#                    higher factor = splits are closer to ideal_token_len
+# sentence_end_reward_factor: the weight of the sentence end score in the search.
+#                             Higher values make it more likely to always split at sentence end.
+# comma_end_reward_factor: the weight of the comma end score in the search.
+#                             Higher values make it more likely to always split at sentence end.
+# max_lookahead: maximum lookahead for the beam search, this is also the maximum length of one segment
+# search: 'beam' for the beam search or 'dp' for the exact dynamic programming search (beam_size is ignored)
+# scorer: 'parser' for the dependency tree based cut rewards or 'fast' for the parser-free cut rewards
+#         (model_spacy must be loaded with the same scorer)
+# debug_print: print additional debug info
+
+def segment_beamsearch(text, model_spacy, beam_size=10, ideal_token_len=10, len_reward_factor=2.3,
+                   sentence_end_reward_factor=0.9, comma_end_reward_factor=0.5, max_lookahead=40, search='beam',
+                   scorer='parser', debug_print=False):
+
+    # if model_spacy is just the model name, then load the model (or get it from the cache)
+    # otherwise assume model_spacy is preloaded outside of this function
+    if type(model_spacy) is str:
+        segment_nlp = load_spacy_model(model_spacy, scorer=scorer)
+    else:
+        segment_nlp = model_spacy
+    doc = segment_nlp(text)
+
+    spans = segment_doc(doc, beam_size=beam_size, ideal_token_len=ideal_token_len,
+                        len_reward_factor=len_reward_factor, sentence_end_reward_factor=sentence_end_reward_factor,
+                        comma_end_reward_factor=comma_end_reward_factor, max_lookahead=max_lookahead, search=search,
+                        scorer=scorer, debug_print=debug_print)
+
+    return [sp.text for sp in spans]
+
+# Segments a parsed doc, same options as segment_beamsearch. Returns the segments as spans of the doc.
+# pauses and pause_reward_factor are passed on to boundary_scores.
+def segment_doc(doc, beam_size=10, ideal_token_len=10, len_reward_factor=2.3, sentence_end_reward_factor=0.9,
+                comma_end_reward_factor=0.5, max_lookahead=40, search='beam', scorer='parser', pauses=None,
+                pause_reward_factor=0.0, debug_print=False):
+
+    doc_parsetree_seqs = boundary_scores(doc, scorer=scorer, sentence_end_reward_factor=sentence_end_reward_factor,
+                                         comma_end_reward_factor=comma_end_reward_factor, pauses=pauses,
+                                         pause_reward_factor=pause_reward_factor, debug_print=debug_print)
+
+    num_doc_tokens = len(doc_parsetree_seqs)
+    assert(num_doc_tokens == len(doc))
+
+    best = search_cuts(doc_parsetree_seqs, beam_size=beam_size, ideal_token_len=ideal_token_len,
+                       len_reward_factor=len_reward_factor, max_lookahead=max_lookahead, search=search,
+                       debug_print=debug_print)
+
+    spans = cuts_to_spans(doc, best[0])
 
     if debug_print:
-        for span in best[1]:
+        print('best score:', best[1])
+        for span in spans:
             print(span.text)
 
-    return [sp.text for sp in best[1]]
+    return spans
+
+# Punctuation that is split off the end of words, so that the parser sees it as a separate token
+split_punctuation = ('.', ',', '?', '!', ':', ';')
+
+# Creates a doc directly from a list of words (e.g. ASR output), without running spaCy's tokenizer.
+# Trailing punctuation is split off into its own token, everything else is one token per word.
+# Returns the parsed doc and for every token the index of the word it belongs to.
+def words_to_doc(segment_nlp, words):
+    tokens = []
+    spaces = []
+    token_words = []
+    for i, word in enumerate(words):
+        # Empty words don't get a token, they are added to the segment of the word before
+        if not word:
+            continue
+        word_tokens = [word]
+        if len(word) > 1 and word.endswith(split_punctuation):
+            word_tokens = [word[:-1], word[-1]]
+        tokens += word_tokens
+        spaces += [False] * (len(word_tokens) - 1) + [True]
+        token_words += [i] * len(word_tokens)
+    if spaces:
+        spaces[-1] = False
+
+    doc = segment_nlp(Doc(segment_nlp.vocab, words=tokens, spaces=spaces))
+    return doc, token_words
+
+# Maps the spans of a doc created with words_to_doc to (start, end) ranges of word indices.
+# If a span ends within a word (e.g. before a comma that was split off), the complete word belongs to this span.
+# Spans that do not contain the start of a word are skipped.
+def spans_to_word_ranges(spans, token_words, num_words):
+    num_tokens = len(token_words)
+
+    # Index of the first word that starts at or after token position
+    def word_cut(position):
+        if position == 0:
+            return 0
+        if position >= num_tokens:
+            return num_words
+        if token_words[position] == token_words[position - 1]:
+            return token_words[position] + 1
+        return token_words[position]
+
+    word_ranges = []
+    for span in spans:
+        start_word, end_word = word_cut(span.start), word_cut(span.end)
+        if end_word > start_word:
+            word_ranges.append((start_word, end_word))
+    return word_ranges
+
+# Segments a list of words (e.g. a complete Kaldi transcript), same options as segment_beamsearch.
+# word_pauses is optional, the pause after every word in seconds.
+# Returns the segments as (start, end) ranges of word indices, so that word timings can be looked up directly.
+def segment_words(words, model_spacy, beam_size=10, ideal_token_len=10, len_reward_factor=2.3,
+                  sentence_end_reward_factor=0.9, comma_end_reward_factor=0.5, max_lookahead=40, search='beam',
+                  scorer='parser', word_pauses=None, pause_reward_factor=0.0):
+
+    if type(model_spacy) is str:
+        segment_nlp = load_spacy_model(model_spacy, scorer=scorer)
+    else:
+        segment_nlp = model_spacy
+
+    doc, token_words = words_to_doc(segment_nlp, words)
+
+    # The pause after a word belongs to its last token, there is no pause between the word and its punctuation
+    pauses = None
+    if word_pauses is not None:
+        pauses = [0.0 if i + 1 < len(token_words) and token_words[i + 1] == word else word_pauses[word]
+                  for i, word in enumerate(token_words)]
+
+    spans = segment_doc(doc, beam_size=beam_size, ideal_token_len=ideal_token_len,
+                        len_reward_factor=len_reward_factor, sentence_end_reward_factor=sentence_end_reward_factor,
+                        comma_end_reward_factor=comma_end_reward_factor, max_lookahead=max_lookahead, search=search,
+                        scorer=scorer, pauses=pauses, pause_reward_factor=pause_reward_factor)
+    return spans_to_word_ranges(spans, token_words, len(words))
+
+# Segments a long list of words (e.g. a complete Kaldi transcript) in overlapping windows, so that spaCy never
+# has to parse the complete text at once. Every window contains window_sentences + overlap_sentences sentences,
+# where a sentence ends with a word that ends with '.', '?' or '!'. Only the segments that end within the first
+# window_sentences sentences are kept, the next window starts after the last kept segment.
+# This is a generator that yields the segments as (start, end) ranges of word indices as soon as a window
+# is finished, so memory only depends on the window size and not on the length of the text.
+# Same options as segment_beamsearch.
+def segment_windows(words, model_spacy, window_sentences=50, overlap_sentences=5, beam_size=10, ideal_token_len=10,
+                    len_reward_factor=2.3, sentence_end_reward_factor=0.9, comma_end_reward_factor=0.5,
+                    max_lookahead=40, search='beam', scorer='parser', word_pauses=None, pause_reward_factor=0.0):
+
+    if type(model_spacy) is str:
+        segment_nlp = load_spacy_model(model_spacy, scorer=scorer)
+    else:
+        segment_nlp = model_spacy
+
+    num_words = len(words)
+    # Word positions after every sentence end, the end of the text is always a sentence end
+    sentence_ends = [i + 1 for i, word in enumerate(words) if word.endswith(('.', '?', '!'))]
+    if not sentence_ends or sentence_ends[-1] != num_words:
+        sentence_ends.append(num_words)
+
+    pos = 0
+    while pos < num_words:
+        sentence_idx = bisect.bisect_right(sentence_ends, pos)
+        commit_end = sentence_ends[min(sentence_idx + window_sentences - 1, len(sentence_ends) - 1)]
+        window_end = sentence_ends[min(sentence_idx + window_sentences + overlap_sentences - 1,
+                                       len(sentence_ends) - 1)]
+
+        word_ranges = segment_words(words[pos:window_end], segment_nlp, beam_size=beam_size,
+                                    ideal_token_len=ideal_token_len, len_reward_factor=len_reward_factor,
+                                    sentence_end_reward_factor=sentence_end_reward_factor,
+                                    comma_end_reward_factor=comma_end_reward_factor, max_lookahead=max_lookahead,
+                                    search=search, scorer=scorer,
+                                    word_pauses=None if word_pauses is None else word_pauses[pos:window_end],
+                                    pause_reward_factor=pause_reward_factor)
+
+        # The last window, we keep everything
+        if window_end == num_words:
+            for start_word, end_word in word_ranges:
+                yield pos + start_word, pos + end_word
+            break
+
+        kept = [word_range for word_range in word_ranges if word_range[1] <= commit_end - pos]
+        # Make sure that we always make progress
+        if not kept:
+            kept = word_ranges[:1]
+        if not kept:
+            kept = [(0, commit_end - pos)]
+
+        for start_word, end_word in kept:
+            yield pos + start_word, pos + end_word
+        pos += kept[-1][1]
+
+# Runs the selected search ('beam' or 'dp') over the cut rewards, returns the cut positions and the score
+def search_cuts(doc_parsetree_seqs, beam_size=10, ideal_token_len=10, len_reward_factor=2.3, max_lookahead=40,
+                search='beam', debug_print=False):
+    if search == 'beam':
+        return beamsearch_cuts(doc_parsetree_seqs, beam_size=beam_size, ideal_token_len=ideal_token_len,
+                               len_reward_factor=len_reward_factor, max_lookahead=max_lookahead,
+                               debug_print=debug_print)
+    elif search == 'dp':
+        return dp_cuts(doc_parsetree_seqs, ideal_token_len=ideal_token_len, len_reward_factor=len_reward_factor,
+                       max_lookahead=max_lookahead)
+    else:
+        raise ValueError(f'Unknown segmentation search: {search}')
+
+# Worker function for segment_texts, returns the exception instead of raising it,
+# so that one failed text does not stop the segmentation of the others
+def search_cuts_or_exception(search_args):
+    try:
+        return search_cuts(*search_args)
+    except Exception as e:
+        return e
+
+# The spans between the cut positions
+def cuts_to_spans(doc, seq_pos):
+    return [doc[start:end] for start, end in zip([0] + seq_pos[:-1], seq_pos)]
+
+# Parses all texts with nlp.pipe. If this fails, all texts are parsed separately,
+# so that only the texts that can't be parsed are lost. Returns a Doc or an exception for every text.
+def parse_texts(segment_nlp, texts, batch_size=16, n_process=1):
+    try:
+        return list(segment_nlp.pipe(texts, batch_size=batch_size, n_process=n_process))
+    except Exception:
+        traceback.print_exc()
+
+    docs = []
+    for text in texts:
+        try:
+            docs.append(segment_nlp(text))
+        except Exception as e:
+            docs.append(e)
+    return docs
+
+# Segments a list of texts (e.g. the paragraphs of a Speechcatcher transcript), same options as segment_beamsearch.
+# All texts are parsed in batches with nlp.pipe (with n_process parser processes) and the cut search of all texts
+# is distributed over num_workers processes. Returns the segments for every text, in the same order as texts.
+# If a text could not be segmented, the exception is returned in its place instead.
+def segment_texts(texts, model_spacy, beam_size=10, ideal_token_len=10, len_reward_factor=2.3,
+                  sentence_end_reward_factor=0.9, comma_end_reward_factor=0.5, max_lookahead=40, search='beam',
+                  scorer='parser', batch_size=16, n_process=1, num_workers=1):
+
+    if type(model_spacy) is str:
+        segment_nlp = load_spacy_model(model_spacy, scorer=scorer)
+    else:
+        segment_nlp = model_spacy
+    docs = parse_texts(segment_nlp, texts, batch_size=batch_size, n_process=n_process)
+
+    # The cut rewards are cheap to compute, only the (much smaller) rewards are sent to the worker processes
+    search_args = []
+    for i, doc in enumerate(docs):
+        if isinstance(doc, Exception):
+            continue
+        try:
+            doc_parsetree_seqs = boundary_scores(doc, scorer=scorer,
+                                                 sentence_end_reward_factor=sentence_end_reward_factor,
+                                                 comma_end_reward_factor=comma_end_reward_factor)
+        except Exception as e:
+            docs[i] = e
+            continue
+        search_args.append((doc_parsetree_seqs, beam_size, ideal_token_len, len_reward_factor, max_lookahead,
+                            search))
+
+    if num_workers > 1 and len(search_args) > 1:
+        with multiprocessing.Pool(min(num_workers, len(search_args))) as pool:
+            search_results = pool.map(search_cuts_or_exception, search_args)
+    else:
+        search_results = [search_cuts_or_exception(args) for args in search_args]
+
+    segments = []
+    search_results = iter(search_results)
+    for doc in docs:
+        if isinstance(doc, Exception):
+            segments.append(doc)
+            continue
+        best = next(search_results)
+        if isinstance(best, Exception):
+            segments.append(best)
+        else:
+            segments.append([sp.text for sp in cuts_to_spans(doc, best[0])])
+    return segments
 
 if __name__ == "__main__":
-    segment_nlp = spacy.load('de_core_news_lg')
+    segment_nlp = load_spacy_model('de_core_news_lg')
     print('test input')
     print(test)
 
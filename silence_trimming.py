@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    Copyright 2023 Lecture2Go, Dr. Benjamin Milde
+#
+#    Licensed under the Apache License, Version 2.0 (the 'License');
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an 'AS IS' BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Optional pre-stage for all ASR engines: long silent stretches of a recording (breaks, setup, pauses in a Q&A)
+# are removed before the ASR, so that they are not decoded. Silence is found with the smoothed frame power of
+# the endpointing (see simple_endpointing.audio_energy). The ASR engines decode the trimmed audio, and all
+# word, token and cue timestamps are mapped back to the time of the original media file with a time offset map.
+
+import os
+import wave
+
+import numpy as np
+
+from simple_endpointing import audio_energy
+
+# Frames of the frame power per second
+frame_rate = 100
+
+# Default: a frame is silent, if its smoothed power is more than this many dB below the level of the speech
+default_threshold_db = 25.0
+
+# Silence that is kept at both sides of a removed silent stretch, in seconds, so that words are never cut
+default_padding = 0.5
+
+
+# Finds the parts of the audio that are kept, as a list of (start_sample, end_sample) ranges.
+# Every silent stretch longer than min_silence seconds is removed, except for padding seconds at both sides.
+# The level of the speech is the 95th percentile of the smoothed frame power, so it doesn't depend on the
+# recording volume.
+def find_speech_ranges(data, samplerate, min_silence=2.0, threshold_db=default_threshold_db,
+                       padding=default_padding):
+    num_samples = len(data)
+    power = audio_energy(data, samplerate)
+    if num_samples == 0 or len(power) == 0:
+        return [(0, num_samples)]
+
+    # The power is the sum of the natural log energies of 26 filterbanks divided by 10, so one dB of
+    # the mean filterbank energy is 2.6 / (10 / ln(10)) of the power
+    threshold = np.percentile(power, 95) - threshold_db * 2.6 * np.log(10) / 10.
+    silent = np.concatenate([[False], power < threshold, [False]])
+    # Start and end frames of all silent stretches
+    edges = np.flatnonzero(np.diff(silent.astype(np.int8)))
+    starts, ends = edges[::2].tolist(), edges[1::2].tolist()
+
+    frame_step = samplerate // frame_rate
+    min_frames = int(min_silence * frame_rate)
+    padding_samples = int(padding * samplerate)
+
+    speech_ranges = []
+    speech_start = 0
+    for start, end in zip(starts, ends):
+        if end - start < min_frames:
+            continue
+        silence_start = start * frame_step + padding_samples
+        silence_end = min(end * frame_step, num_samples) - padding_samples
+        if silence_end <= silence_start:
+            continue
+        if silence_start > speech_start:
+            speech_ranges.append((speech_start, silence_start))
+        speech_start = silence_end
+    if speech_start < num_samples:
+        speech_ranges.append((speech_start, num_samples))
+
+    # Nothing but silence, keep everything
+    if not speech_ranges:
+        return [(0, num_samples)]
+    return speech_ranges
+
+
+# The time offset map of the kept ranges: [trimmed_start, original_start] in seconds for every kept range
+def time_offset_map(speech_ranges, samplerate):
+    time_offsets = []
+    trimmed_start = 0
+    for start, end in speech_ranges:
+        time_offsets.append([trimmed_start / samplerate, start / samplerate])
+        trimmed_start += end - start
+    return time_offsets
+
+
+# Maps a list of times (in seconds) of the trimmed audio back to the time of the original media file
+def map_times(times, time_offsets):
+    if not time_offsets:
+        return list(times)
+    times = np.asarray(times, dtype=np.float64)
+    trimmed_starts, original_starts = np.asarray(time_offsets, dtype=np.float64).reshape(-1, 2).T
+    idx = np.maximum(np.searchsorted(trimmed_starts, times, side='right') - 1, 0)
+    return (times - trimmed_starts[idx] + original_starts[idx]).tolist()
+
+
+# Number of seconds of the original audio that are not in the kept ranges
+def skipped_seconds(speech_ranges, num_samples, samplerate):
+    return (num_samples - sum(end - start for start, end in speech_ranges)) / samplerate
+
+
+# The kept ranges of data, as one array
+def trimmed_audio(data, speech_ranges):
+    return np.concatenate([data[start:end] for start, end in speech_ranges])
+
+
+# Writes the kept ranges of data as 16 bit mono wav file, range by range, without a copy of the audio in memory.
+# The file is written under a temporary name and renamed, so wav_filename can also be a symlink to the
+# (memory mapped) data: the symlink is replaced, its target is not changed.
+def write_trimmed_wav(wav_filename, data, samplerate, speech_ranges, block_size=1024*1024):
+    tmp_filename = wav_filename + '.part'
+    with wave.open(tmp_filename, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(samplerate)
+        for start, end in speech_ranges:
+            for block_start in range(start, end, block_size):
+                wav_file.writeframes(np.ascontiguousarray(data[block_start:min(block_start + block_size, end)],
+                                                          dtype='<i2').tobytes())
+    os.replace(tmp_filename, wav_filename)
+
+
+# Finds and reports the silence of data. Returns the kept ranges and the time offset map,
+# or None for both if min_silence is 0 (trimming disabled).
+def silence_trimming(data, samplerate, min_silence=0.0, threshold_db=default_threshold_db, status=None):
+    if min_silence <= 0:
+        return None, None
+
+    speech_ranges = find_speech_ranges(data, samplerate, min_silence=min_silence, threshold_db=threshold_db)
+    skipped = skipped_seconds(speech_ranges, len(data), samplerate)
+    total = len(data) / samplerate
+    message = (f'Silence trimming: skipped {skipped:.1f} of {total:.1f} seconds of audio'
+               f' ({100. * skipped / max(total, 1e-9):.1f}%).')
+    print(message)
+    if status:
+        status.publish_status(message)
+
+    return speech_ranges, time_offset_map(speech_ranges, samplerate)
@@ -23,41 +23,140 @@ import ffmpeg
 
 import math
 from python_speech_features import logfbank
-from scipy.ndimage import gaussian_filter1d
+from python_speech_features.base import get_filterbanks
+from python_speech_features.sigproc import round_half_up
+from scipy.ndimage import gaussian_filter1d, maximum_filter1d
 import audiosegment
 import numpy as np
 
-# All timing are in frames, where one frame is 0.01 seconds.
-def process_wav(wav_filename, beam_size=10, ideal_segment_len=1000*4,
-                max_lookahead=100*180, min_len=1000*2, step=10, len_reward = 40, debug=False):
+# Streaming version of logfbank(data, samplerate, winlen, winstep, nfilt, nfft, preemph=preemph).sum(axis=-1) / 10.,
+# the power of every frame. The frames are computed in blocks of block_frames frames, so data can be a memory mapped
+# array and only the samples of one block are in memory at a time. Yields the power of every block.
+def frame_power_blocks(data, samplerate, winlen=0.025, winstep=0.01, nfilt=26, nfft=512, preemph=0.97,
+                       block_frames=1000):
+    frame_len = int(round_half_up(winlen * samplerate))
+    frame_step = int(round_half_up(winstep * samplerate))
+    num_samples = len(data)
+    if num_samples <= frame_len:
+        num_frames = 1
+    else:
+        num_frames = 1 + int(math.ceil((1.0 * num_samples - frame_len) / frame_step))
 
-    samplerate, data = wavfile.read(wav_filename, mmap=False)
-    fbank_feat = logfbank(data, samplerate=samplerate, winlen=0.025, winstep=0.01)
-    fbank_feat_power = fbank_feat.sum(axis=-1) / 10.
-    
-    fbank_feat_len = len(fbank_feat)
+    filterbanks = get_filterbanks(nfilt, nfft, samplerate, 0, samplerate / 2).T
+    for block_start in range(0, num_frames, block_frames):
+        block_end = min(block_start + block_frames, num_frames)
+        sample_start = block_start * frame_step
+        sample_end = (block_end - 1) * frame_step + frame_len
 
-    fbank_feat_min_power = min(fbank_feat_power)
-    fbank_feat_max_power = max(fbank_feat_power)
+        # Preemphasis needs the sample before the block, the first sample of the file is kept as it is
+        signal = np.asarray(data[max(sample_start - 1, 0):sample_end], dtype=np.float64)
+        emphasized = signal[1:] - preemph * signal[:-1]
+        if sample_start == 0:
+            emphasized = np.append(signal[0], emphasized)
+        # The last frames are padded with zeros
+        emphasized = np.append(emphasized, np.zeros(sample_end - sample_start - len(emphasized)))
 
-    fbank_feat_power_smoothed = gaussian_filter1d(fbank_feat_power, sigma=20) * -1.0
-    
-    if debug:
-        import pylab as plt
+        yield frames_power(emphasized, block_end - block_start, frame_len, frame_step, filterbanks, nfft)
 
-        print('min:', fbank_feat_min_power, 'max:', fbank_feat_max_power)
+# The power of the first num_frames frames of the preemphasized signal, as in logfbank(...).sum(axis=-1) / 10.
+def frames_power(emphasized, num_frames, frame_len, frame_step, filterbanks, nfft):
+    frames = emphasized[(np.arange(num_frames) * frame_step)[:, None] + np.arange(frame_len)[None, :]]
+    power_spectrum = 1.0 / nfft * np.square(np.absolute(np.fft.rfft(frames, nfft)))
+    feat = np.dot(power_spectrum, filterbanks)
+    feat = np.where(feat == 0, np.finfo(float).eps, feat)
+    return np.log(feat).sum(axis=-1) / 10.
 
-        plt.imshow(fbank_feat[:1000].T, interpolation=None, aspect='auto', origin='lower')
-        plt.show()
-        plt.plot(fbank_feat_power_smoothed[:1000])
-        plt.show()
+# Same as frame_power_blocks, but for a stream of sample blocks (e.g. from ffmpeg) of unknown total length.
+# The power of every frame is yielded as soon as all of its samples have been read, the last frames
+# are padded with zeros at the end of the stream. The result is exactly the same as with frame_power_blocks.
+def stream_frame_power_blocks(sample_blocks, samplerate, winlen=0.025, winstep=0.01, nfilt=26, nfft=512,
+                              preemph=0.97):
+    frame_len = int(round_half_up(winlen * samplerate))
+    frame_step = int(round_half_up(winstep * samplerate))
+    filterbanks = get_filterbanks(nfilt, nfft, samplerate, 0, samplerate / 2).T
+
+    # The preemphasized samples, starting with the first sample of the next frame
+    emphasized = np.zeros(0)
+    last_sample = None
+    num_samples = 0
+    num_frames_done = 0
+    for block in sample_blocks:
+        signal = np.asarray(block, dtype=np.float64)
+        if len(signal) == 0:
+            continue
+        if last_sample is None:
+            # The first sample of the stream is kept as it is
+            block_emphasized = np.append(signal[0], signal[1:] - preemph * signal[:-1])
+        else:
+            block_emphasized = signal - preemph * np.append(last_sample, signal[:-1])
+        last_sample = signal[-1]
+        num_samples += len(signal)
+        emphasized = np.concatenate([emphasized, block_emphasized])
+
+        # All frames that are complete
+        if len(emphasized) >= frame_len:
+            num_frames = (len(emphasized) - frame_len) // frame_step + 1
+            yield frames_power(emphasized, num_frames, frame_len, frame_step, filterbanks, nfft)
+            emphasized = emphasized[num_frames * frame_step:]
+            num_frames_done += num_frames
+
+    if num_samples == 0:
+        return
+    if num_samples <= frame_len:
+        total_frames = 1
+    else:
+        total_frames = 1 + int(math.ceil((1.0 * num_samples - frame_len) / frame_step))
+    num_frames = total_frames - num_frames_done
+    if num_frames > 0:
+        # The last frames are padded with zeros
+        emphasized = np.append(emphasized, np.zeros((num_frames - 1) * frame_step + frame_len - len(emphasized)))
+        yield frames_power(emphasized, num_frames, frame_len, frame_step, filterbanks, nfft)
+
+# Streaming version of gaussian_filter1d (with its default reflect mode), applied to a stream of blocks.
+# Every block is filtered together with the filter radius of the values before and after it,
+# so the result is exactly the same as filtering the concatenation of all blocks. Yields the filtered values.
+def gaussian_filter_blocks(blocks, sigma=20, truncate=4.0):
+    radius = int(truncate * float(sigma) + 0.5)
+    history = np.zeros(0)
+    pending = np.zeros(0)
+    for block in blocks:
+        pending = np.concatenate([pending, block])
+        num_out = len(pending) - radius
+        if num_out <= 0:
+            continue
+        context = np.concatenate([history, pending])
+        yield gaussian_filter1d(context, sigma=sigma, truncate=truncate)[len(history):len(history) + num_out]
+        history = context[:len(history) + num_out][-radius:]
+        pending = pending[num_out:]
+
+    if len(pending) > 0:
+        context = np.concatenate([history, pending])
+        yield gaussian_filter1d(context, sigma=sigma, truncate=truncate)[len(history):]
+
+# The smoothed frame power of the samples in data (e.g. a memory mapped array), computed in blocks
+# with constant memory apart from the result (one float per frame).
+def audio_energy(data, samplerate, sigma=20, block_frames=1000):
+    power_blocks = frame_power_blocks(data, samplerate, block_frames=block_frames)
+    return np.concatenate(list(gaussian_filter_blocks(power_blocks, sigma=sigma)))
+
+# The smoothed and negated frame power for the endpointing search, computed with constant memory
+# (apart from the result, one float per frame) from a memory mapped wav file.
+def wav_energy(wav_filename, sigma=20, block_frames=1000):
+    samplerate, data = wavfile.read(wav_filename, mmap=True)
+    return audio_energy(data, samplerate, sigma=sigma, block_frames=block_frames) * -1.0
+
+# Simple Beam search to find good cuts, where the eneregy is low and where its
+# still close to the ideal segment length.
+# fbank_feat_power_smoothed is the smoothed and negated power of every frame, higher = better place for a cut.
+# Returns the cut positions (starting with 0) and the score of the best path.
+def beamsearch_endpoints(fbank_feat_power_smoothed, beam_size=10, ideal_segment_len=1000*4,
+                         max_lookahead=100*180, min_len=1000*2, step=10, len_reward=40):
+    fbank_feat_len = len(fbank_feat_power_smoothed)
 
     cont_search = True
 
     len_reward_factor = len_reward / float(ideal_segment_len)
 
-    # Simple Beam search to find good cuts, where the eneregy is low and where its
-    # still close to the ideal segment length.
     # Sequences are of this shape; first list keeps track of the split positions,
     # the float value is the combined score for the complete path.
     sequences = [[[0], 0.0]]
@@ -89,17 +188,142 @@ def process_wav(wav_filename, beam_size=10, ideal_segment_len=1000*4,
         sequences_ordered = ordered[:beam_size]
         sequences = sequences_ordered
 
+    return sequences_ordered[0]
+
+# For every i, the maximum of x[i], x[i - step], ..., x[i - (width-1) * step] (ignoring negative indices)
+def strided_window_max(x, step, width):
+    num_rows = -(-len(x) // step)
+    padded = np.full(num_rows * step, -np.inf)
+    padded[:len(x)] = x
+    # Every column of the rows is one residue class modulo step, the window runs over the rows
+    window_max = maximum_filter1d(padded.reshape(num_rows, step), size=width, axis=0,
+                                  origin=(width - 1) // 2, mode='constant', cval=-np.inf)
+    return window_max.reshape(-1)[:len(x)]
+
+# Exact dynamic programming (Viterbi) search over the same cuts as beamsearch_endpoints, same options
+# (except beam_size). A segment from the last cut q to the next cut p = q + j + 1, with j in
+# range(min_len, max_lookahead, step), scores len_reward_factor * (ideal_segment_len - |ideal_segment_len - j|)
+# plus the smoothed power at frame p - 1. As in the beam search, the best path can end at any cut and the frames
+# after the last cut are not scored. The score is always at least as good as the score of the beam search.
+#
+# The length reward is linear in the predecessor q, separately for j <= ideal_segment_len and j >= ideal_segment_len.
+# So the best predecessor of p is a maximum over a window of every step-th frame before p, which is computed for
+# blocks of min_len + 1 frames at once (they only depend on frames before the block) with a sliding maximum.
+# This makes the search linear in the number of frames and independent of the number of lookaheads.
+# Returns the cut positions (starting with 0) and the score of the best path.
+def dp_endpoints(fbank_feat_power_smoothed, ideal_segment_len=1000*4, max_lookahead=100*180, min_len=1000*2,
+                 step=10, len_reward=40):
+    fbank_feat_len = len(fbank_feat_power_smoothed)
+    fbank_feat_power_smoothed = np.asarray(fbank_feat_power_smoothed, dtype=np.float64)
+
+    # The beam search can't make a segment longer than the audio minus one frame
+    lookaheads = np.arange(min_len, min(max_lookahead, fbank_feat_len - 1), step)
+    if len(lookaheads) == 0:
+        return [[0], 0.0]
+
+    len_reward_factor = len_reward / float(ideal_segment_len)
+    len_rewards = len_reward_factor * (ideal_segment_len - np.abs(ideal_segment_len - lookaheads.astype(np.float64)))
+    num_lookaheads = len(lookaheads)
+    num_rising = int(np.sum(lookaheads <= ideal_segment_len))
+    max_j = int(lookaheads[-1])
+
+    best_scores = np.full(fbank_feat_len, -np.inf)
+    best_scores[0] = 0.0
+
+    block_size = min_len + 1
+    for block_start in range(1, fbank_feat_len, block_size):
+        block_end = min(block_start + block_size, fbank_feat_len)
+        positions = np.arange(block_start, block_end)
+
+        # All predecessors q = p - 1 - j of the block
+        prev_start = block_start - 1 - max_j
+        prev_positions = np.arange(prev_start, block_end - 1 - min_len)
+        prev_scores = np.where(prev_positions >= 0, best_scores[np.maximum(prev_positions, 0)], -np.inf)
+        # Index of the nearest predecessor (j = min_len) of every position of the block
+        nearest = positions - 1 - min_len - prev_start
+
+        # j <= ideal_segment_len: len_reward_factor * j = len_reward_factor * (p - 1) - len_reward_factor * q
+        rising = strided_window_max(prev_scores - len_reward_factor * prev_positions, step, num_rising)
+        candidates = len_reward_factor * (positions - 1) + rising[nearest]
+        # j > ideal_segment_len: len_reward_factor * (2 * ideal_segment_len - j)
+        if num_rising < num_lookaheads:
+            falling = strided_window_max(prev_scores + len_reward_factor * prev_positions, step,
+                                         num_lookaheads - num_rising)
+            candidates = np.maximum(candidates, len_reward_factor * (2 * ideal_segment_len - (positions - 1))
+                                    + falling[nearest - num_rising * step])
+
+        best_scores[block_start:block_end] = candidates + fbank_feat_power_smoothed[positions - 1]
+
+    # Backtrack from the best position, the best predecessor of a cut is recomputed from the best scores
+    cut = int(np.argmax(best_scores))
+    score = float(best_scores[cut])
+    cuts = [cut]
+    while cut != 0:
+        prev_cuts = cut - 1 - lookaheads
+        prev_scores = np.where(prev_cuts >= 0, best_scores[np.maximum(prev_cuts, 0)], -np.inf) + len_rewards
+        cut = int(prev_cuts[np.argmax(prev_scores)])
+        cuts.append(cut)
+    return [cuts[::-1], score]
+
+# Online version of the endpointing search for a stream of blocks of the smoothed and negated frame power.
+# The search runs over a window of horizon frames after the last cut, the cuts in the first
+# horizon - max_lookahead frames of the window (at least one) are final and the window moves on to the last of them.
+# At the end of the stream, the rest is searched at once. Yields the (start, end) segments in frames,
+# the same as cuts_to_segments, as soon as they are final. The default horizon is two max_lookaheads.
+def online_endpoints(power_blocks, beam_size=10, ideal_segment_len=1000*4, max_lookahead=100*180, min_len=1000*2,
+                     step=10, len_reward=40, search='beam', horizon=None):
+    if horizon is None:
+        horizon = 2 * max_lookahead
+
+    def search_cuts(fbank_feat_power_smoothed):
+        if search == 'beam':
+            return beamsearch_endpoints(fbank_feat_power_smoothed, beam_size=beam_size,
+                                        ideal_segment_len=ideal_segment_len, max_lookahead=max_lookahead,
+                                        min_len=min_len, step=step, len_reward=len_reward)[0]
+        elif search == 'dp':
+            return dp_endpoints(fbank_feat_power_smoothed, ideal_segment_len=ideal_segment_len,
+                                max_lookahead=max_lookahead, min_len=min_len, step=step, len_reward=len_reward)[0]
+        raise ValueError(f'Unknown endpointing search: {search}')
+
+    window = np.zeros(0)
+    # Absolute frame of the first frame of the window, this is the last cut
+    window_start = 0
+    fbank_feat_len = 0
+    for block in power_blocks:
+        window = np.concatenate([window, block])
+        fbank_feat_len += len(block)
+        while len(window) >= horizon:
+            cuts = search_cuts(window[:horizon])[1:]
+            final_cuts = [cut for cut in cuts if cut <= horizon - max_lookahead] or cuts[:1]
+            if not final_cuts:
+                break
+            for last_cut, cut in zip([0] + final_cuts[:-1], final_cuts):
+                # This prevents the overlapping of segments
+                yield (window_start + last_cut + (window_start + last_cut != 0), window_start + cut)
+            window_start += final_cuts[-1]
+            window = window[final_cuts[-1]:]
+
+    cuts = search_cuts(window)[1:]
+    # This can happen with very short input wavs
+    if window_start == 0 and not cuts:
+        yield (0, fbank_feat_len)
+    for last_cut, cut in zip([0] + cuts[:-1], cuts):
+        yield (window_start + last_cut + (window_start + last_cut != 0), window_start + cut)
+
+# Converts the cut positions of the search to (start, end) segments in frames
+def cuts_to_segments(cuts, fbank_feat_len):
     # This can happen with very short input wavs
-    if len(sequences_ordered[0][0]) <= 1:
+    if len(cuts) <= 1:
         segments = [(0, fbank_feat_len)]
     else:
-        best_cuts = sequences_ordered[0]
-        segments = list(zip(best_cuts[0][:-1], best_cuts[0][1:]))
+        segments = list(zip(cuts[:-1], cuts[1:]))
     
     # This prevents the overlapping of segments
     segments = [(x[0]+1, x[1]) if x[0]!=0 else (x[0], x[1]) for x in segments]
-    
-    # Write wave segments
+    return segments
+
+# Writes the segments in Kaldi's segments file format next to the wav file, returns the segments filename
+def write_segments(wav_filename, segments):
     filenameS = wav_filename.rpartition('.')[0] # Filename without file extension
     filenameRS = filenameS.partition('/')[2]
     
@@ -114,6 +338,43 @@ def process_wav(wav_filename, beam_size=10, ideal_segment_len=1000*4,
         count+=1
     with open(segmentsFN, 'w') as f:
         f.write(text)
+    return segmentsFN
+
+# All timing are in frames, where one frame is 0.01 seconds.
+# search: 'beam' for the beam search or 'dp' for the exact dynamic programming search (beam_size is ignored)
+def process_wav(wav_filename, beam_size=10, ideal_segment_len=1000*4,
+                max_lookahead=100*180, min_len=1000*2, step=10, len_reward = 40, search='beam', debug=False):
+
+    # The wav file is memory mapped and the frame power is computed in blocks, so that long recordings
+    # don't need the filterbank features of the complete file in memory
+    samplerate, data = wavfile.read(wav_filename, mmap=True)
+    fbank_feat_power_smoothed = wav_energy(wav_filename, sigma=20)
+
+    fbank_feat_len = len(fbank_feat_power_smoothed)
+
+    if debug:
+        import pylab as plt
+
+        fbank_feat_power = np.concatenate(list(frame_power_blocks(data, samplerate)))
+        print('min:', min(fbank_feat_power), 'max:', max(fbank_feat_power))
+
+        fbank_feat = logfbank(data[:1000 * 160 + 240], samplerate=samplerate, winlen=0.025, winstep=0.01)
+        plt.imshow(fbank_feat[:1000].T, interpolation=None, aspect='auto', origin='lower')
+        plt.show()
+        plt.plot(fbank_feat_power_smoothed[:1000])
+        plt.show()
+
+    if search == 'beam':
+        best_cuts = beamsearch_endpoints(fbank_feat_power_smoothed, beam_size=beam_size,
+                                         ideal_segment_len=ideal_segment_len, max_lookahead=max_lookahead,
+                                         min_len=min_len, step=step, len_reward=len_reward)
+    elif search == 'dp':
+        best_cuts = dp_endpoints(fbank_feat_power_smoothed, ideal_segment_len=ideal_segment_len,
+                                 max_lookahead=max_lookahead, min_len=min_len, step=step, len_reward=len_reward)
+    else:
+        raise ValueError(f'Unknown endpointing search: {search}')
+    segments = cuts_to_segments(best_cuts[0], fbank_feat_len)
+    segmentsFN = write_segments(wav_filename, segments)
     return segmentsFN, segments
     
     
@@ -148,6 +409,9 @@ if __name__ == '__main__':
 
     parser.add_argument('-a', '--average-segment-length', help='Average segment length in seconds.',
                                      type=float, default=60.0)
+    parser.add_argument('-s', '--search', help='The endpointing search: "beam" for the beam search or "dp" for the'
+                                               ' exact (and faster) dynamic programming search.',
+                        default='beam', choices=['beam', 'dp'])
 
     # Positional argument, without (- and --)
     parser.add_argument('filename', help='The path of the mediafile', type=str)
@@ -169,4 +433,4 @@ if __name__ == '__main__':
             .run(quiet=True)
     )
 
-    result = process_wav(tmp_file, debug=False)
+    result = process_wav(tmp_file, search=args.search, debug=False)
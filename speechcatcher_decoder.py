@@ -16,33 +16,107 @@
 #    limitations under the License.
 
 import hashlib
-import wave
 import os
 import numpy as np
 import multiprocessing
 import segment_text
+from audio_cache import load_audio, default_cache_dir, default_cache_size
+from silence_trimming import silence_trimming, trimmed_audio, map_times, default_threshold_db
 import sys
-import io
+import bisect
+import itertools
 import traceback
-from speechcatcher import speechcatcher
-import spacy
+
+# Maps every segment (consecutive parts of the paragraph text) to a (start_token_idx, end_token_idx) range
+# of the tokens, end_token_idx is exclusive. Spaces and case are ignored for the matching.
+# We build the concatenated token text and the character offset of every token end once, then the segments
+# are matched with a cursor into this text and the end token is found with a binary search, O(tokens) in total.
+#
+# If a segment doesn't match at the cursor (alignment mismatch, something is probably broken if this happens),
+# we first try to skip up to max_skip_chars characters at the start of the segment, then we search for the
+# segment in the next max_skip_chars characters of the tokens. If both fail, we advance the cursor by the
+# length of the segment anyway. Returns the token ranges and the number of mismatches.
+def align_segments_to_tokens(segments, tokens, max_skip_chars=200):
+    # espnet uses '▁' (Unicode U+2581 Lower One Eighth Block Unicode Character) to denote a space in a token.
+    token_texts = [''.join(token.replace('▁', ' ').split()).lower() for token in tokens]
+    token_text = ''.join(token_texts)
+    token_char_ends = list(itertools.accumulate(len(text) for text in token_texts))
+
+    token_ranges = []
+    num_mismatches = 0
+    cursor = 0
+    end_token_idx = 0
+    for segment in segments:
+        # note that the start position should be the end of the last segment
+        start_token_idx = end_token_idx
+        segment_text = ''.join(segment.split()).lower()
+
+        if not token_text.startswith(segment_text, cursor):
+            num_mismatches += 1
+            skip_chars = next((skip for skip in range(1, min(max_skip_chars, len(segment_text) - 1) + 1)
+                               if token_text.startswith(segment_text[skip:], cursor)), None)
+            if skip_chars is not None:
+                segment_text = segment_text[skip_chars:]
+            else:
+                found_pos = token_text.find(segment_text, cursor, cursor + max_skip_chars + len(segment_text))
+                if found_pos != -1:
+                    cursor = found_pos
+                else:
+                    print("Warning, segment overflow.", f"{segment=}")
+        cursor = min(cursor + len(segment_text), len(token_text))
+
+        # first token that ends at or after the cursor
+        end_token_idx = max(bisect.bisect_left(token_char_ends, cursor) + 1, start_token_idx + 1)
+        end_token_idx = min(end_token_idx, len(tokens))
+        token_ranges.append((start_token_idx, end_token_idx))
+
+    return token_ranges, num_mismatches
+
 
 def speechcatcher_vtt_segmentation(paragraphs, model_spacy_name, beam_size, ideal_token_len, len_reward_factor,
-                                   comma_end_reward_factor, sentence_end_reward_factor, status=None):
+                                   comma_end_reward_factor, sentence_end_reward_factor, status=None, search='beam',
+                                   num_processes=1, parse_processes=1, scorer='parser'):
 
     num_warnings = 0
 
     if status:
         status.publish_status("Running subtitle segmentation...")
     sequences = []
-    model_spacy = spacy.load(model_spacy_name)
-    for paragraph in paragraphs:
+    model_spacy = segment_text.load_spacy_model(model_spacy_name, scorer=scorer)
+
+    # Use cpu_count / divided by 2 as default number of processors, same as in speechcatcher_asr.
+    if num_processes == -1:
+        num_processes = multiprocessing.cpu_count() // 2
+
+    # Batched mode: parse all paragraphs with nlp.pipe and run the segmentation search in parallel.
+    # Otherwise each paragraph is parsed and segmented in the loop below.
+    paragraph_segments = None
+    if num_processes > 1 or parse_processes != 1:
+        if status:
+            status.publish_status(f"Segmenting {len(paragraphs)} paragraphs with {num_processes} processes...")
+        paragraph_segments = segment_text.segment_texts([paragraph["text"] for paragraph in paragraphs],
+                                                        model_spacy, beam_size=beam_size,
+                                                        ideal_token_len=ideal_token_len,
+                                                        len_reward_factor=len_reward_factor,
+                                                        sentence_end_reward_factor=sentence_end_reward_factor,
+                                                        comma_end_reward_factor=comma_end_reward_factor,
+                                                        search=search, scorer=scorer, n_process=parse_processes,
+                                                        num_workers=num_processes)
+
+    for paragraph_idx, paragraph in enumerate(paragraphs):
         try:
-            segments = segment_text.segment_beamsearch(paragraph["text"], model_spacy, beam_size=beam_size,
-                                               ideal_token_len=ideal_token_len,
-                                               len_reward_factor=len_reward_factor,
-                                               sentence_end_reward_factor=sentence_end_reward_factor,
-                                               comma_end_reward_factor=comma_end_reward_factor)
+            if paragraph_segments is None:
+                segments = segment_text.segment_beamsearch(paragraph["text"], model_spacy, beam_size=beam_size,
+                                                   ideal_token_len=ideal_token_len,
+                                                   len_reward_factor=len_reward_factor,
+                                                   sentence_end_reward_factor=sentence_end_reward_factor,
+                                                   comma_end_reward_factor=comma_end_reward_factor,
+                                                   search=search, scorer=scorer)
+            else:
+                segments = paragraph_segments[paragraph_idx]
+                # segment_texts returns the exception if this paragraph could not be segmented
+                if isinstance(segments, Exception):
+                    raise segments
         except Exception as e:
             traceback.print_exc()
             num_warnings += 1
@@ -56,64 +130,15 @@ def speechcatcher_vtt_segmentation(paragraphs, model_spacy_name, beam_size, idea
         tokens = paragraph["tokens"]
         token_timestamps = paragraph["token_timestamps"]
 
-        start_token_idx = 0
-        end_token_idx = 0
-
         try:
-            for segment in segments:
-                # iterate through tokens to find the start and end indices
-                # note that the start position should be the end of the last segment
-                start_token_idx = end_token_idx
-                remaining_text = segment
-
-                # match the segment to the tokens, so that we can get start and end positions
-                # of the segment from the token timestamps
-                while remaining_text:
-                    # espnet uses '▁' (Unicode U+2581 Lower One Eighth Block Unicode Character) to denote a space
-                    # in a token.
-                    token = tokens[end_token_idx].replace('▁',' ')
-                    token_without_space = token.replace(' ', '')
-                    if remaining_text.startswith(token):
-                        remaining_text = remaining_text[len(token):]
-                        end_token_idx += 1
-                    elif remaining_text.startswith(token_without_space):
-                        remaining_text = remaining_text[len(token_without_space):]
-                        end_token_idx += 1
-                    # recheck if this wasn't just a case mismatch
-                    elif remaining_text.lower().startswith(token.lower()):
-                        remaining_text = remaining_text[len(token):]
-                        end_token_idx += 1
-                    elif remaining_text.lower().startswith(token_without_space.lower()):
-                        remaining_text = remaining_text[len(token_without_space):]
-                        end_token_idx += 1
-                    else:
-                        # Alignment mismatch!
-                        #
-                        # We can try to advance the tokens and/or remove
-                        # characters from the segment test to see if
-                        # we can recover from the mismatch,
-                        # but something is probably broken if this happens:
-
-                        remaining_text_test = remaining_text
-                        jump_chars = 0
-                        found_token = False
-                        while remaining_text_test:
-                            remaining_text_test = remaining_text_test[1:]
-                            jump_chars += 1
-                            if remaining_text_test.startswith(token) or \
-                                    remaining_text_test.startswith(token_without_space):
-                                # we found a matching token
-                                remaining_text = remaining_text[jump_chars:]
-                                found_token = True
-                                break
-                        if found_token:
-                            continue
-                        else:
-                            # try to advance token anyway, give warning
-                            end_token_idx += 1
-                            print("Warning, segment overflow.", f"{segment=}", f"{token=}")
-                            num_warnings += 1
-
+            # match the segments to the tokens, so that we can get start and end positions
+            # of the segments from the token timestamps
+            token_ranges, num_mismatches = align_segments_to_tokens(segments, tokens)
+            if num_mismatches > 0:
+                print(f"Warning, {num_mismatches} segment/token alignment mismatches in paragraph.")
+                num_warnings += num_mismatches
+
+            for segment, (start_token_idx, end_token_idx) in zip(segments, token_ranges):
                 # get the timestamps for the start and end tokens
                 start_timestamp = token_timestamps[start_token_idx]
                 end_timestamp = token_timestamps[end_token_idx - 1]
@@ -139,7 +164,9 @@ def speechcatcher_vtt_segmentation(paragraphs, model_spacy_name, beam_size, idea
 
 def speechcatcher_asr(media_path, status, language=None,
                       model_short_tag='de_streaming_transformer_xl',
-                      chunk_length=8192, num_processes=-1):
+                      chunk_length=8192, num_processes=-1, audio_cache_dir=default_cache_dir,
+                      audio_cache_size=default_cache_size, trim_silence=0.0,
+                      trim_silence_threshold=default_threshold_db):
 
     if language is not None and language != '' and language != 'auto' and language != 'ignore':
         if language not in model_short_tag:
@@ -155,6 +182,9 @@ def speechcatcher_asr(media_path, status, language=None,
     if num_processes == -1:
         num_processes = multiprocessing.cpu_count() // 2
 
+    # dynamic import, so that the segmentation can be used without loading Speechcatcher (see --resegment-from)
+    from speechcatcher import speechcatcher
+
     if status:
         status.publish_status(f'Loading model {model_short_tag}...')
 
@@ -170,30 +200,23 @@ def speechcatcher_asr(media_path, status, language=None,
     if status:
         status.publish_status('Converting input file to 16kHz mono audio...')
 
-    # Step 2: convert input file to 16kHz audio (mono)
+    # Step 2: convert input file to 16kHz audio (mono), or get it from the audio cache.
+    # The audio is memory mapped from the cache (or streamed from ffmpeg into one array without the cache)
+    # and checked to be in the correct format.
     try:
-        speech_data = speechcatcher.convert_inputfile_inmemory(media_path)
+        rate, raw_speech_data = load_audio(media_path, cache_dir=audio_cache_dir, max_size=audio_cache_size,
+                                           status=status)
     except Exception as e:
         traceback.print_exc()
         status.publish_status(f'Error, could not read and/or convert input media file. Error message is: {e}')
         status.send_error()
         sys.exit(-9)
 
-    # Create an in-memory file-like object
-    wavfile_in_memory = io.BytesIO(speech_data)
-
-    with wave.open(wavfile_in_memory, 'rb') as wavfile_in:
-        ch = wavfile_in.getnchannels()
-        bits = wavfile_in.getsampwidth()*8
-        rate = wavfile_in.getframerate()
-        nframes = wavfile_in.getnframes()
-        buf = wavfile_in.readframes(-1)
-        raw_speech_data = np.frombuffer(buf, dtype='int16')
-
-    # make sure wav is in the correct format
-    assert(ch == 1)
-    assert(bits == 16)
-    assert(rate == 16000)
+    # Optional silence trimming, the recognition only gets the kept parts of the audio
+    speech_ranges, time_offsets = silence_trimming(raw_speech_data, rate, min_silence=trim_silence,
+                                                   threshold_db=trim_silence_threshold, status=status)
+    if speech_ranges:
+        raw_speech_data = trimmed_audio(raw_speech_data, speech_ranges)
 
     if status:
         status.publish_status('Starting decoding with Speechcatcher model'
@@ -212,6 +235,11 @@ def speechcatcher_asr(media_path, status, language=None,
         status.send_error()
         sys.exit(-10)
 
+    # Map the token timestamps of the trimmed audio back to the time of the media file
+    if time_offsets:
+        for paragraph in paragraphs:
+            paragraph['token_timestamps'] = map_times(paragraph['token_timestamps'], time_offsets)
+
     if status:
         status.publish_status('Finished decoding.')
 
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    Copyright 2023 Lecture2Go, Dr. Benjamin Milde
+#
+#    Licensed under the Apache License, Version 2.0 (the 'License');
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an 'AS IS' BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Streaming audio ingest for the Kaldi decoder: the audio extraction, the endpointing and the decoding overlap.
+# A separate ingest process reads the 16 kHz audio from ffmpeg (or from the audio cache) block by block, computes
+# the frame power as the samples arrive, runs the online endpointing search (simple_endpointing.online_endpoints)
+# and writes every segment to its own wav file as soon as its end is final. The decoder gets the segments through
+# a queue, so it can start with the first segment while ffmpeg is still decoding the rest of the media file.
+
+import os
+import wave
+import queue
+import tempfile
+import multiprocessing
+
+import ffmpeg
+import numpy as np
+from scipy.io import wavfile
+
+from audio_cache import is_decoded_wav, cache_filename, evict_cache, read_wav_header, wav_stream_blocks, \
+    ffmpeg_wav_process, default_cache_size
+from simple_endpointing import stream_frame_power_blocks, gaussian_filter_blocks, online_endpoints
+
+# Frames of the endpointing per second
+frame_rate = 100
+
+
+# The samples of the stream that are not yet part of a segment
+class sample_buffer():
+    def __init__(self):
+        self.blocks = []
+        self.start = 0
+
+    def append(self, block):
+        self.blocks.append(block)
+
+    # Returns the samples from start to end and removes all samples before end from the buffer
+    def pop(self, start, end):
+        samples = np.concatenate(self.blocks) if self.blocks else np.zeros(0, dtype=np.int16)
+        segment = samples[max(start - self.start, 0):end - self.start]
+        self.blocks = [samples[end - self.start:]]
+        self.start = end
+        return segment
+
+
+# Runs in the ingest process: reads the audio, endpoints it online and puts ('segment', index, (start, end)
+# in frames, wav filename) for every segment on segment_queue, then ('done',) or ('error', message).
+# The media file is decoded with ffmpeg if decode is set, otherwise it is read as 16 kHz mono wav file.
+# If cached_filename is set, the decoded audio is also written to the audio cache.
+def ingest_segments(filename, segment_prefix, segment_queue, decode=True, cached_filename=None,
+                    cache_size=default_cache_size, search='beam', max_lookahead=100*180, block_size=1024*1024):
+    process = None
+    tmp_filename = None
+    try:
+        if decode:
+            process = ffmpeg_wav_process(filename)
+            stream = process.stdout
+        else:
+            stream = open(filename, 'rb')
+
+        samplerate = read_wav_header(stream)
+        frame_step = samplerate // frame_rate
+        samples = sample_buffer()
+
+        cache_file = None
+        if cached_filename:
+            # Written to a temporary file first and renamed, so that other jobs never see a partial file
+            tmp_fd, tmp_filename = tempfile.mkstemp(suffix='.wav.part', dir=os.path.dirname(cached_filename))
+            os.close(tmp_fd)
+            cache_file = wave.open(tmp_filename, 'wb')
+            cache_file.setnchannels(1)
+            cache_file.setsampwidth(2)
+            cache_file.setframerate(samplerate)
+
+        def sample_blocks():
+            for block in wav_stream_blocks(stream, block_size=block_size):
+                samples.append(block)
+                if cache_file:
+                    cache_file.writeframes(block.tobytes())
+                yield block
+
+        power_blocks = (block * -1.0 for block in
+                        gaussian_filter_blocks(stream_frame_power_blocks(sample_blocks(), samplerate), sigma=20))
+        for i, segment in enumerate(online_endpoints(power_blocks, search=search, max_lookahead=max_lookahead)):
+            segment_filename = f'{segment_prefix}_{i:04}.wav'
+            wavfile.write(segment_filename, samplerate,
+                          samples.pop(segment[0] * frame_step, segment[1] * frame_step))
+            segment_queue.put(('segment', i, segment, segment_filename))
+
+        stream.close()
+        if process:
+            stderr = process.stderr.read()
+            if process.wait() != 0:
+                segment_queue.put(('error', stderr))
+                return
+        if cache_file:
+            cache_file.close()
+            os.replace(tmp_filename, cached_filename)
+            evict_cache(os.path.dirname(cached_filename), max_size=cache_size, keep=[cached_filename])
+        segment_queue.put(('done',))
+    except Exception as e:
+        if process:
+            process.kill()
+        segment_queue.put(('error', str(e).encode()))
+    finally:
+        if tmp_filename and os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+# Starts the ingest process of a media file, before the models are loaded so that loading overlaps with ffmpeg.
+# The segment wav files are named segment_prefix_0000.wav, segment_prefix_0001.wav, ...
+# Returns the process and its queue for ingested_segments.
+def start_ingest(filename, segment_prefix, cache_dir=None, cache_size=default_cache_size, search='beam',
+                 max_lookahead=100*180, status=None):
+    decode = not is_decoded_wav(filename)
+    cached_filename = None
+    if decode and cache_dir:
+        cached_filename = cache_filename(filename, cache_dir)
+        if os.path.exists(cached_filename):
+            # Mark as recently used
+            os.utime(cached_filename)
+            if status:
+                status.publish_status('Using cached 16 kHz mono audio.')
+            filename, decode, cached_filename = cached_filename, False, None
+
+    # fork, so that the ingest starts without importing anything again
+    context = multiprocessing.get_context('fork')
+    segment_queue = context.Queue()
+    process = context.Process(target=ingest_segments, args=(filename, segment_prefix, segment_queue),
+                              kwargs={'decode': decode, 'cached_filename': cached_filename,
+                                      'cache_size': cache_size, 'search': search,
+                                      'max_lookahead': max_lookahead}, daemon=True)
+    process.start()
+    return process, segment_queue
+
+
+# Yields (index, (start, end) in frames, wav filename) of every segment of the ingest process as soon as
+# it is endpointed. Raises ffmpeg.Error if the audio can't be decoded.
+def ingested_segments(process, segment_queue):
+    try:
+        while True:
+            try:
+                message = segment_queue.get(timeout=1.0)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                # The process may have put its last message just before it exited
+                try:
+                    message = segment_queue.get(timeout=1.0)
+                except queue.Empty:
+                    raise ffmpeg.Error('ffmpeg', b'', b'The audio ingest process exited unexpectedly.')
+            if message[0] == 'segment':
+                yield message[1:]
+            elif message[0] == 'done':
+                break
+            else:
+                raise ffmpeg.Error('ffmpeg', b'', message[1])
+    finally:
+        process.join(timeout=10)
+        if process.is_alive():
+            process.terminate()
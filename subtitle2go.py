@@ -21,61 +21,59 @@ import argparse
 import segment_text
 import sys
 
-from utils import output_status, ensure_dir, format_timestamp_str
+from utils import output_status, ensure_dir, format_timestamp_str, write_timings_sidecar, read_timings_sidecar, \
+    timings_sidecar_suffix, kaldi_feature_factor
 
 
-# This creates a segmentation for the subtitles and make sure it can still be mapped to the Kaldi tokenisation
+# This creates a segmentation for the subtitles. The spaCy doc is built directly from the Kaldi words,
+# so every segment is a range of word indices and the timings can be looked up directly in vtt.
 def vtt_segmentation(vtt, model_spacy, beam_size, ideal_token_len, len_reward_factor, comma_end_reward_factor,
-                     sentence_end_reward_factor, status):
+                     sentence_end_reward_factor, status, search='beam', window_sentences=0, overlap_sentences=5,
+                     scorer='parser', pause_reward_factor=0.0):
     sequences = []
 
     status.publish_status('Start text segmentation.')
 
-    # Array starts at zero
-    word_counter = -1
+    # Makes a word list for segmentation and change the <UNK> and <unk> Token to UNK
+    word_list = [e[0].replace('<UNK>', 'UNK').replace('<unk>', 'UNK') for e in vtt]
     
-    # Makes a string for segmentation and change the <UNK> and <unk> Token to UNK
-    word_string = ' '.join([e[0].replace('<UNK>', 'UNK').replace('<unk>', 'UNK') for e in vtt])
-    
-    # Call the segmentation beamsearch
-    segments = segment_text.segment_beamsearch(word_string, model_spacy, beam_size=beam_size,
-                                               ideal_token_len=ideal_token_len,
-                                               len_reward_factor=len_reward_factor,
-                                               sentence_end_reward_factor=sentence_end_reward_factor,
-                                               comma_end_reward_factor=comma_end_reward_factor)
-
-    temp_segments = [segments[0]]
-
-    # Corrects punctuation marks and also lost tokens when they are slipped
-    # to the beginning of the next line
-    for current in segments[1:]:
-        current_l = current.split(' ')
-        if current_l[0].startswith((',', '.', '?', '!', "'", "n't")):
-            temp_segments[-1] += current_l[0]
-            current_l = current_l[1:]
-        temp_segments.append(' '.join(current_l))
-    segments = temp_segments
-
-    # Cuts the segments in words, removes empty objects
-    # and creates the sequences object
-    for segment in segments:
-        clean_segment = list(filter(None, segment.split(' ')))
-        string_segment = ' '.join(clean_segment)
-        segment_length = len(clean_segment)
+    # Pause after every word in seconds, the Kaldi timings are in frames
+    word_pauses = [max(0.0, (vtt[i + 1][1] - (vtt[i][1] + vtt[i][2])) * kaldi_feature_factor / 100.)
+                   for i in range(len(vtt) - 1)] + [0.0]
+
+    # Parser-only (or with the fast scorer: parser-free) spaCy pipeline, cached per process
+    segment_nlp = segment_text.load_spacy_model(model_spacy, scorer=scorer)
+
+    if window_sentences > 0:
+        # Segment the text in overlapping windows of sentences, instead of parsing the complete text at once
+        word_ranges = segment_text.segment_windows(word_list, segment_nlp, window_sentences=window_sentences,
+                                                   overlap_sentences=overlap_sentences, beam_size=beam_size,
+                                                   ideal_token_len=ideal_token_len,
+                                                   len_reward_factor=len_reward_factor,
+                                                   sentence_end_reward_factor=sentence_end_reward_factor,
+                                                   comma_end_reward_factor=comma_end_reward_factor,
+                                                   search=search, scorer=scorer, word_pauses=word_pauses,
+                                                   pause_reward_factor=pause_reward_factor)
+    else:
+        # Call the segmentation beamsearch
+        word_ranges = segment_text.segment_words(word_list, segment_nlp, beam_size=beam_size,
+                                                 ideal_token_len=ideal_token_len,
+                                                 len_reward_factor=len_reward_factor,
+                                                 sentence_end_reward_factor=sentence_end_reward_factor,
+                                                 comma_end_reward_factor=comma_end_reward_factor,
+                                                 search=search, scorer=scorer, word_pauses=word_pauses,
+                                                 pause_reward_factor=pause_reward_factor)
+
+    # Creates the sequences object from the word ranges
+    for start_word, end_word in word_ranges:
+        string_segment = ' '.join(filter(None, word_list[start_word:end_word]))
         # Fixes problems with the first token. The first token is everytime 0
-        if vtt[word_counter + 1][1] == 0:
-            begin_segment = vtt[word_counter + 2][1]
+        if vtt[start_word][1] == 0 and start_word + 1 < end_word:
+            begin_segment = vtt[start_word + 1][1]
         else:
-            begin_segment = vtt[word_counter + 1][1]
-        # this check is a workaround to not get index out a range error which may happen
-        # (why? didn't want to get deep into the segmentation code)
-        if (word_counter + segment_length) < len(vtt):
-            end_segment = vtt[word_counter + segment_length][1] + vtt[word_counter + segment_length][2]
-        else: 
-            # use last segment as end_segment
-            end_segment = vtt[-1][1] + vtt[-1][2] 
+            begin_segment = vtt[start_word][1]
+        end_segment = vtt[end_word - 1][1] + vtt[end_word - 1][2]
         sequences.append([string_segment, begin_segment, end_segment])
-        word_counter = word_counter + segment_length
     
     status.publish_status('Text segmentation finished.')
     
@@ -129,21 +127,60 @@ def create_subtitle(sequences, subtitle_format, filename_without_extension, conv
     status.publish_status('Finished subtitle creation.')
 
 
+# vtt is only passed in if we resegment from a timings sidecar, otherwise the ASR (or the forced alignment of
+# --align-transcript) is run first
 def pykaldi_subtitle(status, args, filename, filename_without_extension, filename_without_extension_hash,
-                     subtitle_format):
-    vtt, words = kaldi_asr(filename_without_extension_hash, filename=filename, asr_beamsize=args.asr_beam_size,
-                           asr_max_active=args.asr_max_active, acoustic_scale=args.acoustic_scale,
-                           do_rnn_rescore=args.rnn_rescore, config_file=model_kaldi, status=status)
-    vtt = interpunctuation(vtt, words, filename_without_extension_hash, model_punctuation, uppercase, status=status)
+                     subtitle_format, vtt=None):
+    if vtt is None and args.align_transcript:
+        # The words of the transcript already have their punctuation and casing, no interpunctuation needed
+        vtt, words = kaldi_align(filename_without_extension_hash, filename, args.align_transcript,
+                                 config_file=model_kaldi, status=status, endpoint_search=args.endpoint_search,
+                                 audio_cache_dir=args.audio_cache_dir, audio_cache_size=args.audio_cache_size)
+        if not args.no_timings_sidecar:
+            write_timings_sidecar(filename_without_extension, 'kaldi', args.language, vtt=vtt)
+    elif vtt is None:
+        vtt, words = kaldi_asr(filename_without_extension_hash, filename=filename, asr_beamsize=args.asr_beam_size,
+                               asr_max_active=args.asr_max_active, acoustic_scale=args.acoustic_scale,
+                               do_rnn_rescore=args.rnn_rescore, config_file=model_kaldi, status=status,
+                               endpoint_search=args.endpoint_search, audio_cache_dir=args.audio_cache_dir,
+                               audio_cache_size=args.audio_cache_size, trim_silence=args.trim_silence,
+                               trim_silence_threshold=args.trim_silence_threshold,
+                               streaming_ingest=args.streaming_ingest, kaldi_features=args.kaldi_features,
+                               num_procs=args.num_procs, batch_size=args.kaldi_batch_size,
+                               rescore_min_depth=args.rnn_rescore_min_depth, rescore_procs=args.rnn_rescore_procs,
+                               rtf_budget=args.kaldi_rtf_budget, deadline=args.kaldi_deadline)
+        vtt = interpunctuation(vtt, words, filename_without_extension_hash, model_punctuation, uppercase,
+                               status=status, num_threads=args.punctuation_threads,
+                               batch_size=args.punctuation_batch_size)
+        if not args.no_timings_sidecar:
+            write_timings_sidecar(filename_without_extension, 'kaldi', args.language, vtt=vtt)
     sequences = vtt_segmentation(vtt, model_spacy, beam_size=args.segment_beam_size,
                                  ideal_token_len=args.ideal_token_len,
                                  len_reward_factor=args.len_reward_factor,
                                  sentence_end_reward_factor=args.sentence_end_reward_factor,
-                                 comma_end_reward_factor=args.comma_end_reward_factor, status=status)
+                                 comma_end_reward_factor=args.comma_end_reward_factor, status=status,
+                                 search=args.segment_search, window_sentences=args.segment_window_sentences,
+                                 overlap_sentences=args.segment_window_overlap, scorer=args.segment_scorer,
+                                 pause_reward_factor=args.pause_reward_factor)
     create_subtitle(sequences, subtitle_format, filename_without_extension, convert_kaldi_time=True,
                     subtitle_offset=args.subtitle_offset, status=status)
 
 
+# Retimes a subtitle that was corrected by an editor (--realign-edited): only the audio around the edited words is
+# aligned again (see kaldi_aligner.kaldi_realign), the subtitle file is rewritten and the sidecar is updated
+def pykaldi_realign_subtitle(status, args, filename, filename_without_extension, filename_without_extension_hash,
+                             vtt):
+    vtt, sequences = kaldi_realign(filename_without_extension_hash, filename, vtt, args.realign_edited,
+                                   config_file=model_kaldi, status=status, subtitle_offset=args.subtitle_offset,
+                                   audio_cache_dir=args.audio_cache_dir, audio_cache_size=args.audio_cache_size)
+    if not args.no_timings_sidecar:
+        write_timings_sidecar(filename_without_extension, 'kaldi', args.language, vtt=vtt)
+    subtitle_filename_without_extension, _, subtitle_format = args.realign_edited.rpartition('.')
+    # The cue times are already in seconds, with the subtitle offset
+    create_subtitle(sequences, subtitle_format.lower(), subtitle_filename_without_extension,
+                    convert_kaldi_time=False, subtitle_offset=0.0, status=status)
+
+
 if __name__ == '__main__':
     # Argument parser
     parser = argparse.ArgumentParser()
@@ -172,7 +209,8 @@ if __name__ == '__main__':
                                                      ' finished or something went off', type=str,
                         required=False)
 
-    parser.add_argument('-p', '--num-procs', help='Number of parallel processors (Speechcatcher and Whisper only)',
+    parser.add_argument('-p', '--num-procs', help='Number of parallel processors. For Kaldi, the segments are decoded'
+                                                  ' in parallel by this many processes (-1: one process).',
                         type=int, default=-1)
 
     parser.add_argument('-o', '--subtitle-offset', help='Subtitle offset (in seconds)',
@@ -181,6 +219,14 @@ if __name__ == '__main__':
     parser.add_argument('--rnn-rescore', help='Do RNNLM rescoring of the decoder output (only for PyKaldi'
                                               'models).',
                         action='store_true', default=False)
+    parser.add_argument('--rnn-rescore-min-depth', help='Only rescore segments whose lattice depth (lattice arcs per'
+                                                        ' frame) is at least this, segments with a shallower lattice'
+                                                        ' are confident and keep their first pass result, e.g. 2.0.'
+                                                        ' 0 rescores all segments (for --rnn-rescore).',
+                        type=float, default=0.0)
+    parser.add_argument('--rnn-rescore-procs', help='Number of processes that rescore the lattices, while the first'
+                                                    ' pass decodes the next segments (for --rnn-rescore).',
+                        type=int, default=1)
 
     parser.add_argument('--acoustic-scale', help='ASR decoder option: This is a scale on the acoustic'
                                                  ' log-probabilities, and is a universally used kludge'
@@ -196,8 +242,86 @@ if __name__ == '__main__':
                                                  'can be active at one time.',
                         type=int, default=16000)
 
+    parser.add_argument('--audio-cache-dir', help='Directory of the decoded audio cache, media files are only'
+                                                  ' decoded to 16 kHz mono audio once and then read from here.'
+                                                  ' Set to "" to disable the cache and decode in memory.',
+                        type=str, default='tmp/audio_cache')
+    parser.add_argument('--audio-cache-size', help='Maximum size of the decoded audio cache in GB, the least'
+                                                   ' recently used files are removed first.',
+                        type=float, default=10.0)
+    parser.add_argument('--trim-silence', help='Remove silent stretches longer than this many seconds from the'
+                                               ' audio before the ASR, the timestamps of the subtitle are mapped'
+                                               ' back to the media file. 0 to disable. Default=0',
+                        type=float, default=0.0)
+    parser.add_argument('--trim-silence-threshold', help='Audio is silent, if it is more than this many dB below'
+                                                         ' the level of the speech (for --trim-silence).',
+                        type=float, default=25.0)
+    parser.add_argument('--endpoint-search', help='The search that cuts the audio into segments for the ASR:'
+                                                  ' "beam" for the beam search or "dp" for the exact (and faster)'
+                                                  ' dynamic programming search (Kaldi only).',
+                        required=False, default='beam', choices=['beam', 'dp'])
+    parser.add_argument('--streaming-ingest', help='Endpoint the audio while ffmpeg extracts it and decode every'
+                                                   ' segment as soon as it is endpointed, instead of extracting and'
+                                                   ' endpointing the complete file first (Kaldi only).',
+                        action='store_true', default=False)
+    parser.add_argument('--kaldi-features', help='The feature extraction of the Kaldi decoder: "inprocess" computes'
+                                                 ' the MFCCs once per segment in-process and uses them for the nnet'
+                                                 ' and the i-vectors, "rspec" uses the Kaldi command line tools'
+                                                 ' (Kaldi only).',
+                        required=False, default='inprocess', choices=['inprocess', 'rspec'])
+    parser.add_argument('--kaldi-batch-size', help='Batched decoding: the acoustic model is computed for the chunks'
+                                                   ' of several segments together, in minibatches of this many'
+                                                   ' chunks, the lattice search still runs per segment. 0 disables'
+                                                   ' batched decoding (Kaldi only).',
+                        type=int, default=0)
+    parser.add_argument('--kaldi-rtf-budget', help='Adaptive beam: decode within this real-time factor (seconds of'
+                                                   ' decoding per second of audio, including the feature extraction),'
+                                                   ' the beam and max-active of every segment are tightened when the'
+                                                   ' decoding falls behind and widened when it is ahead. 0 disables'
+                                                   ' it (Kaldi only).',
+                        type=float, default=0.0)
+    parser.add_argument('--kaldi-deadline', help='Adaptive beam: finish the job within this many seconds (wall-clock),'
+                                                 ' see --kaldi-rtf-budget. 0 disables it (Kaldi only).',
+                        type=float, default=0.0)
+    parser.add_argument('--align-transcript', help='Forced alignment: align the text of this file (e.g. a script or'
+                                                   ' a corrected transcript) to the media file with the acoustic'
+                                                   ' model, instead of decoding it (Kaldi only).',
+                        type=str, default=None)
+
+    parser.add_argument('--punctuation-threads', help='Number of threads of the punctuation model. 0 keeps the'
+                                                      ' default of torch (Kaldi only).',
+                        type=int, default=0)
+
+    parser.add_argument('--punctuation-batch-size', help='The punctuation model predicts the text in overlapping'
+                                                         ' windows of words, this many windows per batch'
+                                                         ' (Kaldi only).',
+                        type=int, default=8)
+
     parser.add_argument('--segment-beam-size', help='What beam size to use for the segmentation search',
                         type=int, default=10)
+    parser.add_argument('--segment-search', help='The segmentation search: "beam" for the beam search or "dp" for'
+                                                 ' the exact (and faster) dynamic programming search.',
+                        required=False, default='beam', choices=['beam', 'dp'])
+    parser.add_argument('--segment-scorer', help='The cut rewards of the segmentation: "parser" uses the dependency'
+                                                 ' tree of the spaCy model, "fast" only uses punctuation, pauses and'
+                                                 ' word lists and does not need a parser model.',
+                        required=False, default='parser', choices=['parser', 'fast'])
+    parser.add_argument('--pause-reward-factor', help='Reward per second of pause after a word for a split there'
+                                                      ' (Kaldi only). Default=5.0 with the fast scorer, otherwise 0.',
+                        type=float, default=None)
+    parser.add_argument('--segment-window-sentences', help='Segment the transcript in overlapping windows of this'
+                                                           ' many sentences instead of parsing it at once, 0 to'
+                                                           ' disable (Kaldi only).',
+                        type=int, default=0)
+    parser.add_argument('--segment-window-overlap', help='Number of sentences that overlap between segmentation'
+                                                         ' windows (Kaldi only).',
+                        type=int, default=5)
+    parser.add_argument('--segment-num-procs', help='Number of parallel processes for the segmentation search,'
+                                                    ' -1 uses half of the CPUs (Speechcatcher only).',
+                        type=int, default=1)
+    parser.add_argument('--segment-parse-procs', help='Number of parallel spaCy processes to parse the paragraphs'
+                                                      ' for the segmentation (Speechcatcher only).',
+                        type=int, default=1)
     parser.add_argument('--ideal-token-len', help='The ideal length of tokens per segment',
                         type=int, default=10)
 
@@ -236,8 +360,24 @@ if __name__ == '__main__':
 
     parser.add_argument('--debug', help='Output debug timing information', action='store_true', default=False)
 
+    parser.add_argument('--no-timings-sidecar', help='Do not write the word/token timings of the ASR to a'
+                                                     f' <filename>{timings_sidecar_suffix} sidecar file.',
+                        action='store_true', default=False)
+
+    parser.add_argument('--resegment-from', help='Skip the ASR and only run the segmentation and subtitle creation'
+                                                 ' with the word/token timings of this sidecar file. The engine'
+                                                 ' and language are taken from the sidecar.',
+                        type=str, default=None)
+
+    parser.add_argument('--realign-edited', help='Retime a vtt/srt subtitle of the media file that was corrected by'
+                                                 ' an editor: only the audio around the edited words is aligned'
+                                                 ' again, with the word timings of the sidecar of the media file'
+                                                 ' (Kaldi only). The subtitle file and the sidecar are rewritten.',
+                        type=str, default=None)
+
     # Positional argument, without (- and --)
-    parser.add_argument('filename', help='The path of the mediafile', type=str)
+    parser.add_argument('filename', help='The path of the mediafile (optional with --resegment-from)', type=str,
+                        nargs='?', default=None)
 
     beamsize_default = {
         'kaldi': 13,
@@ -259,6 +399,28 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    if args.pause_reward_factor is None:
+        args.pause_reward_factor = 5.0 if args.segment_scorer == 'fast' else 0.0
+
+    # Resegmentation: engine, language and the word/token timings come from the sidecar
+    timings = None
+    if args.resegment_from:
+        # The name of the subtitle is derived from the name of the sidecar
+        if not args.resegment_from.endswith(timings_sidecar_suffix):
+            parser.error(f'--resegment-from needs a timings sidecar file (<filename>{timings_sidecar_suffix})')
+        timings = read_timings_sidecar(args.resegment_from)
+        args.engine = timings['engine']
+        args.language = timings['language']
+    elif args.filename is None:
+        parser.error('the following arguments are required: filename')
+    elif args.realign_edited:
+        # Realignment: the word timings come from the sidecar of the media file
+        timings = read_timings_sidecar(args.filename.rpartition('.')[0] + timings_sidecar_suffix)
+        if timings['engine'] != 'kaldi':
+            parser.error('--realign-edited needs the timings sidecar of a Kaldi run')
+        args.engine = timings['engine']
+        args.language = timings['language']
+
     if args.model_yaml is None:
         args.model_yaml = engine_model_default[args.engine]
 
@@ -270,7 +432,12 @@ if __name__ == '__main__':
         args.subtitle_offset = subtitle_offset_default.get(args.engine, 0.0)
 
     filename = args.filename
-    filename_without_extension = filename.rpartition('.')[0]
+    if filename is None:
+        # Resegmentation without the media file, the subtitle is written next to the sidecar
+        filename = args.resegment_from
+        filename_without_extension = filename[:-len(timings_sidecar_suffix)]
+    else:
+        filename_without_extension = filename.rpartition('.')[0]
     subtitle_format = args.subtitle
     beamsize = args.asr_beam_size
 
@@ -293,12 +460,19 @@ if __name__ == '__main__':
     language = args.language
 
     if args.engine == 'kaldi':
-        # dynamic import
-        from kaldi_decoder import kaldi_asr
-        from punctuation import interpunctuation
-
-        print("Using Kaldi as ASR engine.")
-        ensure_dir('tmp/')
+        if args.realign_edited:
+            # dynamic import
+            from kaldi_aligner import kaldi_realign
+
+            ensure_dir('tmp/')
+        elif timings is None:
+            # dynamic import
+            from kaldi_decoder import kaldi_asr
+            from kaldi_aligner import kaldi_align
+            from punctuation import interpunctuation
+
+            print("Using Kaldi as ASR engine.")
+            ensure_dir('tmp/')
         with open('kaldi_languages.yaml', 'r') as stream:
             language_yaml = yaml.safe_load(stream)
             if language_yaml.get(language, None):
@@ -310,8 +484,17 @@ if __name__ == '__main__':
                 print(f'Language {language} is not set in kaldi_languages.yaml. Exiting.')
                 sys.exit()
 
-        pykaldi_subtitle(status, args, filename, filename_without_extension, filename_without_extension_hash,
-                         subtitle_format)
+        if args.realign_edited:
+            pykaldi_realign_subtitle(status, args, filename, filename_without_extension,
+                                     filename_without_extension_hash, timings['vtt'])
+        else:
+            pykaldi_subtitle(status, args, filename, filename_without_extension, filename_without_extension_hash,
+                             subtitle_format, vtt=timings['vtt'] if timings else None)
+    elif args.engine == 'whisper' and timings:
+        from whisper_decoder import write_whisper_subtitle
+
+        # Whisper has no custom segmentation, the subtitle is rewritten from the stored segments
+        write_whisper_subtitle(timings['segments'], args.subtitle, filename_without_extension)
     elif args.engine == 'whisper':
         # dynamic import
         import torch
@@ -326,22 +509,29 @@ if __name__ == '__main__':
         # 30 seconds to automatically determine the language
         if language == 'auto':
             language = None
-        whisper_asr(filename, status=status, task=args.whisper_task, language=language, output_format=args.subtitle,
-                    model=args.model_yaml, best_of=5,
-                    beam_size=beamsize, initial_prompt=args.whisper_initial_prompt,
-                    condition_on_previous_text=not args.no_condition_on_previous_text,
-                    fp16=True, no_speech_threshold=args.whisper_no_speech_threshold, verbose=args.debug)
+        result = whisper_asr(filename, status=status, task=args.whisper_task, language=language,
+                             output_format=args.subtitle, model=args.model_yaml, best_of=5,
+                             beam_size=beamsize, initial_prompt=args.whisper_initial_prompt,
+                             condition_on_previous_text=not args.no_condition_on_previous_text,
+                             fp16=True, no_speech_threshold=args.whisper_no_speech_threshold, verbose=args.debug,
+                             audio_cache_dir=args.audio_cache_dir, audio_cache_size=args.audio_cache_size,
+                             trim_silence=args.trim_silence, trim_silence_threshold=args.trim_silence_threshold)
+        if result and not args.no_timings_sidecar:
+            segments = [{'start': segment['start'], 'end': segment['end'], 'text': segment['text']}
+                        for segment in result['segments']]
+            write_timings_sidecar(filename_without_extension, 'whisper', result['language'], segments=segments)
     elif args.engine == 'speechcatcher':
-        # dynamic import
-        import torch
-        # Note that we need to set this to 1, otherwise the decoding will hang with num_procs > 1.
-        # It seems that torch threads are interfering with Speechcatcher's
-        # parallelization (ProcessPoolExecutor with concurrent.futures).
-        torch.set_num_threads(1)
+        if timings is None:
+            # dynamic import
+            import torch
+            # Note that we need to set this to 1, otherwise the decoding will hang with num_procs > 1.
+            # It seems that torch threads are interfering with Speechcatcher's
+            # parallelization (ProcessPoolExecutor with concurrent.futures).
+            torch.set_num_threads(1)
+
+            print("Using Speechcatcher as ASR engine.")
         from speechcatcher_decoder import speechcatcher_asr, speechcatcher_vtt_segmentation
 
-        print("Using Speechcatcher as ASR engine.")
-
         with open('kaldi_languages.yaml', 'r') as stream:
             language_yaml = yaml.safe_load(stream)
             if language_yaml.get(language, None):
@@ -353,15 +543,32 @@ if __name__ == '__main__':
         # The Speechcatcher srt/vtt output is generated in 3 steps;
         # (1) End-to end ASR (2) Segmentation and alignment of token time stamps to the segmented text
         # (3) Generate a VTT or SRT from the segments
-        complete_text, paragraphs = speechcatcher_asr(filename, status, language=language,
-                                                      model_short_tag=args.model_yaml, num_processes=args.num_procs)
+        if timings:
+            paragraphs = timings['paragraphs']
+        else:
+            complete_text, paragraphs = speechcatcher_asr(filename, status, language=language,
+                                                          model_short_tag=args.model_yaml,
+                                                          num_processes=args.num_procs,
+                                                          audio_cache_dir=args.audio_cache_dir,
+                                                          audio_cache_size=args.audio_cache_size,
+                                                          trim_silence=args.trim_silence,
+                                                          trim_silence_threshold=args.trim_silence_threshold)
+            if not args.no_timings_sidecar:
+                paragraphs_timings = [{'text': paragraph['text'], 'tokens': paragraph['tokens'],
+                                       'token_timestamps': paragraph['token_timestamps']}
+                                      for paragraph in paragraphs]
+                write_timings_sidecar(filename_without_extension, 'speechcatcher', language,
+                                      paragraphs=paragraphs_timings)
 
         sequences = speechcatcher_vtt_segmentation(paragraphs, model_spacy, beam_size=args.segment_beam_size,
                                                    ideal_token_len=args.ideal_token_len,
                                                    len_reward_factor=args.len_reward_factor,
                                                    sentence_end_reward_factor=args.sentence_end_reward_factor,
                                                    comma_end_reward_factor=args.comma_end_reward_factor,
-                                                   status=status)
+                                                   status=status, search=args.segment_search,
+                                                   num_processes=args.segment_num_procs,
+                                                   parse_processes=args.segment_parse_procs,
+                                                   scorer=args.segment_scorer)
 
         create_subtitle(sequences, subtitle_format, filename_without_extension, convert_kaldi_time=False,
                         subtitle_offset=args.subtitle_offset, status=status)
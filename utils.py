@@ -17,14 +17,19 @@
 #    limitations under the License.
 
 import os
+import re
 import time
 import json
+import gzip
 import requests
 import ffmpeg
 
 # used to be 3.00151874884282680911
 kaldi_feature_factor = 3.
 
+# file suffix of the word/token timings sidecar
+timings_sidecar_suffix = '.timings.json.gz'
+
 
 # status object for sending status messages through redis and callbacks
 class output_status():
@@ -104,3 +109,56 @@ def format_timestamp_str(time, subtitle_offset, seperator, convert_from_kaldi_ti
                             f'{seperator}'
                             f'{int(time * 1000 % 1000):03}')
     return time_start
+
+
+# parses a vtt/srt timestamp (HH:MM:SS.mmm, MM:SS.mmm or HH:MM:SS,mmm) to seconds
+def parse_timestamp_str(time_str):
+    seconds = 0.0
+    for part in time_str.strip().replace(',', '.').split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+# Reads the cues of a vtt or srt subtitle file (e.g. a subtitle that was corrected by an editor).
+# Returns (text, start, end) of every cue, the times in seconds and the text with its line breaks.
+def read_subtitle(filename):
+    with open(filename, 'r', encoding='utf-8-sig') as subtitle_file:
+        blocks = re.split(r'\n\s*\n', subtitle_file.read().replace('\r\n', '\n'))
+
+    cues = []
+    for block in blocks:
+        lines = block.strip().split('\n')
+        # The header, comments, styles and regions of vtt files have no timing line
+        timing_lines = [i for i, line in enumerate(lines) if '-->' in line]
+        if not timing_lines:
+            continue
+        timing_line = timing_lines[0]
+        start, _, end = lines[timing_line].partition('-->')
+        # vtt cue settings (e.g. align:start) follow the end time
+        cues.append(('\n'.join(lines[timing_line + 1:]), parse_timestamp_str(start),
+                     parse_timestamp_str(end.split()[0])))
+    return cues
+
+
+# json conversion for numpy arrays and scalars (e.g. token timestamps)
+def to_json_type(obj):
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+# Writes the word/token timings of an ASR run to a compact (gzipped json) sidecar file next to the subtitle,
+# so that the subtitle can be resegmented later without running the ASR again (see --resegment-from).
+# timings are the engine specific keyword arguments, e.g. vtt for Kaldi or paragraphs for Speechcatcher.
+def write_timings_sidecar(filename_without_extension, engine, language, **timings):
+    sidecar_filename = filename_without_extension + timings_sidecar_suffix
+    sidecar = {'version': 1, 'engine': engine, 'language': language, **timings}
+    with gzip.open(sidecar_filename, 'wt', encoding='utf-8') as sidecar_file:
+        json.dump(sidecar, sidecar_file, separators=(',', ':'), ensure_ascii=False, default=to_json_type)
+    return sidecar_filename
+
+
+# Reads a sidecar file written with write_timings_sidecar
+def read_timings_sidecar(sidecar_filename):
+    with gzip.open(sidecar_filename, 'rt', encoding='utf-8') as sidecar_file:
+        return json.load(sidecar_file)
@@ -22,6 +22,10 @@ from typing import Iterator, TextIO
 import sys
 import whisper
 import traceback
+import numpy as np
+
+from audio_cache import load_audio, default_cache_dir, default_cache_size
+from silence_trimming import silence_trimming, trimmed_audio, map_times, default_threshold_db
 
 # The write_vtt, write_srt and write_txt functions were replaced in whisper, the new code is a bit annoying
 # and complicates things for no reason
@@ -62,9 +66,19 @@ def write_txt(transcript: Iterator[dict], file: TextIO):
     for segment in transcript:
         print(segment['text'].strip(), file=file, flush=True)
 
+# Writes the whisper segments as vtt or srt subtitle to filename_without_extension + subtitle suffix
+def write_whisper_subtitle(segments, output_format, filename_without_extension):
+    if output_format == 'vtt':
+        with open(filename_without_extension + '.vtt', 'w') as outfile:
+            write_vtt(segments, file=outfile)
+    elif output_format == 'srt':
+        with open(filename_without_extension + '.srt', 'w') as outfile:
+            write_srt(segments, file=outfile)
+
 def whisper_asr(filename, status, task='transcribe', language=None, output_format='vtt', model='small', best_of=5, beam_size=5,
                 initial_prompt=None, condition_on_previous_text=True, fp16=True, compression_ratio_threshold=2.4,
-                logprob_threshold=-1., no_speech_threshold=0.6, verbose=False):
+                logprob_threshold=-1., no_speech_threshold=0.6, verbose=False, audio_cache_dir=default_cache_dir,
+                audio_cache_size=default_cache_size, trim_silence=0.0, trim_silence_threshold=default_threshold_db):
     if status:
         status.publish_status('Starting Whisper decode.')
 
@@ -75,7 +89,17 @@ def whisper_asr(filename, status, task='transcribe', language=None, output_forma
 
     try:
         whisper_model = whisper.load_model(model)
-        result = whisper_model.transcribe(filename, language=language, task=task,
+
+        # Whisper expects float32 samples in [-1, 1], like whisper.load_audio returns them
+        rate, data = load_audio(filename, cache_dir=audio_cache_dir, max_size=audio_cache_size, status=status)
+        speech_ranges, time_offsets = silence_trimming(data, rate, min_silence=trim_silence,
+                                                       threshold_db=trim_silence_threshold, status=status)
+        if speech_ranges:
+            data = trimmed_audio(data, speech_ranges)
+        audio = data.astype(np.float32)
+        audio /= 32768.0
+
+        result = whisper_model.transcribe(audio, language=language, task=task,
                                           temperature=(0.0, 0.2, 0.4, 0.6, 0.8, 1.0),
                               best_of=best_of, beam_size=beam_size, suppress_tokens="-1", initial_prompt=initial_prompt,
                               condition_on_previous_text=condition_on_previous_text, fp16=fp16,
@@ -83,12 +107,14 @@ def whisper_asr(filename, status, task='transcribe', language=None, output_forma
                               no_speech_threshold=no_speech_threshold,
                               verbose=verbose, status=status)
 
-        if output_format == 'vtt':
-            with open(filename_without_extension + '.vtt', 'w') as outfile:
-                write_vtt(result["segments"], file=outfile)
-        elif output_format == 'srt':
-            with open(filename_without_extension + '.srt', 'w') as outfile:
-                write_srt(result["segments"], file=outfile)
+        # Map the segment (and word) timestamps of the trimmed audio back to the time of the media file
+        if time_offsets:
+            for segment in result['segments']:
+                segment['start'], segment['end'] = map_times([segment['start'], segment['end']], time_offsets)
+                for word in segment.get('words', []):
+                    word['start'], word['end'] = map_times([word['start'], word['end']], time_offsets)
+
+        write_whisper_subtitle(result["segments"], output_format, filename_without_extension)
 
     except Exception as e:
         traceback.print_exc()